@@ -0,0 +1,145 @@
+# Author: Andrew.M.G.Reynen
+from __future__ import print_function, division
+import sys
+import pickle
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from obspy import Stream, Trace
+
+from HotVariables import readOnlySnapshot
+
+# If the class of a value defines the state it is pickled (and copied) with
+def hasOwnState(val):
+    return any(['__getstate__' in cls.__dict__ for cls in type(val).__mro__[:-1]])
+
+# Add the content of a value to a hash...
+# ...functions can not be looked into, so are identified by the object itself...
+# ...unless they define their state (such as the map projection, which is rebuilt from its state when copied)
+def updateContentHash(hasher,val):
+    hasher.update(type(val).__name__.encode())
+    if isinstance(val,np.ndarray):
+        hasher.update(repr((val.dtype.str,val.shape)).encode())
+        if val.dtype==object:
+            for entry in val.ravel():
+                updateContentHash(hasher,entry)
+        else:
+            hasher.update(np.ascontiguousarray(val).view(np.uint8))
+            if isinstance(val,np.ma.MaskedArray):
+                hasher.update(np.ascontiguousarray(np.ma.getmaskarray(val)).view(np.uint8))
+    elif isinstance(val,Stream):
+        for tr in val:
+            updateContentHash(hasher,tr)
+    elif isinstance(val,Trace):
+        stats=val.stats
+        hasher.update(repr((stats.network,stats.station,stats.location,stats.channel,str(stats.starttime),
+                            stats.sampling_rate,stats.npts,stats.calib)).encode())
+        updateContentHash(hasher,val.data)
+    elif isinstance(val,dict):
+        for key in sorted(val.keys(),key=str):
+            updateContentHash(hasher,key)
+            updateContentHash(hasher,val[key])
+    elif isinstance(val,(list,tuple)):
+        hasher.update(str(len(val)).encode())
+        for entry in val:
+            updateContentHash(hasher,entry)
+    elif inspect.ismethod(val):
+        # ...each look up of a method gives a new object, so use the object it is bound to
+        updateContentHash(hasher,val.__self__ if hasOwnState(val.__self__) else id(val.__self__))
+        hasher.update(val.__name__.encode())
+    elif callable(val) and hasOwnState(val):
+        updateContentHash(hasher,val.__getstate__())
+    elif callable(val):
+        hasher.update(str(id(val)).encode())
+    elif val is None or isinstance(val,(bool,int,float,complex,str,bytes,np.generic)):
+        hasher.update(repr(val).encode())
+    else:
+        hasher.update(pickle.dumps(val,2))
+
+# Return the content hash of a value
+def getContentHash(val):
+    hasher=hashlib.md5()
+    updateContentHash(hasher,val)
+    return hasher.hexdigest()
+
+# Approximate memory (bytes) used by a value, counting only the larger (array) parts exactly
+def getValSize(val):
+    if isinstance(val,np.ndarray):
+        return val.nbytes
+    elif isinstance(val,Stream):
+        return sum([tr.data.nbytes for tr in val])
+    elif isinstance(val,dict):
+        return sum([getValSize(aVal) for aVal in val.values()])
+    elif isinstance(val,(list,tuple)):
+        return sum([getValSize(aVal) for aVal in val])
+    return sys.getsizeof(val)
+
+# Bounded (least recently used) store of the returns of cacheable actions, keyed by...
+# ...the action and the content hashes of its optionals and inputs
+class ActionCache(object):
+    def __init__(self,maxSize=0):
+        self.maxSize=maxSize # Memory (MB) allowed for the cached returns
+        self.size=0
+        self.entries=OrderedDict() # Key:[returnVals,size]
+        self.lock=threading.RLock()
+        self.hits=0
+        self.misses=0
+    
+    # Return if the key was present, and if so a read only copy of the cached returns
+    def get(self,key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses+=1
+                return False,None
+            self.hits+=1
+            # Mark this as the most recently used
+            entry=self.entries.pop(key)
+            self.entries[key]=entry
+        return True,snapshotReturns(entry[0])
+    
+    # Add the returns of an action, removing the least recently used ones if over the size limit
+    def put(self,key,returnVals):
+        with self.lock:
+            self.remove(key)
+            size=getValSize(returnVals)/1024.0**2
+            if size>self.maxSize:
+                return
+            self.entries[key]=[snapshotReturns(returnVals),size]
+            self.size+=size
+            self.trim()
+    
+    def remove(self,key):
+        with self.lock:
+            if key in self.entries:
+                self.size-=self.entries.pop(key)[1]
+    
+    # Remove the least recently used entries until within the size limit
+    def trim(self):
+        with self.lock:
+            while self.size>self.maxSize and len(self.entries)!=0:
+                self.remove(next(iter(self.entries)))
+    
+    def setMaxSize(self,maxSize):
+        with self.lock:
+            self.maxSize=maxSize
+            self.trim()
+    
+    def clear(self):
+        with self.lock:
+            self.entries=OrderedDict()
+            self.size=0
+            self.hits=0
+            self.misses=0
+
+# Return the key of an action given the content hashes of its inputs
+def getActionCacheKey(action,inputHashes):
+    return (action.tag,action.path,action.name,getContentHash(action.optionals))+tuple(inputHashes)
+
+# Read only copy of an actions returns, with multiple returns (a tuple) copied individually
+def snapshotReturns(returnVals):
+    if isinstance(returnVals,tuple):
+        return tuple([readOnlySnapshot(aVal) for aVal in returnVals])
+    return readOnlySnapshot(returnVals)
@@ -0,0 +1,251 @@
+# Author: Andrew.M.G.Reynen
+from __future__ import print_function, division
+import sys
+import pickle
+import importlib
+import multiprocessing
+
+import numpy as np
+from obspy import Stream, Trace
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory=None
+
+# Arrays at least this large (bytes) are passed to/from the worker processes through shared memory
+SHARED_MIN_BYTES=64*1024
+
+# Place holder for an array which was put into a shared memory block
+class SharedArray(object):
+    def __init__(self,offset,shape,dtype):
+        self.offset=offset
+        self.shape=shape
+        self.dtype=dtype
+
+# Place holder for a stream, whose traces data may be within a shared memory block
+class PackedStream(object):
+    def __init__(self,traces):
+        self.traces=traces # [[stats,data],...]
+
+# Replace the larger numeric arrays within a value with place holders, noting the arrays to be shared
+def packVal(val,arrays):
+    if isinstance(val,np.ndarray) and not isinstance(val,np.ma.MaskedArray):
+        if val.dtype==object or val.nbytes<SHARED_MIN_BYTES:
+            return val
+        offset=sum([arr.nbytes for arr in arrays])
+        arrays.append(val)
+        return SharedArray(offset,val.shape,val.dtype.str)
+    elif isinstance(val,Stream):
+        return PackedStream([[tr.stats,packVal(tr.data,arrays)] for tr in val])
+    elif isinstance(val,dict):
+        return {key:packVal(aVal,arrays) for key,aVal in val.items()}
+    elif isinstance(val,(list,tuple)):
+        return type(val)([packVal(aVal,arrays) for aVal in val])
+    return val
+
+# Rebuild a value from its place holders, using the shared memory buffer...
+# ...if not copying, arrays are read only views of the buffer
+def unpackVal(val,buf,copy):
+    if isinstance(val,SharedArray):
+        arr=np.ndarray(val.shape,dtype=val.dtype,buffer=buf,offset=val.offset)
+        if copy:
+            return arr.copy()
+        arr.flags.writeable=False
+        return arr
+    elif isinstance(val,PackedStream):
+        return Stream(traces=[Trace(data=unpackVal(data,buf,copy),header=stats) for stats,data in val.traces])
+    elif isinstance(val,dict):
+        return {key:unpackVal(aVal,buf,copy) for key,aVal in val.items()}
+    elif isinstance(val,(list,tuple)):
+        return type(val)([unpackVal(aVal,buf,copy) for aVal in val])
+    return val
+
+# Pack a value, putting its larger arrays into one new shared memory block...
+# ...returns the packed value and the shared memory block (None if nothing was shared)
+def packShared(val):
+    if shared_memory is None:
+        return val,None
+    arrays=[]
+    packed=packVal(val,arrays)
+    if len(arrays)==0:
+        return val,None
+    shm=shared_memory.SharedMemory(create=True,size=sum([arr.nbytes for arr in arrays]))
+    offset=0
+    for arr in arrays:
+        np.ndarray(arr.shape,dtype=arr.dtype,buffer=shm.buf,offset=offset)[...]=arr
+        offset+=arr.nbytes
+    return packed,shm
+
+# Rebuild a packed value from the named shared memory block, the block is returned so it can be closed later
+def unpackShared(packed,shmName,copy):
+    if shmName is None:
+        return packed,None
+    shm=shared_memory.SharedMemory(name=shmName)
+    return unpackVal(packed,shm.buf,copy),shm
+
+# Close (and optionally remove) a shared memory block...
+# ...arrays still viewing the block (eg. kept by a plugin) prevent closing, these are left to be garbage collected
+def releaseShared(shm,unlink=False):
+    if shm is None:
+        return
+    try:
+        shm.close()
+    except BufferError:
+        pass
+    if unlink:
+        shm.unlink()
+
+# The object last read from shared memory (see shareObject) within a worker process, as [block name,object]
+WORKER_SHARED_OBJECT=[None,None]
+
+# Put an object, pickled, into a new shared memory block, so each worker process reads it once instead of with every task...
+# ...returns the block (None if shared memory is not available, the object should then be given to each task)
+def shareObject(obj):
+    if shared_memory is None:
+        return None
+    data=pickle.dumps(obj,protocol=pickle.HIGHEST_PROTOCOL)
+    shm=shared_memory.SharedMemory(create=True,size=len(data))
+    shm.buf[:len(data)]=data
+    return shm
+
+# Get the object put into the named shared memory block by shareObject, within a worker process...
+# ...only read again if it is not the object last read by this process
+def getSharedObject(shmName):
+    if WORKER_SHARED_OBJECT[0]!=shmName:
+        shm=shared_memory.SharedMemory(name=shmName)
+        try:
+            # Bytes past the pickled object (the block may be rounded up in size) are ignored
+            obj=pickle.loads(bytes(shm.buf))
+        finally:
+            shm.close()
+        WORKER_SHARED_OBJECT[:]=[shmName,obj]
+    return WORKER_SHARED_OBJECT[1]
+
+# Cancel token within a worker process, which reads the cancelled flag set by the main process
+class SharedCancelToken(object):
+    def __init__(self,shmName):
+        self.shm=shared_memory.SharedMemory(name=shmName)
+    
+    def isCancelled(self):
+        return self.shm.buf[0]!=0
+    
+    def close(self):
+        releaseShared(self.shm)
+
+# Reload generation of each plugin module within a worker process, as [module path]:generation
+WORKER_RELOAD_GENS={}
+
+# Get a function within a worker process, using the python path and plugin reload generation of the main process...
+# ...the module is reloaded if plugins were reloaded since the worker last used it
+def getWorkerFunc(path,name,sysPath,reloadGen):
+    if sys.path!=sysPath:
+        sys.path[:]=sysPath
+    mod=importlib.import_module(path)
+    if WORKER_RELOAD_GENS.get(path,reloadGen)!=reloadGen:
+        if sys.version_info[0]==2:
+            reload(mod)
+        else:
+            importlib.reload(mod)
+    WORKER_RELOAD_GENS[path]=reloadGen
+    return getattr(mod,name)
+
+# Run an actions function within a worker process...
+# ...the python path and plugin reload generation of the main process are sent along with each call...
+# ...inputs are read only views of the shared memory, unless asked to be copied
+def runProcessAction(path,name,optionals,packedInputs,shmName,sysPath,reloadGen,cancelName=None,copyInputs=False):
+    func=getWorkerFunc(path,name,sysPath,reloadGen)
+    inputs,inShm=unpackShared(packedInputs,shmName,copy=copyInputs)
+    if cancelName is not None:
+        optionals=dict(optionals)
+        optionals['cancelToken']=SharedCancelToken(cancelName)
+    try:
+        returnVals=func(*inputs,**optionals)
+        packedReturns,outShm=packShared(returnVals)
+    finally:
+        del inputs
+        releaseShared(inShm)
+        if cancelName is not None:
+            optionals['cancelToken'].close()
+    if outShm is None:
+        return packedReturns,None
+    outName=outShm.name
+    releaseShared(outShm)
+    return packedReturns,outName
+
+# Start a pool of processes...
+# ...spawn (rather than fork) as the main process holds the GUI, which may have other threads running
+def startProcessPool(nProcs,initializer=None,initargs=()):
+    if hasattr(multiprocessing,'get_context'):
+        context=multiprocessing.get_context('spawn')
+    else:
+        context=multiprocessing
+    # The GUI log replaces stdout and stderr, which have no file descriptor to pass on to new processes
+    guiStreams=[sys.stdout,sys.stderr]
+    sys.stdout,sys.stderr=sys.__stdout__,sys.__stderr__
+    try:
+        return context.Pool(nProcs,initializer=initializer,initargs=initargs)
+    finally:
+        sys.stdout,sys.stderr=guiStreams
+
+# Persistent pool of processes, which run the functions of actions marked to run in a separate process...
+# ...so that they do not hold up the GUI (python code run on a thread still shares the GIL)
+class ActionProcessPool(object):
+    def __init__(self,nProcs):
+        self.nProcs=nProcs
+        self.reloadGen=0 # Incremented whenever plugins are reloaded
+        self.pool=startProcessPool(nProcs)
+
+    # Call an actions function in one of the worker processes, returning its returns...
+    # ...if the inputs or optionals can not be sent to another process, the function is called here instead...
+    # ...a cancel token within kwargs is passed on as a shared flag (set when the token is cancelled)...
+    # ...if copyInputs, the worker gets its own (editable) copy of the inputs
+    def call(self,action,inputs,kwargs=None,copyInputs=False):
+        if kwargs is None:
+            kwargs=action.optionals
+        optionals=dict([[key,val] for key,val in kwargs.items() if key!='cancelToken'])
+        packedInputs,inShm=packShared(inputs)
+        try:
+            # Only the small parts are pickled here, the arrays are in shared memory
+            pickle.dumps((optionals,packedInputs),2)
+        except Exception as error:
+            releaseShared(inShm,unlink=True)
+            print('Action '+action.tag+' could not be sent to a process ('+str(error)+'), running it here')
+            return action.func(*inputs,**kwargs)
+        cancelToken,cancelShm,setFlag=kwargs.get('cancelToken'),None,None
+        if cancelToken is not None and shared_memory is not None:
+            cancelShm=shared_memory.SharedMemory(create=True,size=1)
+            cancelShm.buf[0]=0
+            def setFlag():
+                cancelShm.buf[0]=1
+            cancelToken.addCallback(setFlag)
+        try:
+            args=(action.path,action.name,optionals,packedInputs,
+                  None if inShm is None else inShm.name,list(sys.path),self.reloadGen,
+                  None if cancelShm is None else cancelShm.name,copyInputs)
+            packedReturns,outName=self.pool.apply_async(runProcessAction,args).get()
+        finally:
+            releaseShared(inShm,unlink=True)
+            if cancelShm is not None:
+                cancelToken.removeCallback(setFlag)
+                releaseShared(cancelShm,unlink=True)
+        returnVals,outShm=unpackShared(packedReturns,outName,copy=True)
+        releaseShared(outShm,unlink=True)
+        return returnVals
+
+    # Call an actions function, giving the worker its own copy of the inputs (for functions which edit them in place)
+    def copyCall(self,action,inputs,kwargs=None):
+        return self.call(action,inputs,kwargs,copyInputs=True)
+    
+    # Start a module level function with the given arguments in one of the worker processes, returning its AsyncResult...
+    # ...the function is run as is, so should use getWorkerFunc to reach any plugin functions
+    def applyAsync(self,func,args):
+        return self.pool.apply_async(func,args)
+    
+    # Have the workers reload plugin modules before their next call
+    def reload(self):
+        self.reloadGen+=1
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,223 @@
+# Author: Andrew.M.G.Reynen
+from __future__ import print_function, division
+import time
+import json
+import threading
+from collections import OrderedDict
+
+from PyQt5 import QtWidgets,QtCore
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc=None
+
+# Highest resolution clock available
+perfTime=getattr(time,'perf_counter',time.time)
+
+# The stages of an action which are timed, in the order they happen
+STAT_STAGES=['inputs','func','checks','gui']
+
+# Columns of the statistics table, and of the exported files
+STAT_COLUMNS=['tag','count','wallMean','wallMax','wallLast','inputsMean','funcMean',
+              'checksMean','guiMean','peakMemMax','peakMemLast','cacheHits','cacheMisses']
+
+# Record of how long each action spent in its stages, and how much memory it allocated...
+# ...inputs: collecting the inputs (including copying hot variables), func: the actions function...
+# ...checks: the return type and hot variable checks, gui: the hot variable update functions...
+# ...wall: from starting to collect the inputs until the returns are updated (includes waiting on the GUI for threads)
+class ActionStats(object):
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.pending={} # Stage times of the actions currently being run, keyed by action tag
+        self.stats=OrderedDict() # Running totals, keyed by action tag
+        self.memTrack=False # If peak allocations are being recorded
+        self.ownTrace=False # If tracemalloc was started here (so it can be stopped here)
+        self.changed=False # If new stats were added since last being shown
+
+    # Set if the peak memory allocations should be tracked (slows actions down while on)
+    def setMemTrack(self,memTrack):
+        if memTrack and tracemalloc is None:
+            print('Memory tracking requires tracemalloc (python 3.4+)')
+            memTrack=False
+        if memTrack and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.ownTrace=True
+        elif not memTrack and self.ownTrace:
+            tracemalloc.stop()
+            self.ownTrace=False
+        self.memTrack=memTrack
+
+    # Start recording an action, before its inputs are collected
+    def begin(self,tag):
+        with self.lock:
+            self.pending[tag]={'start':perfTime(),'peakMem':None,'cache':None}
+
+    # Add time spent in a stage of an action
+    def add(self,tag,stage,dt):
+        with self.lock:
+            if tag not in self.pending.keys():
+                return
+            self.pending[tag][stage]=self.pending[tag].get(stage,0)+dt
+
+    # Note if the returns of an action were found in the action cache (cacheable actions only)
+    def countCache(self,tag,hit):
+        with self.lock:
+            if tag in self.pending.keys():
+                self.pending[tag]['cache']='hit' if hit else 'miss'
+
+    # Call an actions function, recording its run time and peak allocation...
+    # ...allocations are traced process wide, so other threads running actions at the same time are included...
+    # ...call is used to run the function elsewhere (eg. another process), as call(action,inputs,kwargs)...
+    # ...kwargs default to the actions optionals
+    def callAction(self,action,inputs,call=None,kwargs=None):
+        memTrack=self.memTrack and tracemalloc is not None and tracemalloc.is_tracing()
+        if memTrack:
+            if hasattr(tracemalloc,'reset_peak'):
+                tracemalloc.reset_peak()
+            startMem=tracemalloc.get_traced_memory()[0]
+        if kwargs is None:
+            kwargs=action.optionals
+        t0=perfTime()
+        if call is None:
+            returnVals=action.func(*inputs,**kwargs)
+        else:
+            returnVals=call(action,inputs,kwargs)
+        dt=perfTime()-t0
+        self.add(action.tag,'func',dt)
+        if memTrack:
+            peakMem=max(0,tracemalloc.get_traced_memory()[1]-startMem)
+            with self.lock:
+                if action.tag in self.pending.keys():
+                    self.pending[action.tag]['peakMem']=peakMem
+        return returnVals
+
+    # Finish recording an action, once its returns have been updated, adding it to the running totals
+    def finish(self,tag):
+        with self.lock:
+            if tag not in self.pending.keys():
+                return
+            entry=self.pending.pop(tag)
+            wall=perfTime()-entry['start']
+            if tag not in self.stats.keys():
+                self.stats[tag]={'count':0,'wallSum':0,'wallMax':0,'wallLast':0,
+                                 'peakMemMax':None,'peakMemLast':None,'hit':0,'miss':0}
+                for stage in STAT_STAGES:
+                    self.stats[tag][stage+'Sum']=0
+            stat=self.stats[tag]
+            stat['count']+=1
+            stat['wallSum']+=wall
+            stat['wallMax']=max(stat['wallMax'],wall)
+            stat['wallLast']=wall
+            for stage in STAT_STAGES:
+                stat[stage+'Sum']+=entry.get(stage,0)
+            if entry['peakMem'] is not None:
+                stat['peakMemLast']=entry['peakMem']
+                stat['peakMemMax']=max(stat['peakMemMax'] or 0,entry['peakMem'])
+            if entry['cache'] is not None:
+                stat[entry['cache']]+=1
+            self.changed=True
+
+    # Forget all recorded stats
+    def clear(self):
+        with self.lock:
+            self.pending={}
+            self.stats=OrderedDict()
+            self.changed=True
+
+    # Return the stats as rows of STAT_COLUMNS, times in milliseconds and memory in MB...
+    # ...sorted with the slowest actions (by total wall time) first
+    def getRows(self):
+        with self.lock:
+            items=sorted(self.stats.items(),key=lambda item:-item[1]['wallSum'])
+            rows=[]
+            for tag,stat in items:
+                count=stat['count']
+                row=[tag,count,1000*stat['wallSum']/count,1000*stat['wallMax'],1000*stat['wallLast']]
+                row+=[1000*stat[stage+'Sum']/count for stage in STAT_STAGES]
+                row+=[None if stat[key] is None else stat[key]/1024.0**2 for key in ['peakMemMax','peakMemLast']]
+                row+=[stat['hit'],stat['miss']]
+                rows.append(row)
+        return rows
+
+    # Write the stats to a csv file
+    def exportCsv(self,fileName):
+        with open(fileName,'w') as aFile:
+            aFile.write(','.join(STAT_COLUMNS)+'\n')
+            for row in self.getRows():
+                aFile.write(','.join(['' if val is None else str(val) for val in row])+'\n')
+
+    # Write the stats to a json file, as a list of dictionaries
+    def exportJson(self,fileName):
+        with open(fileName,'w') as aFile:
+            json.dump([OrderedDict(zip(STAT_COLUMNS,row)) for row in self.getRows()],aFile,indent=1)
+
+# Table of the action stats, refreshed while visible, with the ability to export and clear them
+class ActionStatsWidget(QtWidgets.QWidget):
+    def __init__(self,actStats,parent=None,refreshInterval=500):
+        QtWidgets.QWidget.__init__(self,parent)
+        self.actStats=actStats
+        # Table of the stats
+        self.table=QtWidgets.QTableWidget(0,len(STAT_COLUMNS))
+        self.table.setHorizontalHeaderLabels(['Action','Count','Wall (ms)','Max (ms)','Last (ms)',
+                                              'Inputs (ms)','Func (ms)','Checks (ms)','GUI (ms)',
+                                              'Peak (MB)','Last Peak (MB)','Cache Hits','Cache Misses'])
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        # Buttons to clear and export
+        self.memCheckBox=QtWidgets.QCheckBox('Track Memory')
+        self.memCheckBox.setToolTip('Record the peak allocation of each action (slows actions down while on)')
+        self.memCheckBox.toggled.connect(self.actStats.setMemTrack)
+        self.clearButton=QtWidgets.QPushButton('Clear')
+        self.clearButton.clicked.connect(self.actStats.clear)
+        self.exportButton=QtWidgets.QPushButton('Export')
+        self.exportButton.clicked.connect(self.exportStats)
+        buttonLayout=QtWidgets.QHBoxLayout()
+        buttonLayout.addWidget(self.memCheckBox)
+        buttonLayout.addStretch()
+        buttonLayout.addWidget(self.clearButton)
+        buttonLayout.addWidget(self.exportButton)
+        layout=QtWidgets.QVBoxLayout(self)
+        layout.setContentsMargins(0,0,0,0)
+        layout.addWidget(self.table)
+        layout.addLayout(buttonLayout)
+        # Refresh periodically, rather than after every action
+        self.timer=QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(refreshInterval)
+
+    # Update the table if there are new stats, and it can be seen
+    def refresh(self,force=False):
+        if not force and (not self.actStats.changed or not self.isVisible()):
+            return
+        self.actStats.changed=False
+        rows=self.actStats.getRows()
+        self.table.setRowCount(len(rows))
+        for i,row in enumerate(rows):
+            for j,val in enumerate(row):
+                if val is None:
+                    text=''
+                elif isinstance(val,float):
+                    text='%.2f' % val if STAT_COLUMNS[j].startswith('peakMem') else '%.3f' % val
+                else:
+                    text=str(val)
+                item=QtWidgets.QTableWidgetItem(text)
+                if j>0:
+                    item.setTextAlignment(QtCore.Qt.AlignRight|QtCore.Qt.AlignVCenter)
+                self.table.setItem(i,j,item)
+
+    # Ask where to save the stats, the file type is given by the extension (csv or json)
+    def exportStats(self):
+        fileName,fileFilter=QtWidgets.QFileDialog.getSaveFileName(self,'Export Action Stats','actionStats.csv',
+                                                                  'CSV (*.csv);;JSON (*.json)')
+        if fileName=='':
+            return
+        if fileName.lower().endswith('.json') or (fileFilter.startswith('JSON') and not fileName.lower().endswith('.csv')):
+            if not fileName.lower().endswith('.json'):
+                fileName+='.json'
+            self.actStats.exportJson(fileName)
+        else:
+            if not fileName.lower().endswith('.csv'):
+                fileName+='.csv'
+            self.actStats.exportCsv(fileName)
+        print('Action stats exported to '+fileName)
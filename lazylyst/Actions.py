@@ -1,7 +1,9 @@
 # Author: Andrew.M.G.Reynen
 from __future__ import print_function
 import importlib
+import inspect
 import sys
+import threading
 from future.utils import iteritems
 
 from PyQt5 import QtWidgets, QtGui, QtCore
@@ -9,6 +11,7 @@ from PyQt5.QtCore import Qt
 
 from lazylyst.UI.ActionSetup import Ui_actionDialog
 from CustomFunctions import dict2Text, text2Dict
+from HotVariables import getHotVarEffects
 
 # Default Actions
 def defaultActions():
@@ -33,10 +36,26 @@ def defaultActions():
     'ReloadPlugins':Action(tag='ReloadPlugins',name='reloadPlugins',
                            path='$main',trigger=QtGui.QKeySequence('F5'),locked=True),
 
+    'ToggleActionStats':Action(tag='ToggleActionStats',name='toggleActionStats',
+                               path='$main',trigger=QtGui.QKeySequence('F7'),locked=True),
+
     'ReloadArchive':Action(tag='ReloadArchive',name='updateArchive',
                            path='$main',optionals={'showBar':False,'resetSearch':True},
                            trigger=QtGui.QKeySequence('F6'),threaded=True),
+
+    'RelocatePickDir':Action(tag='RelocatePickDir',name='relocatePickDir',
+                             path='$main',optionals={'locateTag':'SimpleLocate','nProcs':0},
+                             trigger=QtGui.QKeySequence('F9'),threaded=True,threadPolicy='supersede',
+                             inputs=['pickDir','pickFiles'],returns=['mapPrevEve']),
                            
+    'DetectArchive':Action(tag='DetectArchive',name='detectArchive',
+                           path='$main',optionals={'templatePre':-0.5,'templatePost':2.5,'phaseType':'P',
+                                                   'component':'Z','freqMin':2.0,'freqMax':10.0,'chunkLen':3600.0,
+                                                   'madMult':8.0,'minChans':3,'nProcs':0},
+                           trigger=QtGui.QKeySequence('F10'),threaded=True,threadPolicy='supersede',
+                           inputs=['stream','pickSet','curPickFile','pickDir','pickFiles',
+                                   'archDir','archFiles','archFileTimes'],returns=['pickFiles']),
+
     'SaveSettings':Action(tag='SaveSettings',name='saveSettings',
                           path='$main',optionals={'closing':False},
                           trigger=QtGui.QKeySequence('Ctrl+S'),locked=True),
@@ -165,7 +184,75 @@ def defaultPassiveOrder(actions):
     order=sorted([act.tag for tag,act in iteritems(actions) if act.passive])
 #    order=['SavePickSetOnNewEve','SimpleLocate'] ## Ensure this includes ALL default passive
     return order
+
+# Return which of the earlier actions within a queue each action has to wait on to be updated...
+# ...an action waits on any earlier action whose returns (or the hot variables their updates change) are its inputs...
+# ...actions of the main window may change anything, so wait on, and are waited on by, all others
+def getQueueDependencies(actQueue):
+    reads,writes=[],[]
+    for action in actQueue:
+        if action.path=='$main':
+            reads.append(None)
+            writes.append(None)
+        else:
+            reads.append(set(action.inputs))
+            writes.append(getHotVarEffects(action.returns))
+    deps=[]
+    for j in range(len(actQueue)):
+        deps.append([i for i in range(j) if writes[i] is None or reads[j] is None or
+                     len(writes[i]&reads[j])>0])
+    return deps
+    
+# What a threaded action does when triggered while its previous run is still going...
+# ...in the order of the action dialogs combo box
+THREAD_POLICIES=['drop','queue','supersede']
+
+# Cooperative cancellation of a run of actions...
+# ...functions with a cancelToken argument are given one when run on a thread, and should return early once isCancelled()
+class CancelToken(object):
+    def __init__(self):
+        self.event=threading.Event()
+        self.lock=threading.Lock()
+        self.callbacks=[] # Functions to call when cancelled (eg. to pass the cancel on to another process)
+    
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            callbacks=list(self.callbacks)
+        for func in callbacks:
+            func()
+    
+    def isCancelled(self):
+        return self.event.is_set()
+    
+    # Add a function to call when cancelled, called right away if already cancelled
+    def addCallback(self,func):
+        with self.lock:
+            self.callbacks.append(func)
+            cancelled=self.event.is_set()
+        if cancelled:
+            func()
     
+    def removeCallback(self,func):
+        with self.lock:
+            if func in self.callbacks:
+                self.callbacks.remove(func)
+
+# Check if a function has a cancelToken argument
+def takesCancelToken(func):
+    try:
+        if sys.version_info[0]==2:
+            return 'cancelToken' in inspect.getargspec(func).args
+        return 'cancelToken' in inspect.signature(func).parameters
+    except (TypeError,ValueError):
+        return False
+
+# Functions whose inputs or returns were cut down in newer versions, so saved actions using them can be updated...
+# ...{(path,name):[number of old inputs,inputs kept,number of old returns,returns kept]}
+# ...globalLocate no longer takes mainPath, customDict and staProjStyle (models are in a shared registry)...
+# ...nor returns customDict
+OLD_SIGNATURES={('Plugins.GlobalLocate','globalLocate'):[5,2,2,1]}
+
 # Capabilities of an action
 class Action(object):
     def __init__(self,tag='New action',name='Function name',
@@ -173,7 +260,8 @@ class Action(object):
                  passive=False,beforeTrigger=False,timer=False,
                  trigger='Add Trigger',inputs=[],returns=[],
                  timerInterval=60,func=None,locked=False,
-                 sleeping=False,threaded=False):
+                 sleeping=False,threaded=False,cached=False,process=False,
+                 threadPolicy='drop'):
         self.tag=tag # User visible name for the action
         self.name=name # Function name
         self.path=path # Function path (uses "." instead of "\", path is relative a directory in the systems PATH variable)
@@ -189,6 +277,10 @@ class Action(object):
         self.locked=locked # If the action is allowed to be altered (other than the trigger)
         self.sleeping=sleeping # If the action is responding to triggers or not
         self.threaded=threaded # If the action is to be run on a seperate thread ("in background")
+        self.cached=cached # If the returns can be reused when called again with the same inputs and optionals
+        self.process=process # If the function is to be run in a worker process (inputs and returns must be picklable)
+        self.threadPolicy=threadPolicy # When triggered while its thread is still running: "drop", "queue" or "supersede"
+        self.takesCancel=False # If the function accepts a cancelToken keyword (set when linked)
         # convert the trigger to a key sequence, if the trigger was a key
         if type(trigger)==type(Qt.Key_1):
             self.trigger=QtGui.QKeySequence(self.trigger)
@@ -221,17 +313,48 @@ class Action(object):
                 return
         # Assign the function to the action
         self.func=func
+        self.takesCancel=takesCancelToken(func)
         return
     
+    # Keyword arguments to send to the function, adding the cancel token if the function accepts one
+    def getKwargs(self,cancelToken=None):
+        if cancelToken is None or not getattr(self,'takesCancel',False):
+            return self.optionals
+        kwargs=dict(self.optionals)
+        kwargs['cancelToken']=cancelToken
+        return kwargs
+    
+    # If the actions function is run in a worker process
+    def inProcess(self):
+        return self.process and self.path!='$main'
+    
+    # If triggering this action runs its queue on a seperate thread...
+    # ...actions run in a worker process are also, so the GUI is not held up waiting on the process
+    def runsThreaded(self):
+        return self.threaded or self.inProcess()
+    
     # Assign the default attributes which were are added in newer versions...
     # ...if not already present
     def fillMissingAttrib(self):
         defAct=Action()
-        for attrib in ['sleeping','threaded']:
+        for attrib in ['sleeping','threaded','cached','process','threadPolicy']:
             try:
                 getattr(self,attrib)
             except:
                 setattr(self,attrib,getattr(defAct,attrib))
+        self.updateOldSignature()
+    
+    # Drop the inputs and returns no longer used by the function, if saved with an older version (see OLD_SIGNATURES)
+    def updateOldSignature(self):
+        if (self.path,self.name) not in OLD_SIGNATURES:
+            return
+        nOldInputs,nInputs,nOldReturns,nReturns=OLD_SIGNATURES[(self.path,self.name)]
+        if len(self.inputs)==nOldInputs:
+            print('Action '+self.tag+' uses an older version of '+self.name+', dropping inputs '+str(self.inputs[nInputs:]))
+            self.inputs=self.inputs[:nInputs]
+        if len(self.returns)==nOldReturns:
+            print('Action '+self.tag+' uses an older version of '+self.name+', dropping returns '+str(self.returns[nReturns:]))
+            self.returns=self.returns[:nReturns]
         
 # Action setup dialog
 class ActionSetupDialog(QtWidgets.QDialog, Ui_actionDialog):
@@ -308,6 +431,12 @@ class ActionSetupDialog(QtWidgets.QDialog, Ui_actionDialog):
             self.activeTimerCheck.setChecked(False)
         # Set the state of the activeThreaded check box
         self.activeThreadedCheck.setChecked(self.action.threaded)
+        # ...and what to do if triggered while its thread is still running
+        self.activeThreadPolicyCombo.setCurrentIndex(THREAD_POLICIES.index(self.action.threadPolicy))
+        # Set the state of the cached check box
+        self.actCachedCheck.setChecked(self.action.cached)
+        # Set the state of the process check box
+        self.actProcessCheck.setChecked(self.action.process)
         # Set the timer interval value
         self.actIntervalLineEdit.setText(str(self.action.timerInterval))
         # Toggle the appropriate radio button
@@ -348,7 +477,8 @@ class ActionSetupDialog(QtWidgets.QDialog, Ui_actionDialog):
                        self.actSelectInputList,self.actSelectReturnList,
                        self.actPassiveRadio,self.actActiveRadio,
                        self.passiveBeforeCheck,self.activeTimerCheck,
-                       self.activeThreadedCheck,self.actTagLineEdit]:
+                       self.activeThreadedCheck,self.activeThreadPolicyCombo,
+                       self.actCachedCheck,self.actProcessCheck,self.actTagLineEdit]:
             widget.setEnabled(False)
     
     # Update the key bind to what the user pressed
@@ -408,6 +538,7 @@ class ActionSetupDialog(QtWidgets.QDialog, Ui_actionDialog):
         self.actIntervalLineEdit.setEnabled(active)
         self.activeTimerCheck.setEnabled(active)
         self.activeThreadedCheck.setEnabled(active)
+        self.activeThreadPolicyCombo.setEnabled(active)
         self.passiveBeforeCheck.setEnabled(not active)
         self.actAvailTriggerList.setEnabled(not active)
         self.actSelectTriggerList.setEnabled(not active)
@@ -505,9 +636,23 @@ class ActionSetupDialog(QtWidgets.QDialog, Ui_actionDialog):
             self.action.threaded=True
         else:
             self.action.threaded=False
+        self.action.threadPolicy=THREAD_POLICIES[self.activeThreadPolicyCombo.currentIndex()]
         # Collect the tags of the inputs and returns associated with the action
         self.action.inputs=self.actSelectInputList.visualListOrder()
         self.action.returns=self.actSelectReturnList.visualListOrder()
+        # If the returns of previous calls can be reused
+        self.action.cached=self.actCachedCheck.isChecked()
+        if self.action.cached and 'customDict' in self.action.inputs:
+            print('Action '+self.action.tag+' takes customDict (which can be edited in place), so will not be cached')
+        # If the function should be run in a worker process
+        self.action.process=self.actProcessCheck.isChecked()
+        if self.action.process and self.action.path=='$main':
+            print('Action '+self.action.tag+' is part of the main window, so will not be run in a process')
+        elif self.action.process and not self.action.passive and not self.action.threaded:
+            print('Action '+self.action.tag+' is run in a process, so its queue is run on a seperate thread (as if threaded)')
+        elif self.action.process and self.action.passive:
+            print('Action '+self.action.tag+' is passive, so holds up the GUI while in its process '+
+                  'unless the triggering action is threaded or run in a process')
         # Try to link to the function (given the new path, and name)
         try:
             self.action.linkToFunction(self.main)
@@ -517,38 +662,74 @@ class ActionSetupDialog(QtWidgets.QDialog, Ui_actionDialog):
         
 # Custom thread class to execute a queue of actions
 class QueueThread(QtCore.QThread):
-    setNextInputs=QtCore.pyqtSignal()    
-    sendReturns=QtCore.pyqtSignal()
+    setNextInputs=QtCore.pyqtSignal(int)
+    sendReturns=QtCore.pyqtSignal(int,object)
     
-    def __init__(self,tag,actQueue):
+    def __init__(self,tag,actQueue,callAction=None):
         QtCore.QThread.__init__(self)
         self.tag=tag # The tag of the active action which created this queue
         self.actQueue=actQueue # The queue of all actions relating to the active action
+        self.callAction=callAction # Function used to call the actions (with inputs, cache key and cancel token), if not called directly
+        self.cancelToken=CancelToken() # Set when this run is no longer wanted
         self.inputs=None # The inputs of the action currently being processed
+        self.cacheKey=None # The cache key of the action currently being processed
         self.returns=None # The returns of the last action processed
         self.curIdx=None # Which index within the action queue is being processed
+        # Wakes the thread as soon as the GUI has sent inputs, or finished updating returns
+        self.mutex=QtCore.QMutex()
+        self.handoff=QtCore.QWaitCondition()
     
-    def setInputs(self,inputs):
+    def setInputs(self,inputs,cacheKey=None):
+        self.mutex.lock()
         self.inputs=inputs
+        self.cacheKey=cacheKey
+        self.handoff.wakeAll()
+        self.mutex.unlock()
         
+    # Stop the queue after the current action, whose returns are dropped...
+    # ...the current action itself only stops early if its function checks the cancel token
+    def cancel(self):
+        self.cancelToken.cancel()
+    
     def resetInputsAndReturns(self):
+        self.mutex.lock()
         self.returns=None
         self.inputs=None
+        self.handoff.wakeAll()
+        self.mutex.unlock()
     
     # This function is called using the start() function
     def run(self):
         # Go through each of the queued action and execute it
         for i in range(len(self.actQueue)):
+            if self.cancelToken.isCancelled():
+                break
             # Ask to collect the required inputs
             self.curIdx=i
-            self.setNextInputs.emit()
-            # Wait to collect the inputs before processing the action
-            while self.inputs==None:
-                self.msleep(50)
+            self.setNextInputs.emit(i)
+            # Wait to collect the inputs before processing the action...
+            # ...taking them, so they are not reused by the next action
+            self.mutex.lock()
+            while self.inputs is None:
+                self.handoff.wait(self.mutex)
+            inputs,self.inputs=self.inputs,None
+            cacheKey=self.cacheKey
+            self.mutex.unlock()
             # Run the actions function and send back the return values
-            self.returns=self.actQueue[self.curIdx].func(*self.inputs,**self.actQueue[self.curIdx].optionals)
-            self.sendReturns.emit()
+            if self.callAction is None:
+                returns=self.actQueue[i].func(*inputs,**self.actQueue[i].getKwargs(self.cancelToken))
+            else:
+                returns=self.callAction(self.actQueue[i],inputs,cacheKey,self.cancelToken)
+            # Returns of a cancelled run are out of date
+            if self.cancelToken.isCancelled():
+                break
+            self.mutex.lock()
+            self.returns=returns
+            self.mutex.unlock()
+            self.sendReturns.emit(i,returns)
             # Wait for the return values on the GUI to be updated
+            self.mutex.lock()
             while self.returns is not None:
-                self.msleep(50)
+                self.handoff.wait(self.mutex)
+            self.mutex.unlock()
         self.exit()
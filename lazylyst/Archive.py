@@ -2,6 +2,13 @@
 from __future__ import print_function,division
 import os
 import sys
+import io
+import struct
+import time
+import multiprocessing
+import threading
+from fnmatch import fnmatch
+from collections import OrderedDict
 import ctypes as C
 if sys.version_info[0]==2:
     from scandir import scandir
@@ -15,6 +22,9 @@ from obspy.core.utcdatetime import UTCDateTime
 from obspy.io.mseed.headers import clibmseed,VALID_CONTROL_HEADERS,SEED_CONTROL_HEADERS
 from PyQt5 import QtWidgets, QtCore
 
+from ArchiveIndex import ArchiveIndex,getIndexPath
+from ActionProcess import startProcessPool
+
 # If the stream was not able to be merged, check to see if multiple sampling rates on the same channel...
 # ... and remove the ones with the uncommon sampling rate
 def RemoveOddRateTraces(stream):
@@ -46,7 +56,18 @@ def RemoveOddRateTraces(stream):
 
 # Given two timestamps, extract all information...
 # fileTimes contains [startTime,endTime] of the archive files
-def extractDataFromArchive(t1,t2,fileNames,fileTimes,wantedStaChas=[['*','*']]):
+# ...if the archive directory is given, only the indexed records overlapping the times are read
+# ...if a stream cache is given, previously extracted windows are returned from it (if the files are unchanged)
+def extractDataFromArchive(t1,t2,fileNames,fileTimes,wantedStaChas=[['*','*']],archDir=None,cache=None):
+    if cache is not None:
+        key=getStreamCacheKey(t1,t2,archDir,wantedStaChas)
+        state=getArchiveState(t1,t2,fileNames,fileTimes,archDir)
+        stream=cache.get(key,state)
+        if stream is None:
+            stream=extractDataFromArchive(t1,t2,fileNames,fileTimes,wantedStaChas,archDir)
+            cache.put(key,state,stream)
+        # Give back a copy, so the cached stream is not altered
+        return stream.copy()
     # Return nothing if there is no data
     if len(fileTimes)==0:
         return EmptyStream()
@@ -55,6 +76,12 @@ def extractDataFromArchive(t1,t2,fileNames,fileTimes,wantedStaChas=[['*','*']]):
         return EmptyStream()
     # Figure out what set of files are wanted
     collectArgs=np.where((fileTimes[:,0]<=t2)&(fileTimes[:,1]>=t1))[0]
+    # Get the record blocks of the wanted files which overlap the times (files not record indexed are read fully)
+    fileBlocks={}
+    if archDir is not None and os.path.exists(getIndexPath(archDir)):
+        index=ArchiveIndex(archDir)
+        fileBlocks=index.getFileBlocks(list(fileNames[collectArgs]),t1,t2)
+        index.close()
     stream=EmptyStream()
     flagged=False
     # Read in all of the information
@@ -63,7 +90,10 @@ def extractDataFromArchive(t1,t2,fileNames,fileTimes,wantedStaChas=[['*','*']]):
         if not os.path.exists(aFile):
             flagged=True
             continue
-        aStream=read(aFile)
+        if aFile in fileBlocks:
+            aStream=readMseedBlocks(aFile,selectBlocks(fileBlocks[aFile],wantedStaChas))
+        else:
+            aStream=read(aFile)
         for aSta,aCha in wantedStaChas:
             stream+=aStream.select(station=aSta,channel=aCha)
     if flagged: 
@@ -81,6 +111,133 @@ def extractDataFromArchive(t1,t2,fileNames,fileTimes,wantedStaChas=[['*','*']]):
     stream.trim(UTCDateTime(t1),UTCDateTime(t2))
     return stream
     
+# Get the state of the files overlapping the given times, [[path,startTime,endTime,mtime,ctime,size],...]...
+# ...if any of these change, data extracted previously for these times is outdated
+def getArchiveState(t1,t2,fileNames,fileTimes,archDir=None):
+    if len(fileTimes)==0:
+        return ()
+    collectArgs=np.where((fileTimes[:,0]<=t2)&(fileTimes[:,1]>=t1))[0]
+    fileMeta={}
+    if archDir is not None and os.path.exists(getIndexPath(archDir)):
+        index=ArchiveIndex(archDir)
+        fileMeta=index.getFileMeta(list(fileNames[collectArgs]))
+        index.close()
+    return tuple([(fileNames[i],fileTimes[i,0],fileTimes[i,1])+fileMeta.get(fileNames[i],()) for i in collectArgs])
+
+# Key used for a extracted window within the stream cache
+def getStreamCacheKey(t1,t2,archDir=None,wantedStaChas=[['*','*']]):
+    return (t1,t2,archDir,tuple([tuple(staCha) for staCha in wantedStaChas]))
+
+# Least recently used cache of extracted streams, limited to a given size in MB...
+# ...may be shared with the prefetching thread, so all access is locked
+class StreamCache(object):
+    def __init__(self,maxSize=0):
+        self.maxSize=maxSize
+        self.size=0
+        self.entries=OrderedDict() # Key:[state,stream,size]
+        self.lock=threading.RLock()
+        
+    # Get the stream for this key, if present and the files it was read from have the same state
+    def get(self,key,state):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            if self.entries[key][0]!=state:
+                self.remove(key)
+                return None
+            # Mark this as the most recently used
+            entry=self.entries.pop(key)
+            self.entries[key]=entry
+            return entry[1]
+    
+    # Add a stream to the cache, removing the least recently used ones if over the size limit
+    def put(self,key,state,stream):
+        with self.lock:
+            self.remove(key)
+            size=sum([tr.data.nbytes for tr in stream])/1024.0**2
+            if size>self.maxSize:
+                return
+            self.entries[key]=[state,stream,size]
+            self.size+=size
+            self.trim()
+    
+    def remove(self,key):
+        with self.lock:
+            if key in self.entries:
+                self.size-=self.entries.pop(key)[2]
+    
+    # Remove the least recently used entries until within the size limit
+    def trim(self):
+        with self.lock:
+            while self.size>self.maxSize and len(self.entries)!=0:
+                self.remove(next(iter(self.entries)))
+    
+    def setMaxSize(self,maxSize):
+        with self.lock:
+            self.maxSize=maxSize
+            self.trim()
+    
+    def clear(self):
+        with self.lock:
+            self.entries=OrderedDict()
+            self.size=0
+
+# Thread which extracts upcoming windows into the stream cache, while the current one is viewed
+class StreamPrefetcher(QtCore.QThread):
+    def __init__(self,cache,parent=None):
+        super(StreamPrefetcher, self).__init__(parent)
+        self.cache=cache
+        self.cond=threading.Condition()
+        self.toFetch=[] # Windows yet to be extracted [[key,t1,t2],...]
+        self.fetchArgs=None # The [fileNames,fileTimes,archDir,wantedStaChas] used for extracting
+        self.curKey=None # The window currently being extracted
+        self.stopped=False
+    
+    # Replace any pending windows [[t1,t2],...] with the new ones, in order of priority
+    def request(self,windows,fileNames,fileTimes,archDir=None,wantedStaChas=[['*','*']]):
+        with self.cond:
+            self.toFetch=[[getStreamCacheKey(t1,t2,archDir,wantedStaChas),t1,t2] for t1,t2 in windows]
+            self.fetchArgs=[fileNames,fileTimes,archDir,wantedStaChas]
+            self.cond.notify_all()
+        if not self.isRunning():
+            self.start()
+    
+    def run(self):
+        while True:
+            with self.cond:
+                while len(self.toFetch)==0 and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                key,t1,t2=self.toFetch.pop(0)
+                fileNames,fileTimes,archDir,wantedStaChas=self.fetchArgs
+                self.curKey=key
+            try:
+                state=getArchiveState(t1,t2,fileNames,fileTimes,archDir)
+                if self.cache.get(key,state) is None:
+                    stream=extractDataFromArchive(t1,t2,fileNames,fileTimes,wantedStaChas,archDir)
+                    self.cache.put(key,state,stream)
+            except Exception as error:
+                print('Prefetching of data failed: '+str(error))
+            with self.cond:
+                self.curKey=None
+                self.cond.notify_all()
+    
+    # If a window is pending or being extracted, ensure it is not read twice...
+    # ...pending windows are dropped, and ones being extracted are waited upon
+    def waitFor(self,key):
+        with self.cond:
+            self.toFetch=[entry for entry in self.toFetch if entry[0]!=key]
+            while self.curKey==key:
+                self.cond.wait()
+    
+    # Stop the thread, after the current extraction
+    def stop(self):
+        with self.cond:
+            self.stopped=True
+            self.cond.notify_all()
+        self.wait()
+
 # Get a list of all files of the accepted extension types, and their metadata
 def getDirFiles(mainDir,acceptedExtensions):
     metaData=[] # The returned metadata [path,mtime,ctime,fileSize]
@@ -108,89 +265,111 @@ def getDirFiles(mainDir,acceptedExtensions):
 #    print('...scan complete')
     return metaData
 
-# Get the previously loaded archives file metadata and start/end times
-def getPrevArchive(mainDir):
-    try:
-        meta=np.load(mainDir+'/lazylystArchiveMeta.npy')
-        times=np.load(mainDir+'/lazylystArchiveTimes.npy')
-        return meta,times
-    except:
-        return np.empty((0,4)),np.empty((0,2))
-    
 # Empty class to be able to pass objects to the progress widget
 class ValueObj(object):
     def __init__(self):
         self.value=[]
 
-# Read in all the start and stop times of the files
-def getArchiveAvail(archDir,acceptFileTypes=['seed','miniseed','mseed'],showBar=True):
+# Read in all the start and stop times of the files...
+# ...only files which are new or whose metadata changed since the last load are scanned...
+# ...spread over nProcs processes (all cores if None), and without any widgets if not showing the bar
+def getArchiveAvail(archDir,acceptFileTypes=['seed','miniseed','mseed'],showBar=True,nProcs=None,cancelToken=None):
     # Get the currently present files metadata
     curMeta=getDirFiles(archDir,acceptFileTypes)
-    curMeta=np.array(curMeta,dtype=str)
-    curTimes=np.zeros((len(curMeta),2))
     # If there are no files in archDir
     if len(curMeta)==0:
-        return np.array([]),curTimes
-    # Get the previously loaded archive metadata if it exists
-    prevMeta,prevTimes=getPrevArchive(archDir)
-    # If the arrays are already exactly the same, do not bother updating
-    if np.array_equal(prevMeta,curMeta):
-        return prevMeta[:,0],prevTimes
-    # See which files are common among current and previous metadata (check, which may be added to load)...
-    prevFiles=list(prevMeta[:,0])
-    if len(prevMeta)!=0:
-        checkIdxs=[[i,prevFiles.index(item)] for i, item in enumerate(curMeta[:,0]) if item in set(prevFiles)]
-    else:
-        checkIdxs=[]
-    checkIdxs=np.array(checkIdxs)
-    # ...as well as which files were not previously present (load)
-    if len(checkIdxs)==0:
-        loadIdxs=list(range(len(curMeta)))
-    else:
-        loadIdxs=[i for i in range(len(curMeta)) if i not in checkIdxs[:,0]]
-    # Set the current time to be the previous times (where present) by default
-    if len(checkIdxs)!=0:
-        curTimes[checkIdxs[:,0]]=prevTimes[checkIdxs[:,1]]
-    # See which current files need to be loaded
-    loadIdxs+=[i for i,j in checkIdxs if not np.array_equal(curMeta[i],prevMeta[j])]
-    loadIdxs=np.array(loadIdxs,dtype=int)
-    # Go get all of these times ## ##
-    holder=ValueObj() 
-    if len(loadIdxs)!=0:
+        return np.array([]),np.zeros((0,2))
+    # Compare against the previously loaded archive index, to see which files need to be loaded
+    index=ArchiveIndex(archDir)
+    loadMeta=index.getChangedFiles(curMeta)
+    # Go get all of these files traces and times
+    if len(loadMeta)!=0:
+        holder=ValueObj()
+        scanner=ArchiveScanner([entry[0] for entry in loadMeta],nProcs=nProcs)
         # Have the option to show the progress bar, or run all and now show progress
-        bar=ArchLoadProgressBar(holder,curMeta[loadIdxs,0],useTimer=showBar)
-        if showBar:
-            bar.exec_()
+        try:
+            if showBar:
+                bar=ArchLoadProgressBar(holder,scanner)
+                bar.exec_()
+            else:
+                holder.value=scanner.fileInfos
+                scanner.scanAll(cancelToken=cancelToken)
+        # As the new times loading could have been canceled (or interrupted), update just the ones which were loaded
+        finally:
+            scanner.close()
+            index.updateFiles(loadMeta[:len(holder.value)],holder.value)
+    # Return the file names and times
+    fileNames,fileTimes=index.getFileTimes()
+    index.close()
+    return fileNames,fileTimes
+
+# Minimum number of files to be scanned before starting up a pool of processes
+MIN_POOL_FILES=50
+
+# Scans a set of archive files, in order, spread over a pool of processes...
+# ...results are collected in self.fileInfos as they arrive, so partial results remain if stopped
+class ArchiveScanner(object):
+    def __init__(self,files,nProcs=None):
+        self.files=files
+        self.fileInfos=[]
+        if nProcs is None:
+            nProcs=multiprocessing.cpu_count()
+        nProcs=max(1,min(nProcs,len(files)))
+        # Small scans are not worth the start up of the processes
+        if nProcs==1 or len(files)<MIN_POOL_FILES:
+            self.pool=None
+            self.results=(scanArchiveFileWorker(aFile) for aFile in files)
         else:
-            while len(holder.value)==0:
-                bar.getFileLims()
-        times=np.array(holder.value)
-        # As the new times loading could have been canceled, update just the ones which were updated
-        curTimes[loadIdxs[:len(times)]]=times                   
+            self.pool=startProcessPool(nProcs)
+            # ...one file per task, as only then can results be waited on with a timeout
+            self.results=self.pool.imap(scanArchiveFileWorker,files)
+    
+    # Check if all files have been scanned
+    def isComplete(self):
+        return len(self.fileInfos)>=len(self.files)
     
-    # Keep the times which are not still [0,0]
-    keepIdxs=np.where((curTimes[:,0]!=0)|(curTimes[:,1]!=0))[0]
-    curMeta=curMeta[keepIdxs]
-    curTimes=curTimes[keepIdxs]
+    # Collect any results which arrive within the given time (seconds)...
+    # ...returns the number of files collected
+    def collect(self,waitTime):
+        nCollect=0
+        endTime=time.time()+waitTime
+        while not self.isComplete():
+            try:
+                if self.pool is None:
+                    fileInfo=next(self.results)
+                else:
+                    fileInfo=self.results.next(timeout=max(0,endTime-time.time()))
+            except multiprocessing.TimeoutError:
+                break
+            self.fileInfos.append(fileInfo)
+            nCollect+=1
+            if time.time()>=endTime:
+                break
+        return nCollect
     
-    # Finally save the new metadata and times...
-    np.save(archDir+'/lazylystArchiveMeta',curMeta)
-    np.save(archDir+'/lazylystArchiveTimes',curTimes)
-    # ...and return the file names and times
-    return curMeta[:,0],curTimes
+    # Scan all of the files, blocking until complete or cancelled
+    def scanAll(self,cancelToken=None):
+        while not self.isComplete():
+            if cancelToken is not None and cancelToken.isCancelled():
+                break
+            self.collect(1.0)
+    
+    # Stop any remaining scanning
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool=None
 
 # Progress bar for the archive...
 class ArchLoadProgressBar(QtWidgets.QDialog):
-    def __init__(self,holder,toReadFiles,useTimer=True, parent=None):
+    def __init__(self,holder,scanner,parent=None):
         super(ArchLoadProgressBar, self).__init__(parent)
         self.holder=holder
-        # Set up values to for scanning file times
-        self.files=toReadFiles
-        self.nFiles=float(len(self.files))
-        self.fileMinMaxs=[]
-        self.nextFileIdx=0
-        # Marker if the quick MSEED reading fails
-        self.quickReadFail=False
+        # The scanner which is collecting the file times
+        self.scanner=scanner
+        self.nFiles=float(len(scanner.files))
+        self.loadComplete=False
         # Set up progress bar size and min/max values
         self.resize(300,40)
         self.progressbar = QtWidgets.QProgressBar()
@@ -205,17 +384,17 @@ class ArchLoadProgressBar(QtWidgets.QDialog):
         main_layout.addWidget(self.button)
         self.setLayout(main_layout)
         self.setWindowTitle('Loading archive changes...')
-        # Add a timer and start loading
+        # Add a timer and start collecting the results
         self.timer = QtCore.QTimer()
-        if useTimer:
-            self.timer.timeout.connect(self.getFileLims)
-            self.timer.start(5) # 5 millisecond interval
+        self.timer.timeout.connect(self.getFileLims)
+        self.timer.start(5) # 5 millisecond interval
     
-    # Stop the timer from loading files
+    # Stop the timer from collecting files
     def cancelLoad(self):
         self.timer.stop()
-        self.holder.value=self.fileMinMaxs
-        print(len(self.fileMinMaxs),'archive files were updated')
+        self.loadComplete=True
+        self.holder.value=self.scanner.fileInfos
+        print(len(self.scanner.fileInfos),'archive files were updated')
         self.close()
 
     # If closed, treat as canceled
@@ -223,41 +402,54 @@ class ArchLoadProgressBar(QtWidgets.QDialog):
         if self.timer.isActive():
             self.cancelLoad()
 
-    # Get the earliest and latest time data exists in the wanted files
+    # Collect the traces, record blocks, and their earliest and latest times of the scanned files...
+    # ...only briefly, so that the GUI stays responsive
     def getFileLims(self):
-        # Stop if no more files to load
-        if self.nextFileIdx>=self.nFiles:
-            self.cancelLoad()
-            return
-        nextFile=self.files[self.nextFileIdx]
-        # Try the quick read function
-        if not self.quickReadFail:
-            try:
-                startEnds=getMseedStartEnds(nextFile)
-                minTime,maxTime=np.min(startEnds[:,0]),np.max(startEnds[:,1])
-            except:
-                print('Quick MSEED reading failed on file: '+nextFile)
-                self.quickReadFail=True
-        if self.quickReadFail:
-            try:
-                st=read(nextFile,headonly=True,format='MSEED')
-                stats=[tr.stats for tr in st]
-                # Get min and max times from file
-                minTime=np.min([stat.starttime for stat in stats]).timestamp
-                maxTime=np.max([stat.endtime for stat in stats]).timestamp
-            except:
-                print('Regular MSEED reading failed on file: '+nextFile)
-                minTime,maxTime=0,0 # Assign 0,0 to be removed later
+        self.scanner.collect(0.05)
         # Get a measure of progress and update the GUI
-        perc=int(100*(self.nextFileIdx+1)/self.nFiles)
+        perc=int(100*len(self.scanner.fileInfos)/self.nFiles)
         if perc>self.progressbar.value():
             self.progressbar.setValue(perc)
-        # Update the GUI every Xth loop
-        if self.nextFileIdx%10==0:
-            QtWidgets.qApp.processEvents()
-        # Update the index, and add this min/max time
-        self.nextFileIdx+=1
-        self.fileMinMaxs.append([minTime,maxTime])
+        # Stop if no more files to load
+        if self.scanner.isComplete():
+            self.cancelLoad()
+
+# Whether the quick MSEED reading has failed within this process
+QUICK_READ_FAIL=False
+
+# Scan a single file, remembering if the quick read has failed (for use with the scanning processes)
+def scanArchiveFileWorker(aFile):
+    global QUICK_READ_FAIL
+    fileInfo,QUICK_READ_FAIL=scanArchiveFile(aFile,QUICK_READ_FAIL)
+    return fileInfo
+
+# Get the [NSLC,startTime,endTime] of all traces in a file, as well as its record blocks...
+# ...the quick read is tried first, falling back to obspy if it fails (and staying there if wanted)
+def scanArchiveFile(aFile,quickReadFail=False):
+    traces=[]
+    # Try the quick read function
+    if not quickReadFail:
+        try:
+            ids,startEnds=getMseedStartEnds(aFile,returnIds=True)
+            traces=[[anID,t1,t2] for anID,(t1,t2) in zip(ids,startEnds)]
+        except:
+            print('Quick MSEED reading failed on file: '+aFile)
+            quickReadFail=True
+    if quickReadFail:
+        try:
+            st=read(aFile,headonly=True,format='MSEED')
+            traces=[[tr.id,tr.stats.starttime.timestamp,tr.stats.endtime.timestamp] for tr in st]
+        except:
+            print('Regular MSEED reading failed on file: '+aFile)
+            traces=[] # No traces, will not be shown in the archive availability
+    # Index the records, if this fails the whole file is read when extracting data
+    blocks=[]
+    if len(traces)!=0:
+        try:
+            blocks=getMseedRecordBlocks(aFile)
+        except:
+            print('Record indexing failed on file: '+aFile)
+    return [traces,blocks],quickReadFail
 
 # Functions used for getMseedStartEnds
 def passFunc(*args):
@@ -265,8 +457,9 @@ def passFunc(*args):
 def isdigit(x):
     return True if (x - ord('0')).max() <= 9 else False
 
-# Read the just start and end time from all traces in MSEED
-def getMseedStartEnds(aFile):
+# Read the just start and end time from all traces in MSEED...
+# ...optionally also returning the NSLC of each trace
+def getMseedStartEnds(aFile,returnIds=False):
     # Read file
     bfr_np = np.fromfile(aFile, dtype=np.int8)
  
@@ -311,6 +504,7 @@ def getMseedStartEnds(aFile):
     # Read first section of the miniseed
     current_id = lil.contents
     timeInfo=np.zeros((0,2),dtype=float)
+    ids=[]
     # Loop over each NSLC
     while True:
         try:
@@ -327,6 +521,8 @@ def getMseedStartEnds(aFile):
             except ValueError:
                 # Append these values to array
                 timeInfo=np.vstack((timeInfo,np.array([startTime,duration],dtype=float)))
+                ids.append('.'.join([code.decode() for code in [current_id.network,current_id.station,
+                                                                current_id.location,current_id.channel]]))
                 break
         try:
             current_id = current_id.next.contents
@@ -337,10 +533,171 @@ def getMseedStartEnds(aFile):
     clibmseed.lil_free(lil)
     del lil
     
-    # Return start and end times
-    if len(timeInfo)==0:
-        return timeInfo
-    else:
-        # Make the second entry the end time (start time + duration)
+    # Make the second entry the end time (start time + duration)
+    if len(timeInfo)!=0:
         timeInfo[:,1]=np.sum(timeInfo,axis=1)
-        return timeInfo
\ No newline at end of file
+    # Return start and end times
+    if returnIds:
+        return ids,timeInfo
+    return timeInfo
+
+# Read just the wanted byte ranges [[offset,nBytes],...] of a MSEED file, and decode them
+def readMseedBlocks(aFile,byteRanges):
+    if len(byteRanges)==0:
+        return EmptyStream()
+    # Merge any touching ranges so the file is read with fewer seeks
+    byteRanges=sorted(byteRanges)
+    merged=[list(byteRanges[0])]
+    for offset,nBytes in byteRanges[1:]:
+        if offset<=merged[-1][0]+merged[-1][1]:
+            merged[-1][1]=max(merged[-1][1],offset+nBytes-merged[-1][0])
+        else:
+            merged.append([offset,nBytes])
+    # Gather all of the bytes, and decode in one go
+    buff=io.BytesIO()
+    with open(aFile,'rb') as aFileObj:
+        for offset,nBytes in merged:
+            aFileObj.seek(offset)
+            buff.write(aFileObj.read(nBytes))
+    buff.seek(0)
+    return read(buff,format='MSEED')
+
+# Keep only the record blocks [[nslc,offset,nBytes],...] matching the wanted stations and channels
+def selectBlocks(blocks,wantedStaChas):
+    byteRanges=[]
+    for nslc,offset,nBytes in blocks:
+        net,sta,loc,cha=nslc.split('.')
+        for aSta,aCha in wantedStaChas:
+            if fnmatch(sta,aSta) and fnmatch(cha,aCha):
+                byteRanges.append([offset,nBytes])
+                break
+    return byteRanges
+
+# Maximum number of consecutive records of one channel grouped into a block within the index...
+# ...limits the index size, while still only over-reading a few records at either end of a window
+MAX_BLOCK_RECORDS=16
+
+# Get the sampling rate from the MSEED sample rate factors and multipliers (arrays)
+def getRecordRates(factor,mult):
+    factor,mult=factor.astype(float),mult.astype(float)
+    rates=np.zeros(len(factor))
+    for fSign,mSign,func in [[1,1,lambda f,m:f*m],[1,-1,lambda f,m:-f/m],
+                             [-1,1,lambda f,m:-m/f],[-1,-1,lambda f,m:1.0/(f*m)]]:
+        args=np.where((np.sign(factor)==fSign)&(np.sign(mult)==mSign))[0]
+        rates[args]=func(factor[args],mult[args])
+    return rates
+
+# Convert the BTIME fields to timestamps (arrays)
+def getRecordTimes(year,day,hour,minute,sec,frac):
+    yearDays=(year-1970).astype('datetime64[Y]').astype('datetime64[D]').astype(np.int64)
+    return ((yearDays+day-1)*86400.0+hour*3600.0+minute*60.0+sec)+frac*0.0001
+
+# Read an unsigned (or signed) integer from columns of bytes, for all rows
+def bytesToInt(cols,bigEndian,signed=False):
+    if not bigEndian:
+        cols=cols[:,::-1]
+    val=np.zeros(len(cols),dtype=np.int64)
+    for i in range(cols.shape[1]):
+        val=(val<<8)|cols[:,i]
+    if signed:
+        val[val>=2**(8*cols.shape[1]-1)]-=2**(8*cols.shape[1])
+    return val
+
+# Get the header values from each of the records...
+# ...returns [offsets,reclens,ids,startTimes,endTimes], only for data records
+def getMseedRecords(aFile):
+    buff=np.fromfile(aFile,dtype=np.uint8)
+    # Skip any leading SEED control headers
+    offset=0
+    while offset+48<=len(buff) and buff[offset+6] in SEED_CONTROL_HEADERS:
+        try:
+            offset+=2**int(buff[offset+19:offset+21].tobytes().decode())
+        except ValueError:
+            offset+=4096
+    if offset+48>len(buff):
+        raise Exception('No data records in '+aFile)
+    # Byte order is taken from the first record, by checking for a sensible year
+    bigEndian=1900<=bytesToInt(buff[offset+20:offset+22].reshape(1,2),True)[0]<=2100
+    order='>' if bigEndian else '<'
+    # Get the record length from the first records blockette 1000
+    reclen=getRecordLength(buff,offset,order)
+    # If all records appear to be of the same length, read all headers at once...
+    if (len(buff)-offset)%reclen==0:
+        recs=buff[offset:].reshape(-1,reclen)
+        offsets=offset+np.arange(len(recs),dtype=np.int64)*reclen
+        # ...ensuring that every data record does have this record length
+        firstBlk=bytesToInt(recs[:,46:48],bigEndian)
+        isData=np.isin(recs[:,6],[ord(c) for c in 'DRQM'])
+        blkArgs=np.where(isData)[0]
+        blkPos=firstBlk[blkArgs]
+        if np.all((blkPos>=48)&(blkPos+7<=reclen)):
+            blkType=bytesToInt(np.vstack((recs[blkArgs,blkPos],recs[blkArgs,blkPos+1])).T,bigEndian)
+            blkLen=recs[blkArgs,blkPos+6].astype(np.int64)
+            if np.all((blkType==1000)&(2**blkLen==reclen)):
+                recs,offsets=recs[blkArgs],offsets[blkArgs]
+                return parseRecordHeaders(recs[:,:48],offsets,np.ones(len(recs),dtype=np.int64)*reclen,bigEndian)
+    # ...otherwise walk through the records one at a time
+    offsets,reclens=[],[]
+    while offset+48<=len(buff):
+        reclen=getRecordLength(buff,offset,order)
+        if chr(buff[offset+6]) in 'DRQM':
+            offsets.append(offset)
+            reclens.append(reclen)
+        offset+=reclen
+    offsets=np.array(offsets,dtype=np.int64)
+    headers=buff[offsets[:,None]+np.arange(48)]
+    return parseRecordHeaders(headers,offsets,np.array(reclens,dtype=np.int64),bigEndian)
+
+# Follow the blockettes of a record to get its record length from blockette 1000
+def getRecordLength(buff,offset,order):
+    blkOffset=struct.unpack(order+'H',buff[offset+46:offset+48].tobytes())[0]
+    while blkOffset!=0:
+        blkType,nextOffset=struct.unpack(order+'HH',buff[offset+blkOffset:offset+blkOffset+4].tobytes())
+        if blkType==1000:
+            return 2**int(buff[offset+blkOffset+6])
+        blkOffset=nextOffset
+    raise Exception('MSEED record at byte '+str(offset)+' has no blockette 1000')
+
+# Convert the fixed section of the data headers (rows of 48 bytes) into the record values
+def parseRecordHeaders(headers,offsets,reclens,bigEndian):
+    # NSLC codes, only decode the unique ones
+    rawIds,idIdxs=np.unique(headers[:,8:20].copy().view('S12').ravel(),return_inverse=True)
+    unqIds=[]
+    for rawId in rawIds:
+        rawId=rawId.ljust(12).decode()
+        unqIds.append('.'.join([rawId[10:12].strip(),rawId[0:5].strip(),rawId[5:7].strip(),rawId[7:10].strip()]))
+    ids=np.array(unqIds,dtype=str)[idIdxs.ravel()]
+    # Start times, including the time correction if it was not already applied
+    startTimes=getRecordTimes(bytesToInt(headers[:,20:22],bigEndian),bytesToInt(headers[:,22:24],bigEndian),
+                              headers[:,24].astype(np.int64),headers[:,25].astype(np.int64),
+                              headers[:,26].astype(np.int64),bytesToInt(headers[:,28:30],bigEndian))
+    corrArgs=np.where((headers[:,36]&2)==0)[0]
+    startTimes[corrArgs]+=bytesToInt(headers[corrArgs,40:44],bigEndian,signed=True)*0.0001
+    # End times, one sample after the last (records without samples span no time)
+    nSamps=bytesToInt(headers[:,30:32],bigEndian)
+    rates=getRecordRates(bytesToInt(headers[:,32:34],bigEndian,signed=True),
+                         bytesToInt(headers[:,34:36],bigEndian,signed=True))
+    durations=np.zeros(len(rates))
+    rateArgs=np.where(rates>0)[0]
+    durations[rateArgs]=nSamps[rateArgs]/rates[rateArgs]
+    return offsets,reclens,ids,startTimes,startTimes+durations
+
+# Group consecutive records of the same channel into blocks...
+# ...returns [[nslc,offset,nBytes,startTime,endTime],...]
+def getMseedRecordBlocks(aFile,maxRecords=MAX_BLOCK_RECORDS):
+    offsets,reclens,ids,startTimes,endTimes=getMseedRecords(aFile)
+    if len(offsets)==0:
+        return []
+    # Start a new block when the channel changes, records are not adjacent, or the block is full
+    newBlock=np.ones(len(offsets),dtype=bool)
+    newBlock[1:]=(ids[1:]!=ids[:-1])|(offsets[1:]!=offsets[:-1]+reclens[:-1])
+    runStarts=np.where(newBlock)[0]
+    runPos=np.arange(len(offsets))-runStarts[np.cumsum(newBlock)-1]
+    newBlock|=(runPos%maxRecords)==0
+    blockStarts=np.where(newBlock)[0]
+    blockEnds=np.append(blockStarts[1:],len(offsets))-1
+    nBytes=offsets[blockEnds]+reclens[blockEnds]-offsets[blockStarts]
+    blockT1=np.minimum.reduceat(startTimes,blockStarts)
+    blockT2=np.maximum.reduceat(endTimes,blockStarts)
+    return [[ids[i],int(offsets[i]),int(n),float(aT1),float(aT2)] for i,n,aT1,aT2 in
+            zip(blockStarts,nBytes,blockT1,blockT2)]
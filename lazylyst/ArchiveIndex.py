@@ -0,0 +1,130 @@
+# Author: Andrew.M.G.Reynen
+from __future__ import print_function
+import os
+import sqlite3
+
+import numpy as np
+
+# Bump when the table layout changes, older indexes are then rebuilt from scratch
+INDEX_VERSION=2
+
+# Location of the archive index, kept within the archive directory itself
+def getIndexPath(archDir):
+    return os.path.join(archDir,'lazylystArchive.sqlite')
+
+# Persistent index of the archive files metadata, and the traces they contain...
+# ...files are keyed by path and hold [mtime,ctime,size,startTime,endTime]
+# ...traces hold the NSLC and [startTime,endTime] of each trace within a file
+# ...blocks hold the NSLC, byte [offset,nBytes] and [startTime,endTime] of consecutive records within a file
+class ArchiveIndex(object):
+    def __init__(self,archDir):
+        self.archDir=archDir
+        self.conn=sqlite3.connect(getIndexPath(archDir))
+        # Allow the GUI to read the index while a threaded reload is writing to it
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.initTables()
+
+    # Create the tables if not present, rebuild them if from an older version
+    def initTables(self):
+        cur=self.conn.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, val TEXT)')
+        row=cur.execute("SELECT val FROM meta WHERE key='version'").fetchone()
+        if row is None or int(row[0])!=INDEX_VERSION:
+            cur.execute('DROP TABLE IF EXISTS files')
+            cur.execute('DROP TABLE IF EXISTS traces')
+            cur.execute('DROP TABLE IF EXISTS blocks')
+            cur.execute("INSERT OR REPLACE INTO meta (key,val) VALUES ('version',?)",(str(INDEX_VERSION),))
+        cur.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, ctime REAL, '+
+                    'size INTEGER, startTime REAL, endTime REAL, hasBlocks INTEGER)')
+        cur.execute('CREATE TABLE IF NOT EXISTS traces (path TEXT, nslc TEXT, startTime REAL, endTime REAL)')
+        cur.execute('CREATE INDEX IF NOT EXISTS tracesPath ON traces (path)')
+        cur.execute('CREATE TABLE IF NOT EXISTS blocks (path TEXT, nslc TEXT, offset INTEGER, nBytes INTEGER, '+
+                    'startTime REAL, endTime REAL)')
+        cur.execute('CREATE INDEX IF NOT EXISTS blocksPathTime ON blocks (path,startTime)')
+        self.conn.commit()
+
+    # Compare the current file metadata [[path,mtime,ctime,size],...] against the index...
+    # ...removing files which no longer exist, and returning the metadata of those which need (re)scanning
+    def getChangedFiles(self,curMeta):
+        prevMeta={row[0]:row[1:] for row in self.conn.execute('SELECT path,mtime,ctime,size FROM files')}
+        loadMeta=[entry for entry in curMeta if prevMeta.get(entry[0])!=tuple(entry[1:])]
+        # Remove any files which have been deleted from the archive
+        curPaths=set(entry[0] for entry in curMeta)
+        remPaths=[(path,) for path in prevMeta.keys() if path not in curPaths]
+        if len(remPaths)!=0:
+            self.removeFiles(remPaths)
+        return loadMeta
+
+    # Remove a set of files from the index, given as [(path,),...]
+    def removeFiles(self,remPaths):
+        with self.conn:
+            self.conn.executemany('DELETE FROM files WHERE path=?',remPaths)
+            self.conn.executemany('DELETE FROM traces WHERE path=?',remPaths)
+            self.conn.executemany('DELETE FROM blocks WHERE path=?',remPaths)
+
+    # Add or replace files within the index...
+    # ...fileMeta are [path,mtime,ctime,size], fileInfos are [traces,blocks] for each file where...
+    # ...traces are [[nslc,startTime,endTime],...] and blocks are [[nslc,offset,nBytes,startTime,endTime],...]
+    # ...files which could not be read have no traces, and are kept so they are not rescanned until changed
+    def updateFiles(self,fileMeta,fileInfos):
+        if len(fileMeta)==0:
+            return
+        fileRows,traceRows,blockRows=[],[],[]
+        for (path,mtime,ctime,size),(traces,blocks) in zip(fileMeta,fileInfos):
+            if len(traces)==0:
+                startTime,endTime=None,None
+            else:
+                startTime=min([float(entry[1]) for entry in traces])
+                endTime=max([float(entry[2]) for entry in traces])
+            fileRows.append((path,mtime,ctime,size,startTime,endTime,int(len(blocks)!=0)))
+            traceRows+=[(path,str(nslc),float(t1),float(t2)) for nslc,t1,t2 in traces]
+            blockRows+=[(path,str(nslc),int(offset),int(nBytes),float(t1),float(t2)) for nslc,offset,nBytes,t1,t2 in blocks]
+        with self.conn:
+            self.conn.executemany('DELETE FROM traces WHERE path=?',[(row[0],) for row in fileRows])
+            self.conn.executemany('DELETE FROM blocks WHERE path=?',[(row[0],) for row in fileRows])
+            self.conn.executemany('INSERT OR REPLACE INTO files (path,mtime,ctime,size,startTime,endTime,hasBlocks) '+
+                                  'VALUES (?,?,?,?,?,?,?)',fileRows)
+            self.conn.executemany('INSERT INTO traces (path,nslc,startTime,endTime) VALUES (?,?,?,?)',traceRows)
+            self.conn.executemany('INSERT INTO blocks (path,nslc,offset,nBytes,startTime,endTime) '+
+                                  'VALUES (?,?,?,?,?,?)',blockRows)
+
+    # Return the file names and their [startTime,endTime], sorted by start time
+    def getFileTimes(self):
+        rows=self.conn.execute('SELECT path,startTime,endTime FROM files '+
+                               'WHERE startTime IS NOT NULL ORDER BY startTime').fetchall()
+        if len(rows)==0:
+            return np.array([]),np.zeros((0,2))
+        fileNames=np.array([row[0] for row in rows],dtype=str)
+        fileTimes=np.array([row[1:] for row in rows],dtype=float)
+        return fileNames,fileTimes
+
+    # Return the [nslc,startTime,endTime] of all traces within a given file
+    def getFileTraces(self,path):
+        return [list(row) for row in self.conn.execute('SELECT nslc,startTime,endTime FROM traces '+
+                                                       'WHERE path=?',(path,))]
+
+    # Return the (mtime,ctime,size) of each of the given files which are in the index
+    def getFileMeta(self,paths):
+        fileMeta={}
+        for path in paths:
+            row=self.conn.execute('SELECT mtime,ctime,size FROM files WHERE path=?',(path,)).fetchone()
+            if row is not None:
+                fileMeta[path]=tuple(row)
+        return fileMeta
+
+    # Return the record blocks [[nslc,offset,nBytes],...] overlapping the given times, for each of the given files...
+    # ...files which do not have their records indexed are not included
+    def getFileBlocks(self,paths,t1,t2):
+        fileBlocks={}
+        for path in paths:
+            row=self.conn.execute('SELECT hasBlocks FROM files WHERE path=?',(path,)).fetchone()
+            if row is None or not row[0]:
+                continue
+            fileBlocks[path]=[list(row) for row in self.conn.execute('SELECT nslc,offset,nBytes FROM blocks '+
+                                                                     'WHERE path=? AND startTime<=? AND endTime>=?',
+                                                                     (path,t2,t1))]
+        return fileBlocks
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,255 @@
+# Author: Andrew.M.G.Reynen
+from __future__ import print_function
+import os
+import sys
+import pickle
+import argparse
+import multiprocessing
+from copy import deepcopy
+from fnmatch import fnmatch
+from future.utils import iteritems
+sys.path.insert(0,os.path.abspath(os.path.join(os.path.dirname( __file__ ), os.pardir)))
+
+import numpy as np
+from PyQt5.QtCore import QSettings
+from obspy import UTCDateTime
+
+from LazylystCore import LazylystCore
+from CustomFunctions import getTimeFromFileName,getStaStr
+from HotVariables import initHotVar
+from Preferences import defaultPreferences
+from Actions import defaultActions,defaultPassiveOrder
+from ActionStats import ActionStats
+from ActionCache import ActionCache
+from Archive import getArchiveAvail,extractDataFromArchive
+from StationMeta import staXml2Loc,readStaMeta,setProjFunc
+from SaveSource import defaultSource
+
+# Stand in for the main window, holding the hot variables, preferences and actions without any widgets...
+# ...settings are read from the same files as the GUI (setAct.ini, setPref.ini and setSource.ini)
+class BatchMain(LazylystCore):
+    def __init__(self,sourceTag,settingsDir=None):
+        mainPath=os.path.dirname(os.path.realpath(__file__))
+        if settingsDir is None:
+            settingsDir=mainPath
+        # Load the hot variables
+        self.hotVar=initHotVar()
+        self.hotVar['mainPath'].val=mainPath
+        for key,hotVar in iteritems(self.hotVar):
+            hotVar.linkToFunction(self,withUpdate=False)
+        # Create empty variables
+        self.staWidgets=[]
+        self.qThreads={}
+        self.qTimers={}
+        self.actStats=ActionStats()
+        self.actPool=None
+        self.actCache=ActionCache()
+        self.copyInputTags=set()
+        self.pythonPathInsertions=[]
+        self.pythonPathOriginal=deepcopy(sys.path)
+        self.setAct=QSettings(settingsDir+'/setAct.ini', QSettings.IniFormat)
+        self.setPref=QSettings(settingsDir+'/setPref.ini', QSettings.IniFormat)
+        self.setSource=QSettings(settingsDir+'/setSource.ini', QSettings.IniFormat)
+        # Preferences
+        self.pref=defaultPreferences(self)
+        prefVals=self.setPref.value('prefVals',{})
+        for aKey in prefVals.keys():
+            # Skip if this preference was removed in a newer version
+            if aKey not in self.pref.keys():
+                continue
+            # Add default base color preferences not previously seen
+            if aKey=='basePen':
+                prefVals[aKey].update({oKey:self.pref[aKey].val[oKey] for oKey in self.pref[aKey].val.keys() if oKey not in prefVals[aKey].keys()})
+            self.pref[aKey].val=prefVals[aKey]
+        self.updatePythonPath()
+        self.actCache.setMaxSize(self.pref['actionCacheSize'].val)
+        # Actions...
+        self.act=self.setAct.value('actions', defaultActions())
+        # ...reload locked actions from the defaults (may have been edited in a new version)
+        for key,action in iteritems(defaultActions()):
+            if action.locked:
+                self.act[action.tag]=action
+        # ...get the passive action ordering
+        self.actPassiveOrder=self.setAct.value('actPassiveOrder', defaultPassiveOrder(self.act))
+        if self.actPassiveOrder==None:
+            self.actPassiveOrder=[]
+        self.actPassiveOrder=[actTag for actTag in self.actPassiveOrder if actTag in self.act.keys()]
+        # ...link all actions to their appropriate functions and assign any missing attributes...
+        # ...actions of the main window which require widgets are left unlinked
+        for key,action in iteritems(self.act):
+            if action.path!='$main' or hasattr(self,action.name):
+                action.linkToFunction(self)
+            action.fillMissingAttrib()
+        # Saved sources
+        self.saveSource=self.setSource.value('savedSources',defaultSource())
+        self.loadSource(sourceTag)
+
+    # Preferences which only change widgets (or the pools, which are not used here) have nothing to update
+    def passUpdate(self,init=False):
+        pass
+    updateStaPerPage=updateCursor=updateStreamCache=updateActPool=updateProcPool=passUpdate
+    updateBaseColors=updateCustomPen=updatePagePicks=passUpdate
+
+    def updateEveSort(self,init=False):
+        self.sortPickFiles()
+
+    def updateMapProj(self,init=False):
+        setProjFunc(self.pref['mapProj'].val,self.hotVar['staLoc'].val,init=init)
+
+    def refreshPickDirLists(self):
+        self.hotVar['pickFiles'].val=self.getPickFiles()
+        self.updateEveSort()
+
+    def stopTimedAction(self,action):
+        pass
+
+    # Actions set to run in a process are run here, the events are already spread over processes
+    def getProcPool(self):
+        return None
+
+    # Set the hot variables relating to the saved source, its stations, archive and pick files
+    def loadSource(self,sourceTag):
+        if sourceTag not in self.saveSource.keys():
+            raise Exception('The sourceTag '+sourceTag+' is not currently a saved source')
+        source=self.saveSource[sourceTag]
+        if not source.pathExist():
+            raise Exception('Paths of the source '+sourceTag+' do not exist')
+        self.hotVar['sourceTag'].val=sourceTag
+        for key,val in [['archDir',source.archDir],
+                        ['pickDir',source.pickDir],
+                        ['staFile',source.staFile],
+                        ['sourceDict',source.sourceDict]]:
+            self.hotVar[key].val=val
+        # Station metadata, and the projection which relates to it
+        if self.hotVar['staFile'].val.replace(' ','')!='':
+            self.hotVar['staXml'].val,self.hotVar['staLoc'].val=readStaMeta(self.hotVar['staFile'].val)
+        else:
+            self.hotVar['staLoc'].val=staXml2Loc(self.hotVar['staXml'].val)
+        self.updateMapProj(init=True)
+        # Archive files, sorted by start time
+        archiveFiles,archiveTimes=getArchiveAvail(self.hotVar['archDir'].val,showBar=False)
+        argSort=np.argsort(archiveTimes[:,0])
+        self.hotVar['archFiles'].val=archiveFiles[argSort]
+        self.hotVar['archFileTimes'].val=archiveTimes[argSort]
+        # Pick files, in the order of eveSortStyle
+        self.refreshPickDirLists()
+
+    # Load a pick file's picks and data, as would be done when selecting it in the GUI
+    def loadEvent(self,pickFile):
+        defaultHot=initHotVar()
+        for key in ['pickSet','curPage','curTraceSta','curTracePos','curMapSta','curMapPos']:
+            self.hotVar[key].val=defaultHot[key].val
+        self.hotVar['curPickFile'].val=pickFile
+        self.loadPickSet()
+        aTime=getTimeFromFileName(pickFile).timestamp
+        t1,t2=aTime+self.pref['evePreTime'].val,aTime+self.pref['evePostTime'].val
+        self.hotVar['stream'].val=extractDataFromArchive(t1,t2,self.hotVar['archFiles'].val,
+                                                         self.hotVar['archFileTimes'].val,
+                                                         archDir=self.hotVar['archDir'].val)
+        self.hotVar['pltSt'].val=self.hotVar['stream'].val.copy()
+        self.hotVar['pltSt'].val.sort(keys=['channel'])
+        self.hotVar['staSort'].val=np.sort(np.unique([getStaStr(tr) for tr in self.hotVar['stream'].val]))
+        self.hotVar['timeRange'].val=[t1,t2]
+
+    # Run an active action, and its passive queue, on one pick file and save the resulting picks...
+    # ...returns the values of the wanted hot variables afterwards
+    def runEvent(self,action,pickFile,outputs=[]):
+        self.loadEvent(pickFile)
+        self.runActQueue(self.collectActQueue(action),action.tag)
+        outputVals={key:self.hotVar[key].val for key in outputs}
+        # Actions may have moved curPickFile on, the picks still belong to the loaded pick file
+        self.hotVar['curPickFile'].val=pickFile
+        self.savePickSet()
+        return outputVals
+
+    # Get the pick files matching a file name pattern, and within a time range
+    def getBatchPickFiles(self,pattern='*',t1=None,t2=None):
+        pickFiles,pickTimes=self.hotVar['pickFiles'].val,self.hotVar['pickFileTimes'].val
+        keep=np.array([fnmatch(aFile,pattern) for aFile in pickFiles],dtype=bool)
+        if t1 is not None:
+            keep&=pickTimes>=t1
+        if t2 is not None:
+            keep&=pickTimes<=t2
+        return [str(aFile) for aFile in pickFiles[keep]]
+
+    # Get an active action by its tag, ensuring it can be run without widgets
+    def getBatchAction(self,actionTag):
+        if actionTag not in self.act.keys():
+            raise Exception('Action '+actionTag+' does not exist')
+        action=self.act[actionTag]
+        if action.passive:
+            raise Exception('Action '+actionTag+' is passive, the batch runner requires an active action')
+        if action.func is None:
+            raise Exception('Action '+actionTag+' is not available without the GUI')
+        return action
+
+# The batch runner held by each process of the pool
+BATCH_WORKER=None
+
+def initBatchWorker(sourceTag,settingsDir,actionTag,outputs):
+    global BATCH_WORKER
+    main=BatchMain(sourceTag,settingsDir=settingsDir)
+    BATCH_WORKER=[main,main.getBatchAction(actionTag),outputs]
+
+def runBatchWorker(pickFile):
+    main,action,outputs=BATCH_WORKER
+    return pickFile,main.runEvent(action,pickFile,outputs)
+
+# Apply an active action (and its passive queue) to all pick files of a saved source, which match the...
+# ...file name pattern and time range, optionally spread over a number of processes...
+# ...returns {pickFile:{hotVarTag:value}} for the wanted output hot variables
+def runBatch(actionTag,sourceTag,pattern='*',t1=None,t2=None,outputs=[],nProcs=1,settingsDir=None):
+    main=BatchMain(sourceTag,settingsDir=settingsDir)
+    action=main.getBatchAction(actionTag)
+    for key in outputs:
+        if key not in main.hotVar.keys():
+            raise Exception('Output '+key+' is not a hot variable')
+    pickFiles=main.getBatchPickFiles(pattern,t1,t2)
+    print('Running '+actionTag+' on '+str(len(pickFiles))+' pick files')
+    results={}
+    if nProcs<=1 or len(pickFiles)<=1:
+        for i,pickFile in enumerate(pickFiles):
+            results[pickFile]=main.runEvent(action,pickFile,outputs)
+            print(str(i+1)+'/'+str(len(pickFiles))+' '+pickFile)
+    else:
+        # Spawn (rather than fork) so each process loads the plugins fresh
+        if hasattr(multiprocessing,'get_context'):
+            context=multiprocessing.get_context('spawn')
+        else:
+            context=multiprocessing
+        pool=context.Pool(nProcs,initializer=initBatchWorker,
+                          initargs=(sourceTag,settingsDir,actionTag,outputs))
+        try:
+            for i,(pickFile,result) in enumerate(pool.imap_unordered(runBatchWorker,pickFiles)):
+                results[pickFile]=result
+                print(str(i+1)+'/'+str(len(pickFiles))+' '+pickFile)
+        finally:
+            pool.terminate()
+            pool.join()
+    return results
+
+# Command line entry point to the batch runner
+def runLazylystBatch(args=None):
+    parser=argparse.ArgumentParser(description='Apply an active action, and its passive actions, '+
+                                               'to the pick files of a saved source (without the GUI)')
+    parser.add_argument('action',help='Tag of the active action to run')
+    parser.add_argument('source',help='Tag of the saved source')
+    parser.add_argument('--files',default='*',help='Pattern of the pick file names to run on')
+    parser.add_argument('--t1',default=None,help='Only run on pick files at or after this time')
+    parser.add_argument('--t2',default=None,help='Only run on pick files at or before this time')
+    parser.add_argument('--outputs',default='',help='Comma separated hot variables to save after each pick file')
+    parser.add_argument('--outFile',default=None,help='Pickle file where the outputs are saved')
+    parser.add_argument('--procs',default=1,type=int,help='Number of processes to spread the pick files over')
+    parser.add_argument('--settingsDir',default=None,help='Directory containing the saved settings (.ini files)')
+    args=parser.parse_args(args)
+    t1,t2=[None if aTime is None else UTCDateTime(aTime).timestamp for aTime in [args.t1,args.t2]]
+    outputs=[key for key in args.outputs.split(',') if key!='']
+    results=runBatch(args.action,args.source,pattern=args.files,t1=t1,t2=t2,outputs=outputs,
+                     nProcs=args.procs,settingsDir=args.settingsDir)
+    if args.outFile is not None:
+        with open(args.outFile,'wb') as aFile:
+            pickle.dump(results,aFile)
+        print('Outputs saved to '+args.outFile)
+
+if __name__ == '__main__':
+    runLazylystBatch()
@@ -50,6 +50,29 @@ def getTimeFromFileName(fileName):
     timeStr=fileName.split('_')[1].replace('.'+fileName.split('.')[-1],'')
     return UTCDateTime().strptime(timeStr,'%Y%m%d.%H%M%S.%f')
 
+# Get the file names of new pick files at the given timestamps, with IDs not used by the current pick files...
+# ...idGenStyle "fill" uses the lowest unused IDs, "next" continues on from the largest ID
+def getNewPickFileNames(pickFiles,pickFileTimes,idGenStyle='fill'):
+    if idGenStyle not in ['fill','next']:
+        print('The eveIDGenStyle '+idGenStyle+' has not been implemented')
+        return []
+    seenIDs=set([int(aFile.split('_')[0]) for aFile in pickFiles])
+    newID=0
+    if idGenStyle=='next' and len(seenIDs)>0:
+        newID=max(seenIDs)+1
+    # Use the previous file ID length, default at 10 if no files present
+    zFillLen=10
+    if len(pickFiles)>0:
+        zFillLen=len(pickFiles[0].split('_')[0])
+    newPickFiles=[]
+    for aTime in pickFileTimes:
+        while newID in seenIDs:
+            newID+=1
+        seenIDs.add(newID)
+        aTimeStr=UTCDateTime(aTime).strftime('%Y%m%d.%H%M%S.%f')
+        newPickFiles.append(str(newID).zfill(zFillLen)+'_'+aTimeStr+'.picks')
+    return newPickFiles
+
 
 # Get the string representing the given station via the trace object
 def getStaStr(tr):
@@ -0,0 +1,215 @@
+# Author: Andrew.M.G.Reynen
+from __future__ import print_function, division
+import time
+import bisect
+from collections import deque
+
+import numpy as np
+from obspy import Stream, UTCDateTime
+
+from Archive import extractDataFromArchive
+from ActionProcess import shareObject,getSharedObject,releaseShared
+from CustomFunctions import getStaStr
+from Plugins.CrossCorrelation import calcXCorStack,taperData
+
+# Highest resolution clock available
+perfTime=getattr(time,'perf_counter',time.time)
+
+# Time chunks are scanned within this process for at least this long (s), before the rest may be sent to the process pool...
+# ...and are only sent if they would take longer than POOL_MIN_TIME (s) to scan here, going by the time taken so far
+POOL_AFTER_TIME=0.5
+POOL_MIN_TIME=5.0
+
+# Extra data (s) read on either side of a time chunk, so the taper and filter do not affect the correlated data
+CHUNK_PAD=10.0
+
+# Cut the templates from the picked waveforms of an event, one for each picked channel...
+# ...the first pick of phaseType on each station is used, on channels ending with component ("*" for all)...
+# ...templates are [[traceID,template trace,lag],...] where lag is the template start time less eveTime
+def getDetectTemplates(stream,pickSet,eveTime,templatePre=-0.5,templatePost=2.5,phaseType='P',
+                       component='Z',freqMin=2.0,freqMax=10.0):
+    templates=[]
+    if len(pickSet)==0 or len(stream)==0:
+        return templates
+    phaseArgs=np.where(pickSet[:,1]==phaseType)[0]
+    phaseArgs=phaseArgs[np.argsort(pickSet[phaseArgs,2].astype(float))]
+    pickedStas=[]
+    for arg in phaseArgs:
+        if pickSet[arg,0] in pickedStas:
+            continue
+        pickedStas.append(pickSet[arg,0])
+        pickTime=float(pickSet[arg,2])
+        for tr in stream:
+            if getStaStr(tr)!=pickSet[arg,0] or (component!='*' and tr.stats.channel[-1]!=component):
+                continue
+            tr=prepTrace(tr.copy(),freqMin,freqMax)
+            tempTr=tr.slice(UTCDateTime(pickTime+templatePre),UTCDateTime(pickTime+templatePost))
+            # Skip if less than half of the wanted template was present
+            if tempTr.stats.npts*tempTr.stats.delta<0.5*(templatePost-templatePre):
+                continue
+            tempTr.data=taperData(np.array(tempTr.data,dtype=float),tempTr.stats.sampling_rate)
+            templates.append([tr.id,tempTr,tempTr.stats.starttime.timestamp-eveTime])
+    return templates
+
+# Detrend, taper and bandpass a trace in place (no bandpass if freqMax is not above freqMin)
+def prepTrace(tr,freqMin,freqMax):
+    tr.data=np.array(tr.data,dtype=float)
+    tr.detrend('linear')
+    taperData(tr.data,tr.stats.sampling_rate)
+    if freqMin>0 and freqMax>freqMin and freqMax<0.5*tr.stats.sampling_rate:
+        tr.filter('bandpass',freqmin=freqMin,freqmax=freqMax)
+    return tr
+
+# Stack the normalized cross-correlation of each template against its channel, at event times t1+i*delta for i<nTimes...
+# ...returns the mean correlation of the channels, and the number of channels used at each time
+def getStackedXCor(templates,stream,t1,delta,nTimes):
+    gridTimes=t1+delta*np.arange(nTimes)
+    sumXCor,count=np.zeros(nTimes),np.zeros(nTimes,dtype=int)
+    for traceID,tempTr,lag in templates:
+        chanXCor=np.full(nTimes,np.nan)
+        for tr in stream.select(id=traceID):
+            if tr.stats.sampling_rate!=tempTr.stats.sampling_rate:
+                tempTr=tempTr.copy().resample(tr.stats.sampling_rate)
+            xCorArr=calcXCorStack(tempTr.data,np.asarray(tr.data,dtype=float).reshape((1,-1)))[0]
+            if len(xCorArr)<2:
+                continue
+            # Times of the event for each correlation value of this trace
+            eveTimes=tr.stats.starttime.timestamp-lag+tr.stats.delta*np.arange(len(xCorArr))
+            chanXCor=np.fmax(chanXCor,np.interp(gridTimes,eveTimes,xCorArr,left=np.nan,right=np.nan))
+        valid=~np.isnan(chanXCor)
+        sumXCor[valid]+=chanXCor[valid]
+        count[valid]+=1
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return sumXCor/count,count
+
+# Times where the stacked correlation is above the median plus madMult median absolute deviations...
+# ...only the largest value within minSep (s) is kept, returns [[time,stackedXCor,nChans,madRatio],...]
+def getStackDetections(stack,count,gridTimes,madMult,minChans,minSep):
+    valid=count>=max(1,minChans)
+    if np.sum(valid)==0:
+        return np.empty((0,4))
+    median=np.median(stack[valid])
+    mad=np.median(np.abs(stack[valid]-median))
+    if mad==0:
+        return np.empty((0,4))
+    above=np.where(valid)[0]
+    above=above[stack[above]>median+madMult*mad]
+    rows=[[gridTimes[i],stack[i],count[i],(stack[i]-median)/mad] for i in above]
+    return declusterDetections(np.array(rows,dtype=float).reshape((-1,4)),minSep)
+
+# Keep only the detection with the largest stacked correlation within minSep (s) of each other
+def declusterDetections(detections,minSep):
+    keep,keepTimes=[],[] # Kept detections, and their times in increasing order
+    for i in np.argsort(-detections[:,1]):
+        aTime=detections[i,0]
+        pos=bisect.bisect_left(keepTimes,aTime)
+        if pos>0 and aTime-keepTimes[pos-1]<minSep:
+            continue
+        if pos<len(keepTimes) and keepTimes[pos]-aTime<minSep:
+            continue
+        keepTimes.insert(pos,aTime)
+        keep.append(i)
+    return detections[sorted(keep,key=lambda i:detections[i,0])]
+
+# Times of the data read to scan the time chunk [t1,t2) with the templates
+def getChunkReadTimes(t1,t2,templates):
+    lags=[lag for traceID,tempTr,lag in templates]
+    tempLen=max([tempTr.stats.endtime-tempTr.stats.starttime for traceID,tempTr,lag in templates])
+    return t1+min(lags)-CHUNK_PAD,t2+max(lags)+tempLen+CHUNK_PAD
+
+# Scan one time chunk [t1,t2) for detections, params are the scan parameters (see scanArchive)...
+# ...archFiles and archFileTimes need only be the archive files overlapping the chunks read times (see getChunkReadTimes)
+def scanChunk(t1,t2,params,archFiles,archFileTimes):
+    templates=params['templates']
+    staChas=[]
+    for traceID,tempTr,lag in templates:
+        if [tempTr.stats.station,tempTr.stats.channel] not in staChas:
+            staChas.append([tempTr.stats.station,tempTr.stats.channel])
+    readT1,readT2=getChunkReadTimes(t1,t2,templates)
+    stream=extractDataFromArchive(readT1,readT2,archFiles,archFileTimes,
+                                  wantedStaChas=staChas,archDir=params['archDir'])
+    stream=Stream([prepTrace(tr,params['freqMin'],params['freqMax']) for tr in stream if tr.stats.npts>1])
+    delta=params['delta']
+    nTimes=int(np.ceil((t2-t1)/delta))
+    stack,count=getStackedXCor(templates,stream,t1,delta,nTimes)
+    return getStackDetections(stack,count,t1+delta*np.arange(nTimes),params['madMult'],
+                              params['minChans'],params['minSep'])
+
+# Scan a time chunk within a worker process, with the scan parameters put into shared memory (see shareObject)
+def runSharedScanChunk(t1,t2,paramsName,archFiles,archFileTimes):
+    return scanChunk(t1,t2,getSharedObject(paramsName),archFiles,archFileTimes)
+
+# Scan time chunks [[t1,t2,archFiles,archFileTimes],...] over the action process pool...
+# ...returns the detections of each chunk (None if cancelled)...
+# ...the scan parameters are shared with the workers once, each task is given only the archive files of its chunk...
+# ...only a few chunks are given to the pool at a time, so a cancelled scan does not hold up the pool for long
+def scanInPool(chunks,params,procPool,cancelToken=None):
+    chunks=deque(chunks)
+    running,detections=deque(),[]
+    paramsShm=shareObject(params)
+    try:
+        while len(chunks)>0 or len(running)>0:
+            while len(chunks)>0 and len(running)<2*procPool.nProcs:
+                chunk=chunks.popleft()
+                if paramsShm is None:
+                    running.append(procPool.applyAsync(scanChunk,(chunk[0],chunk[1],params,chunk[2],chunk[3])))
+                else:
+                    running.append(procPool.applyAsync(runSharedScanChunk,(chunk[0],chunk[1],paramsShm.name,
+                                                                            chunk[2],chunk[3])))
+            detections.append(running.popleft().get())
+            if cancelToken is not None and cancelToken.isCancelled():
+                return None
+    finally:
+        # Tasks left running after a cancel may fail to read the parameters, their detections are not wanted anyway
+        releaseShared(paramsShm,unlink=True)
+    return detections
+
+# Scan the archive for events matching the templates (see getDetectTemplates), from t1 to t2 (default the whole archive)...
+# ...the archive is read chunkLen (s) at a time, so memory is bounded by the chunk length not the archive length...
+# ...if scanning here would take a while, the rest of the chunks are sent to the action process pool...
+# ...getProcPool returns the pool, so it is only started when needed (None to scan only within this process)...
+# ...the MAD threshold is taken within each chunk...
+# ...returns the detections as [[time,stackedXCor,nChans,madRatio],...], or None if cancelled
+def scanArchive(templates,archFiles,archFileTimes,archDir,t1=None,t2=None,chunkLen=3600.0,madMult=8.0,
+                minChans=3,freqMin=2.0,freqMax=10.0,getProcPool=None,cancelToken=None):
+    if len(templates)==0 or len(archFileTimes)==0:
+        return np.empty((0,4))
+    t1=np.min(archFileTimes[:,0]) if t1 is None else t1
+    t2=np.max(archFileTimes[:,1]) if t2 is None else t2
+    # Detections closer than the template length are the same event
+    minSep=max([tempTr.stats.endtime-tempTr.stats.starttime for traceID,tempTr,lag in templates])
+    params={'templates':templates,'archDir':archDir,
+            'delta':min([tempTr.stats.delta for traceID,tempTr,lag in templates]),'madMult':madMult,
+            'minChans':min(minChans,len(templates)),'minSep':minSep,'freqMin':freqMin,'freqMax':freqMax}
+    # Time chunks as [t1,t2,archFiles,archFileTimes], with only the archive files read for each chunk
+    chunks=[]
+    for aTime in np.arange(t1,t2,chunkLen):
+        chunkT2=min(aTime+chunkLen,t2)
+        # Skip chunks without any archive data
+        if not np.any((archFileTimes[:,0]<=chunkT2)&(archFileTimes[:,1]>=aTime)):
+            continue
+        readT1,readT2=getChunkReadTimes(aTime,chunkT2,templates)
+        readArgs=np.where((archFileTimes[:,0]<=readT2)&(archFileTimes[:,1]>=readT1))[0]
+        chunks.append([aTime,chunkT2,np.asarray(archFiles)[readArgs],archFileTimes[readArgs]])
+    print('Scanning '+str(len(chunks))+' chunks of the archive with '+str(len(templates))+' templates')
+    detections=[]
+    canPool=getProcPool is not None
+    t0=perfTime()
+    for i,chunk in enumerate(chunks):
+        if cancelToken is not None and cancelToken.isCancelled():
+            return None
+        elapsed=perfTime()-t0
+        if canPool and i>0 and elapsed>=POOL_AFTER_TIME and elapsed/i*(len(chunks)-i)>=POOL_MIN_TIME:
+            procPool=getProcPool()
+            canPool=procPool is not None
+            if canPool:
+                poolDetections=scanInPool(chunks[i:],params,procPool,cancelToken)
+                if poolDetections is None:
+                    return None
+                detections+=poolDetections
+                break
+        detections.append(scanChunk(chunk[0],chunk[1],params,chunk[2],chunk[3]))
+    if len(detections)==0:
+        return np.empty((0,4))
+    # Events on the edge of two chunks may be detected in both
+    return declusterDetections(np.concatenate(detections),minSep)
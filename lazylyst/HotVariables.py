@@ -3,7 +3,7 @@ from __future__ import print_function
 import importlib
 import os
 import sys
-from copy import deepcopy
+from copy import copy,deepcopy
 from future.utils import iteritems
 if sys.version_info.major==3:
     unicode=str
@@ -109,6 +109,29 @@ def initHotVar():
     }
     return hotVar
 
+# Other hot variables (and preferences) which may be changed by a hot variables update function...
+# ...used to find which actions depend on another, so hot variables not listed only change themselves
+HOT_VAR_EFFECTS={'sourceTag':['archDir','pickDir','staFile','sourceDict'],
+                 'pickDir':['pickFiles','pickFileTimes','curPickFile'],
+                 'pickFiles':['pickFileTimes','curPickFile'],
+                 'curPickFile':['pickSet','curPage','stream','pltSt','staSort','curTraceSta','curTracePos'],
+                 'staSort':['curPage','pickSet'],
+                 'curPage':['pickSet'],
+                 'archDir':['archFiles','archFileTimes'],
+                 'staFile':['staXml','staLoc','mapProj','mapCurEve','mapPrevEve','curMapSta','curMapPos','mapPolygon']}
+
+# Return all hot variables (and preferences) changed when updating the given hot variables
+def getHotVarEffects(tags):
+    effects=set()
+    toCheck=list(tags)
+    while len(toCheck)>0:
+        tag=toCheck.pop()
+        if tag in effects:
+            continue
+        effects.add(tag)
+        toCheck+=HOT_VAR_EFFECTS.get(tag,[])
+    return effects
+
 # Class for hot variables, which have defined update functions
 class HotVar(object):
     def __init__(self,tag=None,val=None,
@@ -125,8 +148,18 @@ class HotVar(object):
         self.checkName=checkName # Name of the check function within $main
         self.tip=tip # Short description of the hot variable
     
-    # Return a deep copy of the objects value
-    def getVal(self):
+    # The value, whose content hash (used for cacheable actions) is forgotten whenever it is replaced
+    @property
+    def val(self):
+        return self._val
+    
+    @val.setter
+    def val(self,val):
+        self._val=val
+        self.valHash=None
+    
+    # Return a deep copy of the objects value, or a read only snapshot of it
+    def getVal(self,readOnly=False):
         # If a list has no entries, return the default (empty list) instead of the deepcopy
         if self.dataType in [list,type(np.array([0.0]))]:
             if len(self.val)==0:
@@ -134,6 +167,8 @@ class HotVar(object):
         # The station xml file, and customDict can take a while to copy - user will be able to edit
         if self.tag in ['staXml','customDict']:
             return self.val
+        elif readOnly:
+            return readOnlySnapshot(self.val)
         elif self.tag=='stream':
             return self.val.copy()
         else:
@@ -145,8 +180,9 @@ class HotVar(object):
             return
         self.func()
     
-    # Link a hot variable to its pre-defined update and check functions
-    def linkToFunction(self,main):
+    # Link a hot variable to its pre-defined update and check functions...
+    # ...without the update function if withUpdate is False (no widgets to update, see Batch.py)
+    def linkToFunction(self,main,withUpdate=True):
         # If there is no update function, skip
         if self.funcName is None and self.checkName is None:
             return
@@ -161,7 +197,7 @@ class HotVar(object):
                 linkCheck=False
                 print(self.tag+' check function did not load from $main.'+self.checkName)
         # If the link to the check function passed, link to the update function (if present)
-        if linkCheck and self.funcName is not None:
+        if linkCheck and self.funcName is not None and withUpdate:
             try:
                 self.func=getattr(main,self.funcName)
             except:
@@ -489,4 +525,33 @@ def checkImage(main,image):
             keyFail=True
     if keyFail:
         return False
-    return True
\ No newline at end of file
+    return True
+
+# Return a copy of a hot variables value which shares the underlying (numeric) array memory...
+# ...arrays (and trace data) are read only views, so the original cannot be edited in place...
+# ...an action which wants to edit these in place has to copy them first (eg. arr=arr.copy())
+def readOnlySnapshot(val):
+    if isinstance(val,np.ndarray):
+        # Arrays of python objects may hold mutable entries, which a view would share
+        if val.dtype==object:
+            return deepcopy(val)
+        return readOnlyView(val)
+    elif isinstance(val,Stream):
+        return Stream(traces=[readOnlyTrace(tr) for tr in val])
+    elif isinstance(val,dict):
+        return {key:readOnlySnapshot(aVal) for key,aVal in iteritems(val)}
+    else:
+        return deepcopy(val)
+
+# Return a trace with its own header, but with a read only view of the original data
+def readOnlyTrace(tr):
+    newTr=copy(tr)
+    newTr.stats=deepcopy(tr.stats)
+    newTr.data=readOnlyView(tr.data)
+    return newTr
+
+# Return a read only view of an array
+def readOnlyView(arr):
+    view=arr.view()
+    view.flags.writeable=False
+    return view
@@ -7,9 +7,11 @@ import sip
 import os
 import time
 import ctypes
+import threading
 from future.utils import iteritems
 from fnmatch import fnmatch
 from copy import deepcopy
+from multiprocessing.pool import ThreadPool
 sip.setapi('QVariant', 2)
 sip.setapi('QString', 2)
 sys.path.insert(0,os.path.abspath(os.path.join(os.path.dirname( __file__ ), os.pardir)))
@@ -24,17 +26,22 @@ from obspy import UTCDateTime
 from lazylyst.UI.MainWindow import Ui_MainWindow
 from CustomWidgets import keyPressToString
 from TemporalWidgets import TraceWidget
-from CustomFunctions import getTimeFromFileName,getStaStr
+from CustomFunctions import getTimeFromFileName,getStaStr,getNewPickFileNames
 from HotVariables import initHotVar
 from Preferences import defaultPreferences,DateDialog
 from Actions import defaultActions,defaultPassiveOrder,QueueThread
-from Archive import getArchiveAvail,extractDataFromArchive
-from StationMeta import staXml2Loc,readInventory,setProjFunc
+from ActionStats import ActionStats,ActionStatsWidget
+from ActionCache import ActionCache
+from ActionProcess import ActionProcessPool
+from Relocate import CatalogueRelocator
+from Archive import getArchiveAvail,extractDataFromArchive,getStreamCacheKey,StreamCache,StreamPrefetcher
+from StationMeta import staXml2Loc,readStaMeta,setProjFunc
 from ConfigurationDialog import ConfDialog
 from SaveSource import CsDialog,defaultSource
+from LazylystCore import LazylystCore
 
 # Main window class
-class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
+class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow, LazylystCore):
     def __init__(self):
         QtWidgets.QMainWindow.__init__(self)
         Ui_MainWindow.__init__(self)
@@ -45,12 +52,23 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
         self.setFunctionality()
         self.introduction()
         self.processAction(self.act['OpenLazylyst'])
+        # Once started, let the plugins load what they need in the background
+        QtCore.QTimer.singleShot(0,self.preloadPlugins)
     
     # Update UI for the few commands not captured in Qt Designer
     def tweakUi(self):
         self.traceLayout.setContentsMargins(0,0,0,0)
         self.timeImageLayout.setContentsMargins(0,0,0,0)
         self.setWindowTitle('Lazylyst '+__version__)
+        # Dock showing how long each action takes, hidden unless toggled on (or restored from the saved state)
+        self.actStats=ActionStats()
+        self.actStatsWidget=ActionStatsWidget(self.actStats)
+        self.actStatsDock=QtWidgets.QDockWidget('Action Stats',self)
+        self.actStatsDock.setObjectName('actStatsDock')
+        self.actStatsDock.setFeatures(QtWidgets.QDockWidget.DockWidgetFloatable|QtWidgets.QDockWidget.DockWidgetMovable)
+        self.actStatsDock.setWidget(self.actStatsWidget)
+        self.addDockWidget(QtCore.Qt.BottomDockWidgetArea,self.actStatsDock)
+        self.actStatsDock.hide()
      
     # Go through all preferences, and call their update functions
     def applyPreferences(self):
@@ -77,6 +95,10 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
         self.archiveSpan.addNewEventSignal.connect(lambda: self.addPickFile(self.archiveSpan.newEveTime))
         self.archiveList.doubleClicked.connect(self.archiveListDoubleClickEvent)
         self.archiveListLineEdit.editingFinished.connect(self.updateArchiveSpanList)
+        # Allow cancelling of threads and pending runs (right click)
+        self.schemeComboBox.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+        self.schemeComboBox.customContextMenuRequested.connect(self.schemeMenuEvent)
+        self.schemeComboBox.setToolTip('Running and pending threads, right click to cancel')
         # Give ability to the map
         self.mapWidget.doubleClicked.connect(self.mapDoubleClickEvent)
         self.mapWidget.updatePolygonPenSignal.connect(self.updateMapPolygonPen)
@@ -127,6 +149,14 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
                 self.traceSplitter.setSizes([maxHeight,np.sum(self.traceSplitSizes)-maxHeight])
             dock.hide()
         ## Do not allow resizing splitter if there is no image being shown ##
+    
+    # Toggle the action stats dock on or off
+    def toggleActionStats(self):
+        if self.actStatsDock.isHidden():
+            self.actStatsDock.show()
+            self.actStatsWidget.refresh(force=True)
+        else:
+            self.actStatsDock.hide()
             
     # Reload plugins from the specified modules
     def reloadPlugins(self):
@@ -134,7 +164,23 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
             if action.path=='$main':
                 continue
             action.linkToFunction(self,reloadMod=True)
+        # Worker processes reload the plugins before their next call
+        if self.procPool is not None:
+            self.procPool.reload()
         print('Reloaded plugins')
+        self.preloadPlugins()
+    
+    # Call preload() of the plugin modules used by actions which define it, each on a background thread...
+    # ...so large files (eg. travel time models) are loaded before the action first needs them
+    def preloadPlugins(self):
+        paths=sorted(set([action.path for key,action in iteritems(self.act) if action.path!='$main']))
+        for path in paths:
+            preload=getattr(sys.modules.get(path),'preload',None)
+            if not callable(preload):
+                continue
+            thread=threading.Thread(target=preload,name='Preload '+path)
+            thread.daemon=True
+            thread.start()
     
     # Report the current keybinds for the configuration and change source actions
     def introduction(self):
@@ -207,140 +253,88 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
         for tag,func in [['mapPolygon',self.setMapPolygon]]:
             if tag in seenTags:
                 func()
-        # If the trigerring action is threaded, send the queue to a thread 
-        if action.threaded: 
-            # First check to see if the thread is already running, skip if it is
+        # If the trigerring action is threaded (or run in a process), send the queue to a thread 
+        if action.runsThreaded(): 
+            # First check to see if the thread is already running, if so follow the actions thread policy...
+            # ...queued (and superseding) runs are started once the running thread finishes
             if action.tag in self.qThreads.keys():
-                print('A thread is already running which was initiated by '+action.tag)
+                if action.threadPolicy=='queue':
+                    self.qPending.append(action)
+                elif action.threadPolicy=='supersede':
+                    self.qPending=[act for act in self.qPending if act.tag!=action.tag]+[action]
+                    self.qThreads[action.tag].cancel()
+                else:
+                    print('A thread is already running which was initiated by '+action.tag)
+                self.updateSchemingList()
             else:
-                thread=QueueThread(action.tag,actQueue)
+                thread=QueueThread(action.tag,actQueue,callAction=self.callAction)
                 # Mark this thread, given the active actions tag
                 self.qThreads[action.tag]=thread
                 self.updateSchemingList()
                 # Connect to the threads signals for when to send inputs, and collect returns
-                thread.setNextInputs.connect(lambda: self.setThreadInputs(thread))
-                thread.sendReturns.connect(lambda: self.updateReturns(thread.actQueue[thread.curIdx],thread.returns,thread.tag))
+                thread.setNextInputs.connect(lambda idx: self.setThreadInputs(thread))
+                thread.sendReturns.connect(lambda idx,returnVals: self.updateThreadReturns(thread,idx,returnVals))
                 thread.finished.connect(lambda: self.updateThreadDict(thread.tag))
                 thread.start()
         else:
-            for oAct in actQueue:
-                # Collect the required inputs
-                inputs=self.collectActInputs(oAct.tag)
-                # Call the function with args and kwargs
-                returnVals=oAct.func(*inputs,**oAct.optionals)
-                self.updateReturns(oAct,returnVals,action.tag)
+            self.runActQueue(actQueue,action.tag)
     
     # Update the threads inputs to be its next to process actions inputs
     def setThreadInputs(self,thread):
-        thread.setInputs(self.collectActInputs(thread.actQueue[thread.curIdx].tag))
+        action=thread.actQueue[thread.curIdx]
+        thread.setInputs(self.collectTimedInputs(action),self.getCacheKey(action))
+    
+    # Update the returns of the action the thread just processed...
+    # ...then reset the return value of the thread, so that it continues processing its queues other actions...
+    # ...(also when the returns were not used)
+    def updateThreadReturns(self,thread,idx,returnVals):
+        action=thread.actQueue[idx]
+        try:
+            self.updateReturns(action,returnVals,thread.tag)
+            self.actStats.finish(action.tag)
+        finally:
+            thread.resetInputsAndReturns()
     
-    # When the thread has finished, remove the triggers tag from the thread dictionary
+    # When the thread has finished, remove the triggers tag from the thread dictionary...
+    # ...and start the next run waiting on this action, if any
     def updateThreadDict(self,threadTag):
-        self.qThreads.pop(threadTag)
+        thread=self.qThreads.pop(threadTag)
+        if thread.cancelToken.isCancelled():
+            print('Cancelled the thread initiated by '+threadTag)
+        pendTags=[act.tag for act in self.qPending]
+        if threadTag in pendTags:
+            self.runActiveAction(self.qPending.pop(pendTags.index(threadTag)))
         self.updateSchemingList()
-                
-    # Get the appropriate order of passive functions before and after their triggered active action
-    def collectActQueue(self,action):
-        beforeActive=[] # Passive actions with beforeTrigger
-        afterActive=[] # Passive actions without beforeTrigger
-        # Collect all the passive actions which have this active action as a trigger...
-        # ...in the order specified within the configuration list
-        for actTag in self.actPassiveOrder:
-            if action.tag not in self.act[actTag].trigger:
-                continue
-            # If the actions function wasn't initialized, or is sleeping, skip
-            if self.act[actTag].func==None or self.act[actTag].sleeping:
-                continue
-            if self.act[actTag].beforeTrigger:
-                beforeActive.append(self.act[actTag])
-            else:
-                afterActive.append(self.act[actTag])
-        return beforeActive+[action]+afterActive
     
-    # Collect all of the inputs to be sent to a specific action
-    def collectActInputs(self,actionTag):
-        # Collect the required inputs
-        inputs=[]
-        hotVarKeys=self.hotVar.keys()
-        for key in self.act[actionTag].inputs:
-            if key in hotVarKeys:
-                inputs.append(self.hotVar[key].getVal())
-            else:
-                inputs.append(self.pref[key].getVal())
-        return inputs
-        
-    # Update all return (hot variable) values from an action which just finished executing
-    def updateReturns(self,action,returnVals,triggerTag):
-        # If no returns, but got something, let user know...
-        if len(action.returns)==0:
-            if returnVals is not None:
-                print('Action '+action.tag+' expected no returns, but received some')
+    # Cancel the selected entry of the scheming list, either a running thread or a pending run
+    def cancelScheme(self,idx=None):
+        if idx is None:
+            idx=self.schemeComboBox.currentIndex()
+        if idx<0:
             return
-        # ...if just one return, convert to list to treat it the same as multiple returns
-        elif len(action.returns)==1:
-            returnVals=[returnVals]
-        # ... if expecting multiple returns, ensure the length of the return value array can be taken
-        else:
-            try:
-                len(returnVals)
-            except:
-                returnVals=[returnVals]
-        # Go through each of the returns in order, and update...
-        # ...check first to see the number of returns are correct
-        # ...and that the previous/new types match
-        # ...pass (ignore) updates on variables with "$pass" as the return value
-        if len(action.returns)==len(returnVals):
-            skipUpdates=False
-            # Ensure all the variable types match before updating any hot variables...
-            # ...also ensure that the hot variables ("sanity") check function passes
-            for i,aReturnKey in enumerate(action.returns):
-                # Do not do any checks if the user wanted to pass this returns value
-                if str(returnVals[i])=='$pass':
-                    continue
-                if not self.testReturnType(self.hotVar[aReturnKey].dataType,type(returnVals[i])):
-                    print('Action '+action.tag+' expected variable '+str(self.hotVar[aReturnKey].dataType)+
-                           ' for hot variable '+aReturnKey+', got '+str(type(returnVals[i])))
-                    skipUpdates=True
-                    # If the type is wrong, no point in the longer check
-                    continue
-                # Test if the return variable passes the built in check
-                if self.hotVar[aReturnKey].check==None:
-                    continue
-                elif not self.hotVar[aReturnKey].check(self,returnVals[i]):
-                    print('Action '+action.tag+' failed '+aReturnKey+' check')
-                    skipUpdates=True
-            if skipUpdates: 
-                # Stop the action if it is timed
-                if action.timer:
-                    self.stopTimedAction(action)
-                return
-            # Process the return keys in order ...
-            for i,aReturnKey in enumerate(action.returns):
-                # ... passing over any which have $pass as the return value
-                if str(returnVals[i])=='$pass':
-                    pass
-                else:
-                    self.hotVar[aReturnKey].val=returnVals[i]
-                    self.hotVar[aReturnKey].update()
-        else:
-            print('For action '+action.tag+' got '+str(len(returnVals))+
-                   ' return values, expected '+str(len(action.returns)))
-        # If this was an action which was threaded, reset the return value of the thread...
-        # ...so that the thread knows when to continue processing its queues other actions
-        if triggerTag in self.qThreads.keys():
-            self.qThreads[triggerTag].resetInputsAndReturns()
+        status,key=self.schemeComboBox.itemData(idx)
+        if status=='running' and key in self.qThreads.keys():
+            self.qThreads[key].cancel()
+        elif status=='pending' and key<len(self.qPending):
+            print('Removed the pending run of '+self.qPending.pop(key).tag)
+        self.updateSchemingList()
     
-    # As some variable types are quite similar, allow some to be treated the same...
-    # ... for now just str and np.string_
-    def testReturnType(self,wantType,returnType):
-        # Accepted variations for strings
-        if wantType==str and returnType in [str,np.string_]:
-            return True
-        # All other data types
-        elif wantType==returnType:
-            return True
-        return False        
-            
+    # Cancel all running threads and pending runs
+    def cancelAllSchemes(self):
+        self.qPending=[]
+        for thread in self.qThreads.values():
+            thread.cancel()
+        self.updateSchemingList()
+    
+    # Menu to cancel runs from the scheming list
+    def schemeMenuEvent(self,pos):
+        if self.schemeComboBox.count()==0:
+            return
+        menu=QtWidgets.QMenu(self)
+        menu.addAction('Cancel '+self.schemeComboBox.currentText(),self.cancelScheme)
+        menu.addAction('Cancel All',self.cancelAllSchemes)
+        menu.exec_(self.schemeComboBox.mapToGlobal(pos))
+                
     # Remove a timed action from the queue
     def stopTimedAction(self,action):
         self.qTimers[action.tag].stop()
@@ -391,30 +385,15 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
         if self.hotVar['pickDir'].val=='':
             return
         try:
-            aTimeStr=UTCDateTime(pickFileTime).strftime('%Y%m%d.%H%M%S.%f')
+            UTCDateTime(pickFileTime)
         except:
             print('Expected new pick file time in format timestamp(s)')
             return
-        # Assign an ID to the new event
-        seenIDs=[int(aFile.split('_')[0]) for aFile in self.hotVar['pickFiles'].val]
-        # Use the specified ID generation style
-        if self.pref['eveIdGenStyle'].val=='fill':
-            newID=0
-            while newID in seenIDs:
-                newID+=1
-        elif self.pref['eveIdGenStyle'].val=='next':
-            if len(seenIDs)==0:
-                newID=0
-            else:
-                newID=np.max(seenIDs)+1
-        else:
-            print('The eveIDGenStyle '+self.pref['eveIdGenStyle'].val+' has not been implemented')
+        # Assign an ID to the new event, using the specified ID generation style
+        newPickFiles=getNewPickFileNames(self.hotVar['pickFiles'].val,[pickFileTime],self.pref['eveIdGenStyle'].val)
+        if len(newPickFiles)==0:
             return
-        # Use the previous file ID length, default at 10 if no files present
-        zFillLen=10
-        if len(seenIDs)>0:
-            zFillLen=len(self.hotVar['pickFiles'].val[0].split('_')[0])
-        newPickFile=str(newID).zfill(zFillLen)+'_'+aTimeStr+'.picks'
+        newPickFile=newPickFiles[0]
         # Add to the picks directory
         newFile=open(self.hotVar['pickDir'].val+'/'+newPickFile,'w')
         newFile.close()
@@ -425,38 +404,39 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
         self.updateArchivePrevEvePen()
         self.updateArchiveCurEvePen()
     
-    # Load a specific pick file from the pick directory (inter-event pick loading)...
-    # ...hot variable pickSet is reset just prior to calling this (with no picks)
-    def loadPickSet(self):
-        path=self.hotVar['pickDir'].val+'/'+self.hotVar['curPickFile'].val
-        # Check that the path exists
-        if not os.path.exists(path):
-            print('Pick file at '+path+' no longer exists')
-            return
-        # Check that the file has some content
-        elif os.path.getsize(path)==0:
-            return # pickSet is set to empty prior
-        pickSet=np.genfromtxt(path,delimiter=',',dtype=str)
-        # In the odd case there are empty spaces in the file
-        if len(pickSet)==0:
-            return
-        # Put into proper dimensions if only one pick was present
-        if len(pickSet.shape)==1:
-            pickSet=pickSet.reshape((1,3))
-        # Check to see that this file was not tampered with
-        if not self.hotVar['pickSet'].check(self,pickSet):
-            print('Pick file at '+path+' was not in correct format')
-            return
-        # Update the pickset
-        self.hotVar['pickSet'].val=pickSet
-        
     # Save the current picks
     def savePickSet(self):
-        # If the current pick file was not yet initiated, nothing to save
-        if self.hotVar['curPickFile'].val=='':
+        LazylystCore.savePickSet(self)
+        # Keep the relocated events on the map up to date with the saved picks
+        if self.hotVar['curPickFile'].val!='':
+            self.updateRelocatedPickFile()
+        
+    # Locate all events in the pick directory with the locating action, and show them on the map...
+    # ...locations are kept by pick file content, so only new or edited pick files are located again...
+    # ...if locating takes a while, the rest are located over the action process pool (see the processWorkers preference)...
+    # ...nProcs of 1 locates only within this process
+    def relocatePickDir(self,pickDir,pickFiles,locateTag='SimpleLocate',nProcs=0,cancelToken=None):
+        if pickDir=='':
+            return '$pass'
+        if locateTag not in self.act.keys():
+            print('Action '+locateTag+' does not exist, nothing to relocate with')
+            return '$pass'
+        if not self.relocator.setContext(self.act[locateTag],self.collectActInputs(locateTag),pickDir):
+            return '$pass'
+        catalogue=self.relocator.relocateAll(list(pickFiles),getProcPool=None if nProcs==1 else self.getProcPool,
+                                             cancelToken=cancelToken)
+        if catalogue is None:
+            return '$pass'
+        print('Relocated '+str(len(catalogue))+' of '+str(len(pickFiles))+' events')
+        return catalogue
+    
+    # Relocate the current pick file, if the events of its pick directory were relocated
+    def updateRelocatedPickFile(self):
+        catalogue=self.relocator.relocateFile(self.hotVar['pickDir'].val,self.hotVar['curPickFile'].val)
+        if catalogue is None:
             return
-        np.savetxt(self.hotVar['pickDir'].val+'/'+self.hotVar['curPickFile'].val,
-                   self.hotVar['pickSet'].val,fmt='%s',delimiter=',')
+        self.hotVar['mapPrevEve'].val=catalogue
+        self.hotVar['mapPrevEve'].update()
         
     # Set the current pick file, called from double click an event in the archive list
     def setCurPickFileOnClick(self):
@@ -476,8 +456,12 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
             # Get the wanted time, and query for the data
             aTime=getTimeFromFileName(self.hotVar['curPickFile'].val).timestamp
             t1,t2=aTime+self.pref['evePreTime'].val,aTime+self.pref['evePostTime'].val
+            # If this window is already being prefetched, let it finish rather than reading it again
+            self.streamPrefetcher.waitFor(getStreamCacheKey(t1,t2,self.hotVar['archDir'].val))
             self.hotVar['stream'].val=extractDataFromArchive(t1,t2,self.hotVar['archFiles'].val,
-                                                             self.hotVar['archFileTimes'].val)
+                                                             self.hotVar['archFileTimes'].val,
+                                                             archDir=self.hotVar['archDir'].val,
+                                                             cache=self.streamCache)
             # Get the trace background coloring
             self.traceBgColors=self.getStaColors('traceBg')
             # Make a copy for any filtering to be applied
@@ -495,6 +479,8 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
             # ...let user know otherwise
             else:
                 print('No data extracted from archive for curPickFile')
+            # Start getting the data of the pick files likely to be viewed next
+            self.prefetchEvents()
         # ...Otherwise reset hot variable values relating to curPickFile
         else:
             defaultHot=initHotVar()
@@ -506,6 +492,26 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
         self.archiveEvent.updateEveLineSelect(self.hotVar['curPickFile'].val)
         self.updateArchiveCurEvePen()
     
+    # Extract the data of the pick files before and after the current one in the background...
+    # ...the pick files are already ordered as per eveSortStyle, nearest ones are fetched first
+    def prefetchEvents(self):
+        nFetch=self.pref['prefetchEveCount'].val
+        if nFetch==0 or self.pref['streamCacheSize'].val==0:
+            return
+        pickFiles=self.hotVar['pickFiles'].val
+        curIdx=np.where(pickFiles==self.hotVar['curPickFile'].val)[0]
+        if len(curIdx)==0:
+            return
+        windows=[]
+        for i in range(1,nFetch+1):
+            for idx in [curIdx[0]+i,curIdx[0]-i]:
+                if idx<0 or idx>=len(pickFiles):
+                    continue
+                aTime=getTimeFromFileName(pickFiles[idx]).timestamp
+                windows.append([aTime+self.pref['evePreTime'].val,aTime+self.pref['evePostTime'].val])
+        self.streamPrefetcher.request(windows,self.hotVar['archFiles'].val,self.hotVar['archFileTimes'].val,
+                                      archDir=self.hotVar['archDir'].val)
+    
     # Update the data and picks on the current page
     def updatePage(self,init=False):
         # Update the title on the time widget
@@ -783,17 +789,11 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
     # Update the trace curves on the current page
     def updateTraces(self):
         # As new channels could have been added, update the pen reference
-        self.chaPenRef=self.getStreamPens()
-        # Clear away all previous curves, and references to this station
-        for i in np.arange(len(self.staWidgets)):
-            for curve in self.staWidgets[i].traceCurves:
-                self.staWidgets[i].removeItem(curve)
-            self.staWidgets[i].traceCurves=[]
-            self.staWidgets[i].pltItem.setLabel(axis='left',text='__._____.__')
-            self.staWidgets[i].sta=''
-        # Add in the trace data for the current page
+        if False in [tr.stats.channel in self.chaPenRef for tr in self.hotVar['pltSt'].val]:
+            self.chaPenRef=self.getStreamPens()
+        # Add in the trace data for the current page, curves are reused by each widget
         i=0
-        stas=np.array([getStaStr(tr) for tr in self.hotVar['pltSt'].val])
+        stas=self.getPltStStas()
         numStas=len(np.unique(stas))
         while self.hotVar['curPage'].val*self.pref['staPerPage'].val+i<numStas:
             if i==self.pref['staPerPage'].val:
@@ -812,16 +812,30 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
                             zip(thisSta.split('.'),[2,5,2])])
             self.staWidgets[i].pltItem.setLabel(axis='left',text=label)
             # Plot the data
+            traces=[]
             for idx in wantIdxs:
                 trace=self.hotVar['pltSt'].val[idx]
                 pen,depth=self.chaPenRef[trace.stats.channel]
-                self.staWidgets[i].addTrace(trace.times()+trace.stats.starttime.timestamp,trace.data,
-                                            trace.stats.channel,pen,depth)
+                traces.append([trace.stats.starttime.timestamp,trace.stats.delta,trace.data,
+                               trace.stats.channel,pen,depth])
+            self.staWidgets[i].setTraces(traces)
             i+=1
+        # Clear away the curves, and references to a station, on the remaining widgets
+        for widget in self.staWidgets[i:]:
+            widget.setTraces([])
+            widget.pltItem.setLabel(axis='left',text='__._____.__')
+            widget.sta=''
         # Set the background color
         for widget in self.staWidgets:                        
             widget.setBackground(self.traceBgColors[widget.sta])
     
+    # Get the station of each trace in pltSt, only recalculated when pltSt changes
+    def getPltStStas(self):
+        pltSt=self.hotVar['pltSt'].val
+        if self.pltStStas[0] is not pltSt or len(self.pltStStas[1])!=len(pltSt):
+            self.pltStStas=[pltSt,np.array([getStaStr(tr) for tr in pltSt])]
+        return self.pltStStas[1]
+    
     # Update all custom pens
     def updateCustomPen(self,init=False):
         self.updateTracePen()
@@ -992,6 +1006,31 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
     def updateArchivePrevEvePen(self):
         self.archiveEvent.updateEvePens(self.pref['basePen'].val['archivePrevEve'][0:3],'prev')
         
+    # Update the memory allowed for recently extracted event data
+    def updateStreamCache(self,init=False):
+        self.streamCache.setMaxSize(self.pref['streamCacheSize'].val)
+    
+    # Update the pool used to run independent passive actions at the same time
+    def updateActPool(self,init=False):
+        if self.actPool is not None:
+            self.actPool.close()
+        nWorkers=self.pref['passiveWorkers'].val
+        self.actPool=ThreadPool(nWorkers) if nWorkers>1 else None
+    
+    # Get the pool of worker processes for actions run in a process, starting it if not yet running
+    def getProcPool(self):
+        with self.procPoolLock:
+            if self.procPool is None:
+                self.procPool=ActionProcessPool(self.pref['processWorkers'].val)
+        return self.procPool
+    
+    # Stop the worker processes, they are restarted with the new count when next needed
+    def updateProcPool(self,init=False):
+        with self.procPoolLock:
+            if self.procPool is not None:
+                self.procPool.close()
+                self.procPool=None
+    
     # Update how many widgets are on the main page
     def updateStaPerPage(self,init=False):
         if not init:
@@ -1019,12 +1058,15 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
             self.updateCursor()
         
     # Set the archive availability
-    def updateArchive(self,showBar=True,resetSearch=True):
+    def updateArchive(self,showBar=True,resetSearch=True,cancelToken=None):
         # Do nothing if directory not initialized
         if self.hotVar['archDir'].val=='':
             return
         # Load in all of the start times of the archive...
-        archiveFiles,archiveTimes=getArchiveAvail(self.hotVar['archDir'].val,showBar=showBar)
+        archiveFiles,archiveTimes=getArchiveAvail(self.hotVar['archDir'].val,showBar=showBar,cancelToken=cancelToken)
+        # ...leaving the archive as it was if cancelled (files scanned so far are kept in the index)
+        if cancelToken is not None and cancelToken.isCancelled():
+            return
         # ...and sort them by start time (required for when extracting an events data)
         argSort=np.argsort(archiveTimes[:,0])
         archiveFiles,archiveTimes=archiveFiles[argSort],archiveTimes[argSort]
@@ -1073,10 +1115,12 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
         # Load in the new station metadata
         if self.hotVar['staFile'].val.replace(' ','')=='':
             self.hotVar['staXml'].val=initHotVar()['staXml'].val
+            self.hotVar['staLoc'].val=staXml2Loc(self.hotVar['staXml'].val)
         else:
-            self.hotVar['staXml'].val=readInventory(self.hotVar['staFile'].val)
-        self.hotVar['staLoc'].val=staXml2Loc(self.hotVar['staXml'].val)
+            self.hotVar['staXml'].val,self.hotVar['staLoc'].val=readStaMeta(self.hotVar['staFile'].val)
         self.updateMapProj()
+        # The relocated events are cleared from the map, and were located with the old stations
+        self.relocator.clear()
         # Reset any additional map related visuals
         defaultHot=initHotVar()
         for key in ['mapCurEve','mapPrevEve','curMapSta','curMapPos']:
@@ -1123,31 +1167,6 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
         self.updateArchivePrevEvePen()
         self.updateArchiveCurEvePen()
                                          
-    # Read correctly formatted pick files from the pick directory
-    def getPickFiles(self):
-        pickFiles,skipCount=[],0
-        # Only accept files with proper naming convention
-        for aFile in sorted(os.listdir(self.hotVar['pickDir'].val)):
-            # Do not check folders
-            if not os.path.isfile(self.hotVar['pickDir'].val+'/'+aFile):
-                continue
-            splitFile=aFile.split('_')
-            # Make sure the file has the proper extension '.picks'
-            if len(splitFile)!=2 or aFile.split('.')[-1]!='picks':
-                skipCount+=1
-                continue
-            try:
-                int(splitFile[0])
-                getTimeFromFileName(aFile)
-            except:
-                skipCount+=1
-                continue
-            pickFiles.append(aFile)
-        # Let user know if some files had incorrect file name convention
-        if skipCount>0:
-            print(str(skipCount)+' file(s) skipped when reading in the pickDir (convention: "ID_YYYYMMDD.HHMMSS.ffffff.picks")')
-        return np.array(pickFiles,dtype=str)
-    
     # With the same pick directory, force an update on the pick files...
     # ...this allows for addition of empty pick files and deletion of pick files
     def updatePickFiles(self):
@@ -1182,21 +1201,9 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
     def updateCurPickFile(self):
         self.updateEvent()
             
-    # Sort the pick files according to user preference...
-    # ...also update the pickFileTimes
+    # Sort the pick files according to user preference (also updating the pickFileTimes)
     def updateEveSort(self,init=False):
-        # Sort alphabetically first (will be the secondary sorting)
-        self.hotVar['pickFiles'].val=np.sort(self.hotVar['pickFiles'].val)
-        self.hotVar['pickFileTimes'].val=np.array([getTimeFromFileName(aFile).timestamp for aFile in self.hotVar['pickFiles'].val])
-        # If sorting by ID, this is the same as alphabetical (unless the ID is huge)
-        if self.pref['eveSortStyle'].val=='id':
-            pass
-        elif self.pref['eveSortStyle'].val=='time':
-            argSort=np.argsort(self.hotVar['pickFileTimes'].val)
-            self.hotVar['pickFiles'].val=self.hotVar['pickFiles'].val[argSort]
-            self.hotVar['pickFileTimes'].val=self.hotVar['pickFileTimes'].val[argSort]
-        else:
-            print('The eveSortStyle '+self.pref['eveSortStyle'].val+' has not been implemented, sorting by id')
+        self.sortPickFiles()
         # Clear the old GUI list, and add the new items
         self.updateArchiveSpanList()
             
@@ -1213,14 +1220,18 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
         self.strollComboBox.clear()
         self.strollComboBox.addItems(strollers)
         
-    # Update the scheming list with all threads currently working
+    # Update the scheming list with all threads currently working, and the runs waiting on them...
+    # ...each entry holds its status and thread tag (running) or pending index (pending)
     def updateSchemingList(self):
-        schemers=self.qThreads.keys()
+        schemers=[[tag+(' (cancelling)' if thread.cancelToken.isCancelled() else ''),('running',tag)]
+                  for tag,thread in self.qThreads.items()]
+        schemers+=[[act.tag+' (pending)',('pending',i)] for i,act in enumerate(self.qPending)]
         # Update the label (header)
         self.schemingLabel.setText('Scheming ('+str(len(schemers))+')')
         # Reset the list
         self.schemeComboBox.clear()
-        self.schemeComboBox.addItems(schemers)
+        for text,data in schemers:
+            self.schemeComboBox.addItem(text,data)
     
     # Set a span bound to user specified value
     def setSpanBoundViaDialog(self,whichBound):
@@ -1263,24 +1274,6 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
             print('Screenshot: '+outName)
             pixMap.save(aDir+'/'+outName, 'png')
     
-    # Add/remove entries from the python path
-    def updatePythonPath(self,init=False):
-        pathsToAdd=self.pref['pythonPathAdditions'].val
-        # Add the new entries
-        for path in pathsToAdd:
-            if path not in sys.path:
-                sys.path.append(path)
-                self.pythonPathInsertions.append(path)
-        # Remove any previous additions which are no longer present
-        idxs=[]
-        for path in self.pythonPathInsertions:
-            if path not in pathsToAdd+self.pythonPathOriginal and path in sys.path:
-                idxs.append(sys.path.index(path))
-        for idx in sorted(idxs)[::-1]:
-            sys.path.pop(idx)
-        # Make note of the paths which were added
-        self.pythonPathInsertions=pathsToAdd
-        
     # Load setting from previous run, and initialize base variables
     def loadSettings(self):
         # Load the hot variables
@@ -1292,8 +1285,19 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
             hotVar.linkToFunction(self)
         # Create empty variables
         self.staWidgets=[]
+        self.streamCache=StreamCache()
+        self.chaPenRef={}
+        self.pltStStas=[None,[]]
+        self.streamPrefetcher=StreamPrefetcher(self.streamCache)
+        self.actPool=None
+        self.actCache=ActionCache()
+        self.procPool=None
+        self.procPoolLock=threading.Lock()
         self.qTimers={}
         self.qThreads={}
+        self.qPending=[] # Runs of threaded actions waiting on their previous run to finish
+        self.copyInputTags=set() # Actions found to edit their inputs in place, which are given copies
+        self.relocator=CatalogueRelocator()
         self.traceSplitSizes=None
         self.setUserSeenAtTime()
         self.pythonPathInsertions=[]
@@ -1383,6 +1387,10 @@ class LazylystMain(QtWidgets.QMainWindow, Ui_MainWindow):
         # Run any actions which are to be done before closing
         self.processAction(self.act['CloseLazylyst'])
         self.saveSettings()
+        self.streamPrefetcher.stop()
+        if self.actPool is not None:
+            self.actPool.terminate()
+        self.updateProcPool()
         ev.accept()
 
 # Class for logging
@@ -0,0 +1,324 @@
+# Author: Andrew.M.G.Reynen
+from __future__ import print_function, division
+import os
+import sys
+
+import numpy as np
+
+from CustomFunctions import getTimeFromFileName,getNewPickFileNames
+from Actions import getQueueDependencies
+from ActionStats import perfTime
+from ActionCache import getContentHash,getActionCacheKey
+from Detect import getDetectTemplates,scanArchive
+
+# The parts of the main window which do not touch any widgets, shared by the GUI (LazylystMain) and the batch runner...
+# ...running action queues, collecting their inputs and updating their returns, and reading/writing the pick files...
+# ...the class using this must provide the hot variables, preferences and actions, and the main window functions...
+# ...which differ without widgets (getProcPool, stopTimedAction, and the update functions of hot variables)
+class LazylystCore(object):
+    # Run a queue of actions, updating their returns in the queues order...
+    # ...with a worker pool, later (non $main) actions are started early on the pool once all the actions...
+    # ...they depend on have been updated, otherwise all actions are run one after the other
+    def runActQueue(self,actQueue,triggerTag):
+        deps=getQueueDependencies(actQueue)
+        running={}
+        for j,oAct in enumerate(actQueue):
+            if self.actPool is not None:
+                for k in range(j+1,len(actQueue)):
+                    if k in running or actQueue[k].path=='$main' or len([i for i in deps[k] if i>=j])>0:
+                        continue
+                    running[k]=self.actPool.apply_async(self.callAction,(actQueue[k],self.collectTimedInputs(actQueue[k]),
+                                                                         self.getCacheKey(actQueue[k])))
+            # Call the function with args and kwargs, or collect the result if already started
+            if j in running:
+                returnVals=running.pop(j).get()
+            else:
+                returnVals=self.callAction(oAct,self.collectTimedInputs(oAct),self.getCacheKey(oAct))
+            self.updateReturns(oAct,returnVals,triggerTag)
+            self.actStats.finish(oAct.tag)
+    
+    # Call an actions function, or reuse its returns from a previous call with the same inputs (cacheable actions)...
+    # ...the cancel token is given to functions which accept one, returns of a cancelled call are not cached...
+    # ...an action which fails editing its read only inputs (see inputCopyStyle) is run again, and from then on, with copies...
+    # ...collected afresh from the hot variables, as the failed run may have edited parts of its inputs before failing
+    def callAction(self,action,inputs,cacheKey=None,cancelToken=None):
+        if cacheKey is not None:
+            hit,returnVals=self.actCache.get(cacheKey)
+            self.actStats.countCache(action.tag,hit)
+            if hit:
+                return returnVals
+        kwargs=action.getKwargs(cancelToken)
+        copyInputs=action.tag in self.copyInputTags
+        procPool=self.getProcPool() if action.inProcess() else None
+        try:
+            if procPool is not None:
+                call=procPool.copyCall if copyInputs else procPool.call
+                returnVals=self.actStats.callAction(action,inputs,call=call,kwargs=kwargs)
+            else:
+                returnVals=self.actStats.callAction(action,inputs,kwargs=kwargs)
+        except ValueError as error:
+            if copyInputs or 'read-only' not in str(error):
+                raise
+            print('Action '+action.tag+' edits its inputs in place, so was run again with copies of its inputs, '+
+                  'as it will be from now on (copy them within the function to avoid this)')
+            self.copyInputTags.add(action.tag)
+            return self.callAction(action,self.collectActInputs(action.tag),cacheKey,cancelToken)
+        if cacheKey is not None and (cancelToken is None or not cancelToken.isCancelled()):
+            self.actCache.put(cacheKey,returnVals)
+        return returnVals
+    
+    # Get the key of an actions cached returns, from the content hashes of its inputs...
+    # ...returns None if not to be cached, which includes actions of the main window or those given customDict...
+    # ...hot variable hashes are kept until their value is replaced
+    def getCacheKey(self,action):
+        if not action.cached or action.path=='$main' or 'customDict' in action.inputs or self.actCache.maxSize==0:
+            return None
+        inputHashes=[]
+        for key in action.inputs:
+            if key in self.hotVar.keys():
+                if self.hotVar[key].valHash is None:
+                    self.hotVar[key].valHash=getContentHash(self.hotVar[key].val)
+                inputHashes.append(self.hotVar[key].valHash)
+            else:
+                inputHashes.append(getContentHash(self.pref[key].val))
+        return getActionCacheKey(action,inputHashes)
+    
+    # Collect the inputs of an action which is about to be run, noting the time taken
+    def collectTimedInputs(self,action):
+        self.actStats.begin(action.tag)
+        t0=perfTime()
+        inputs=self.collectActInputs(action.tag)
+        self.actStats.add(action.tag,'inputs',perfTime()-t0)
+        return inputs
+    
+    # Get the appropriate order of passive functions before and after their triggered active action
+    def collectActQueue(self,action):
+        beforeActive=[] # Passive actions with beforeTrigger
+        afterActive=[] # Passive actions without beforeTrigger
+        # Collect all the passive actions which have this active action as a trigger...
+        # ...in the order specified within the configuration list
+        for actTag in self.actPassiveOrder:
+            if action.tag not in self.act[actTag].trigger:
+                continue
+            # If the actions function wasn't initialized, or is sleeping, skip
+            if self.act[actTag].func==None or self.act[actTag].sleeping:
+                continue
+            if self.act[actTag].beforeTrigger:
+                beforeActive.append(self.act[actTag])
+            else:
+                afterActive.append(self.act[actTag])
+        return beforeActive+[action]+afterActive
+    
+    # Collect all of the inputs to be sent to a specific action
+    def collectActInputs(self,actionTag):
+        # Collect the required inputs
+        inputs=[]
+        hotVarKeys=self.hotVar.keys()
+        # Actions which edit their inputs in place are given copies (see callAction)
+        readOnly=self.pref['inputCopyStyle'].val=='view' and actionTag not in self.copyInputTags
+        for key in self.act[actionTag].inputs:
+            if key in hotVarKeys:
+                inputs.append(self.hotVar[key].getVal(readOnly=readOnly))
+            else:
+                inputs.append(self.pref[key].getVal())
+        return inputs
+    
+    # Update all return (hot variable) values from an action which just finished executing
+    def updateReturns(self,action,returnVals,triggerTag):
+        t0=perfTime()
+        # If no returns, but got something, let user know...
+        if len(action.returns)==0:
+            if returnVals is not None:
+                print('Action '+action.tag+' expected no returns, but received some')
+            return
+        # ...if just one return, convert to list to treat it the same as multiple returns
+        elif len(action.returns)==1:
+            returnVals=[returnVals]
+        # ... if expecting multiple returns, ensure the length of the return value array can be taken
+        else:
+            try:
+                len(returnVals)
+            except:
+                returnVals=[returnVals]
+        # Go through each of the returns in order, and update...
+        # ...check first to see the number of returns are correct
+        # ...and that the previous/new types match
+        # ...pass (ignore) updates on variables with "$pass" as the return value
+        if len(action.returns)==len(returnVals):
+            skipUpdates=False
+            # Ensure all the variable types match before updating any hot variables...
+            # ...also ensure that the hot variables ("sanity") check function passes
+            for i,aReturnKey in enumerate(action.returns):
+                # Do not do any checks if the user wanted to pass this returns value
+                if str(returnVals[i])=='$pass':
+                    continue
+                if not self.testReturnType(self.hotVar[aReturnKey].dataType,type(returnVals[i])):
+                    print('Action '+action.tag+' expected variable '+str(self.hotVar[aReturnKey].dataType)+
+                           ' for hot variable '+aReturnKey+', got '+str(type(returnVals[i])))
+                    skipUpdates=True
+                    # If the type is wrong, no point in the longer check
+                    continue
+                # Test if the return variable passes the built in check
+                if self.hotVar[aReturnKey].check==None:
+                    continue
+                elif not self.hotVar[aReturnKey].check(self,returnVals[i]):
+                    print('Action '+action.tag+' failed '+aReturnKey+' check')
+                    skipUpdates=True
+            self.actStats.add(action.tag,'checks',perfTime()-t0)
+            if skipUpdates: 
+                # Stop the action if it is timed
+                if action.timer:
+                    self.stopTimedAction(action)
+                return
+            # Process the return keys in order ...
+            t0=perfTime()
+            for i,aReturnKey in enumerate(action.returns):
+                # ... passing over any which have $pass as the return value
+                if str(returnVals[i])=='$pass':
+                    pass
+                else:
+                    self.hotVar[aReturnKey].val=returnVals[i]
+                    self.hotVar[aReturnKey].update()
+            self.actStats.add(action.tag,'gui',perfTime()-t0)
+        else:
+            print('For action '+action.tag+' got '+str(len(returnVals))+
+                   ' return values, expected '+str(len(action.returns)))
+    
+    # As some variable types are quite similar, allow some to be treated the same...
+    # ... for now just str and np.string_
+    def testReturnType(self,wantType,returnType):
+        # Accepted variations for strings
+        if wantType==str and returnType in [str,np.string_]:
+            return True
+        # All other data types
+        elif wantType==returnType:
+            return True
+        return False        
+    
+    # Load a specific pick file from the pick directory (inter-event pick loading)...
+    # ...hot variable pickSet is reset just prior to calling this (with no picks)
+    def loadPickSet(self):
+        path=self.hotVar['pickDir'].val+'/'+self.hotVar['curPickFile'].val
+        # Check that the path exists
+        if not os.path.exists(path):
+            print('Pick file at '+path+' no longer exists')
+            return
+        # Check that the file has some content
+        elif os.path.getsize(path)==0:
+            return # pickSet is set to empty prior
+        pickSet=np.genfromtxt(path,delimiter=',',dtype=str)
+        # In the odd case there are empty spaces in the file
+        if len(pickSet)==0:
+            return
+        # Put into proper dimensions if only one pick was present
+        if len(pickSet.shape)==1:
+            pickSet=pickSet.reshape((1,3))
+        # Check to see that this file was not tampered with
+        if not self.hotVar['pickSet'].check(self,pickSet):
+            print('Pick file at '+path+' was not in correct format')
+            return
+        # Update the pickset
+        self.hotVar['pickSet'].val=pickSet
+    
+    # Save the current picks
+    def savePickSet(self):
+        # If the current pick file was not yet initiated, nothing to save
+        if self.hotVar['curPickFile'].val=='':
+            return
+        np.savetxt(self.hotVar['pickDir'].val+'/'+self.hotVar['curPickFile'].val,
+                   self.hotVar['pickSet'].val,fmt='%s',delimiter=',')
+    
+    # Scan the whole archive for events like the current event, using its picked waveforms as templates...
+    # ...an empty pick file is added for each detection which is not near an existing pick file (see Detect.py)...
+    # ...if scanning takes a while, the rest is scanned over the action process pool (see the processWorkers preference)...
+    # ...nProcs of 1 scans only within this process
+    def detectArchive(self,stream,pickSet,curPickFile,pickDir,pickFiles,archDir,archFiles,archFileTimes,
+                      templatePre=-0.5,templatePost=2.5,phaseType='P',component='Z',freqMin=2.0,freqMax=10.0,
+                      chunkLen=3600.0,madMult=8.0,minChans=3,nProcs=0,cancelToken=None):
+        if curPickFile=='' or pickDir=='':
+            return '$pass'
+        templates=getDetectTemplates(stream,pickSet,getTimeFromFileName(curPickFile).timestamp,
+                                     templatePre=templatePre,templatePost=templatePost,phaseType=phaseType,
+                                     component=component,freqMin=freqMin,freqMax=freqMax)
+        if len(templates)==0:
+            print('No picks of phase type '+phaseType+' with data to use as templates')
+            return '$pass'
+        detections=scanArchive(templates,archFiles,archFileTimes,archDir,chunkLen=chunkLen,madMult=madMult,
+                               minChans=minChans,freqMin=freqMin,freqMax=freqMax,
+                               getProcPool=None if nProcs==1 else self.getProcPool,cancelToken=cancelToken)
+        if detections is None:
+            return '$pass'
+        # Skip detections of events which already have a pick file (including the template event)
+        minSep=templatePost-templatePre
+        pickFileTimes=np.array([getTimeFromFileName(aFile).timestamp for aFile in pickFiles])
+        newTimes=[aTime for aTime in detections[:,0] if len(pickFileTimes)==0 or np.min(np.abs(pickFileTimes-aTime))>=minSep]
+        print('Detected '+str(len(detections))+' events, '+str(len(newTimes))+' without a pick file')
+        if len(newTimes)==0:
+            return '$pass'
+        newPickFiles=getNewPickFileNames(pickFiles,newTimes,self.pref['eveIdGenStyle'].val)
+        for aFile in newPickFiles:
+            newFile=open(pickDir+'/'+aFile,'w')
+            newFile.close()
+        return np.array(list(pickFiles)+newPickFiles,dtype=str)
+    
+    # Read correctly formatted pick files from the pick directory
+    def getPickFiles(self):
+        pickFiles,skipCount=[],0
+        # Only accept files with proper naming convention
+        for aFile in sorted(os.listdir(self.hotVar['pickDir'].val)):
+            # Do not check folders
+            if not os.path.isfile(self.hotVar['pickDir'].val+'/'+aFile):
+                continue
+            splitFile=aFile.split('_')
+            # Make sure the file has the proper extension '.picks'
+            if len(splitFile)!=2 or aFile.split('.')[-1]!='picks':
+                skipCount+=1
+                continue
+            try:
+                int(splitFile[0])
+                getTimeFromFileName(aFile)
+            except:
+                skipCount+=1
+                continue
+            pickFiles.append(aFile)
+        # Let user know if some files had incorrect file name convention
+        if skipCount>0:
+            print(str(skipCount)+' file(s) skipped when reading in the pickDir (convention: "ID_YYYYMMDD.HHMMSS.ffffff.picks")')
+        return np.array(pickFiles,dtype=str)
+    
+    # Sort the pick files according to user preference...
+    # ...also update the pickFileTimes
+    def sortPickFiles(self):
+        # Sort alphabetically first (will be the secondary sorting)
+        self.hotVar['pickFiles'].val=np.sort(self.hotVar['pickFiles'].val)
+        self.hotVar['pickFileTimes'].val=np.array([getTimeFromFileName(aFile).timestamp for aFile in self.hotVar['pickFiles'].val])
+        # If sorting by ID, this is the same as alphabetical (unless the ID is huge)
+        if self.pref['eveSortStyle'].val=='id':
+            pass
+        elif self.pref['eveSortStyle'].val=='time':
+            argSort=np.argsort(self.hotVar['pickFileTimes'].val)
+            self.hotVar['pickFiles'].val=self.hotVar['pickFiles'].val[argSort]
+            self.hotVar['pickFileTimes'].val=self.hotVar['pickFileTimes'].val[argSort]
+        else:
+            print('The eveSortStyle '+self.pref['eveSortStyle'].val+' has not been implemented, sorting by id')
+    
+    def updateActCache(self,init=False):
+        self.actCache.setMaxSize(self.pref['actionCacheSize'].val)
+    
+    # Add/remove entries from the python path
+    def updatePythonPath(self,init=False):
+        pathsToAdd=self.pref['pythonPathAdditions'].val
+        # Add the new entries
+        for path in pathsToAdd:
+            if path not in sys.path:
+                sys.path.append(path)
+                self.pythonPathInsertions.append(path)
+        # Remove any previous additions which are no longer present
+        idxs=[]
+        for path in self.pythonPathInsertions:
+            if path not in pathsToAdd+self.pythonPathOriginal and path in sys.path:
+                idxs.append(sys.path.index(path))
+        for idx in sorted(idxs)[::-1]:
+            sys.path.pop(idx)
+        # Make note of the paths which were added
+        self.pythonPathInsertions=pathsToAdd
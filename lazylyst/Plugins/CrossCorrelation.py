@@ -1,6 +1,21 @@
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 from obspy import UTCDateTime
-from scipy import signal
+from scipy.signal import windows
+try:
+    from scipy.fft import rfft, irfft, next_fast_len
+except ImportError:
+    from numpy.fft import rfft, irfft
+    from scipy.fftpack import next_fast_len
+
+# Hann taper applied to the template and traces before cross-correlating, as [max fraction per side,max length (s)]
+TAPER_PERC=0.10
+TAPER_MAX_LEN=2.0
+
+# Most values held in one stack of traces, larger groups of traces are correlated in blocks of rows
+MAX_STACK_SIZE=2**22
 
 # Calculate the moving sum of an array
 def MovingSum(arr, n=3):
@@ -8,47 +23,135 @@ def MovingSum(arr, n=3):
     ret[n:] = ret[n:] - ret[:-n]
     return ret[n - 1:]
 
+# FFT of a template, conjugated, so that multiplying by the FFT of data (of length nFFT) gives their cross correlation...
+# ...calculate once and pass to calcXCorStack when correlating the same template many times
+def getTemplateFFT(template,nFFT):
+    return np.conj(rfft(np.asarray(template,dtype=float),nFFT))
+
+# Calculate the cross correlation of a template against each row of a stack of data, in one pass...
+# ...which is (a*b)/(|a||b|) if normalized, just (a*b) otherwise...
+# ...rows shorter than the stack are zero padded, their length given in nPts (default all full length)...
+# ...values where the template runs past the end of a row are nan
+def calcXCorStack(template,dataStack,nPts=None,norm=True,tempFFT=None):
+    dataStack=np.asarray(dataStack,dtype=float)
+    nRow,nCol=dataStack.shape
+    nTemp=len(template)
+    if nPts is None:
+        nPts=np.full(nRow,nCol)
+    nOut=nCol-nTemp+1
+    if nOut<=0:
+        return np.empty((nRow,0))
+    # The circular correlation matches the linear correlation for the values kept, as nFFT>=nCol
+    nFFT=next_fast_len(nCol)
+    if tempFFT is None:
+        tempFFT=getTemplateFFT(template,nFFT)
+    top=irfft(rfft(dataStack,nFFT,axis=1)*tempFFT,nFFT,axis=1)[:,:nOut]
+    invalid=np.arange(nOut)[None,:]>(np.asarray(nPts)-nTemp)[:,None]
+    if norm:
+        # Calculate the magnitudes of the data vectors to be used for normalization
+        cumSum=np.zeros((nRow,nCol+1))
+        np.cumsum(dataStack**2,axis=1,out=cumSum[:,1:])
+        dataMag=np.sqrt(np.maximum(cumSum[:,nTemp:]-cumSum[:,:-nTemp],0))
+        bot=dataMag*np.sqrt(np.sum(np.asarray(template,dtype=float)**2))
+        bot[invalid]=0
+        # Replace and bottom values of zero with the max of each rows bot ( the top values will also be affected, so...
+        # ... areas near the zeros still won't get very large... just avoiding divide by zero here)
+        zeroBot=bot==0
+        bot[zeroBot]=np.broadcast_to(np.max(bot,axis=1,keepdims=True),bot.shape)[zeroBot] # These are always positive values, no need for np.abs()
+        with np.errstate(divide='ignore',invalid='ignore'):
+            xCors=top/bot
+    else:
+        xCors=top
+    xCors[invalid]=np.nan
+    return xCors
+
 # Calculate the cross correlation...
 # ...which is (a*b)/(|a||b|) if normalized, just (a*b) otherwise
 def calcXCor(template,data,norm=True):
     # Return nothing if the template is longer than the data
     if len(data)<=len(template)+1:
         return []
-    Top=signal.fftconvolve(data, template[::-1], mode='valid')
-    if norm:
-        # Calculate the magnitudes of the data vectors to be used for normalization
-        DataMag=np.sqrt(MovingSum(data**2,len(template)))
-        Bot=DataMag*np.sqrt(np.sum(template**2))
-        # Replace and bottom values of zero with the max of Bot ( the top values will also be affected, so...
-        # ... areas near the zeros still won't get very large... just avoiding divide by zero here)
-        Bot[Bot==0]=np.max(Bot) # These are always positive values, no need for np.abs()
-        XCors=Top/Bot
-    else:
-        XCors=Top
-    return XCors
-    
+    return calcXCorStack(template,np.asarray(data,dtype=float).reshape((1,-1)),norm=norm)[0]
+
+# Taper an array in place, at its start and end (same weights as obspys Trace.taper with type "hann")
+def taperData(data,sampRate):
+    npts=len(data)
+    wlen=min(int(TAPER_PERC*npts),int(TAPER_MAX_LEN*sampRate),int(npts/2))
+    if wlen==0:
+        return data
+    sides=windows.hann(2*wlen if 2*wlen==npts else 2*wlen+1)
+    data[:wlen]*=sides[:wlen]
+    data[npts-wlen:]*=sides[len(sides)-wlen:]
+    return data
+
+# Cross correlate the template against a group of traces with the same sampling rate...
+# ...the template is resampled if its sampling rate differs from the traces...
+# ...returns the [max normalized cross-correlation,offset] of each trace (None if not correlated)
+def getXCorGroupOffsets(tempTrace,traces):
+    sampRate=traces[0].stats.sampling_rate
+    if tempTrace.stats.sampling_rate!=sampRate:
+        tempTrace=tempTrace.copy().resample(sampRate)
+    template=taperData(np.array(tempTrace.data,dtype=float),sampRate)
+    nTemp=len(template)
+    nPts=np.array([len(tr.data) for tr in traces])
+    nCol=np.max(nPts)
+    if nCol<=nTemp+1:
+        return [None]*len(traces)
+    # The same template FFT is used for every block of the group
+    tempFFT=getTemplateFFT(template,next_fast_len(nCol))
+    blockSize=max(1,MAX_STACK_SIZE//nCol)
+    results=[]
+    for i in range(0,len(traces),blockSize):
+        blockTraces=traces[i:i+blockSize]
+        dataStack=np.zeros((len(blockTraces),nCol))
+        for j,tr in enumerate(blockTraces):
+            dataStack[j,:len(tr.data)]=tr.data
+            taperData(dataStack[j,:len(tr.data)],sampRate)
+        xCorStack=calcXCorStack(template,dataStack,nPts[i:i+blockSize],norm=True,tempFFT=tempFFT)
+        for tr,xCorArr in zip(blockTraces,xCorStack):
+            # Skip if the trace is not longer than the template, or has no valid correlation
+            if len(tr.data)<=nTemp+1 or np.all(np.isnan(xCorArr)):
+                results.append(None)
+                continue
+            arg=np.nanargmax(xCorArr)
+            offset=tr.stats.starttime+tr.stats.delta*arg-tempTrace.stats.starttime
+            results.append([xCorArr[arg],offset])
+    return results
+
 # Gather the offset values, based on a specific template...
-# ...assumes template is for a vertical channel
-def getVertXCorOffsets(tempTrace,stream):
-    stream=stream.select(component='Z')
+# ...assumes template is for a vertical channel...
+# ...traces are correlated in groups of equal sampling rate, each group on its own thread (up to nThreads)
+def getVertXCorOffsets(tempTrace,stream,nThreads=1):
+    traces=[tr for tr in stream.select(component='Z') if tr.stats.npts>0]
     stas,offsets,xCors=[],[],[]
-    # Taper the stream and template
-    stream.taper(0.10,type='hann',max_length=2.0)
-    tempTrace.taper(0.10,type='hann',max_length=2.0)
+    # Group the traces by their sampling rate
+    groups={}
+    for i,tr in enumerate(traces):
+        groups.setdefault(tr.stats.sampling_rate,[]).append(i)
+    groupArgs=[groups[key] for key in sorted(groups.keys())]
+    def runGroup(args):
+        return getXCorGroupOffsets(tempTrace,[traces[i] for i in args])
+    if nThreads>1 and len(groupArgs)>1:
+        pool=ThreadPool(min(nThreads,len(groupArgs)))
+        try:
+            groupResults=pool.map(runGroup,groupArgs)
+        finally:
+            pool.close()
+    else:
+        groupResults=[runGroup(args) for args in groupArgs]
+    results=[None]*len(traces)
+    for args,groupResult in zip(groupArgs,groupResults):
+        for i,result in zip(args,groupResult):
+            results[i]=result
     # Loop through each trace and get their offsets, and max XCor values
-    for tr in stream:
-        # Skip if the trace in question does not have the same sampling rate
-        if tr.stats.delta!=tempTrace.stats.delta:
-            continue
-        xCorArr=calcXCor(tempTrace.data,tr.data,norm=True)
+    for tr,result in zip(traces,results):
         # Skip if the normalized cross-correlation values do not exist
-        if len(xCorArr)==0:
+        if result is None:
             continue
-        if np.max(xCorArr)<=0:
+        xCor,offset=result
+        if xCor<=0:
             continue
         aSta=tr.stats.network+'.'+tr.stats.station+'.'+tr.stats.location
-        offset=tr.stats.starttime+tr.stats.delta*np.argmax(xCorArr)-tempTrace.stats.starttime
-        xCor=np.max(xCorArr)
         # If another trace had the same station see if larger...
         if aSta in stas:
             idx=stas.index(aSta)
@@ -66,6 +169,7 @@ def getVertXCorOffsets(tempTrace,stream):
 # ...uses a template window length (in seconds) defined by [templatePre,templatePost]
 # ...all alignment is based off the vertical channel
 # ...the earliest pick of type "phaseType" is used as reference
+# ...optional "nThreads" sets the threads used to correlate traces of differing sampling rates
 def xCorAlign(*args,**kwargs):
     # Check to ensure all the wanted kwargs are present
     for kwarg in ['templatePre','templatePost','phaseType']:
@@ -124,7 +228,8 @@ def xCorAlign(*args,**kwargs):
               ' of the desired template length')
         return '$pass'
     # Loop through all stations and get their offsets
-    stas,offsets=getVertXCorOffsets(tempTr,pltSt.copy())
+    nThreads=kwargs.get('nThreads',cpu_count())
+    stas,offsets=getVertXCorOffsets(tempTr,pltSt,nThreads=nThreads)
     missedStas=[]
     # Apply the offsets to the traces
     for tr in pltSt:
@@ -93,6 +93,7 @@ def panPercent(*args,**kwargs):
     
 # Zoom in/out by a certain percent, centered over current position
 def zoomTraceY(yTraceRanges,percent=100):
+    yTraceRanges=yTraceRanges.copy()
     avg=np.mean(yTraceRanges,axis=1)
     halfWidth=(np.diff(yTraceRanges,axis=1)/2.0)[:,0]
     yTraceRanges[:,0]=avg-halfWidth*percent/100.0
@@ -39,7 +39,7 @@ def sepChas(stream):
         offset=0
         for arg in args:
             aMin,aMax=np.min(stream[arg].data),np.max(stream[arg].data)
-            stream[arg].data-=(aMin-offset)
+            stream[arg].data=stream[arg].data-(aMin-offset)
             offset+=aMax-aMin
     return stream
 
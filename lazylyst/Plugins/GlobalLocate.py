@@ -1,8 +1,12 @@
 from __future__ import print_function
+import os
+import sys
 import pickle
+import threading
 
 import numpy as np
-from scipy.optimize import curve_fit
+
+from Plugins.Locate import robustLeastSquares,printFitReport,getMisfitCost
 
 # Reference each pick to a station index
 def getPickStaIdxs(pickSet,staNames):
@@ -54,6 +58,11 @@ def poly3_Fixed(x,a,b,c):
 def poly3(x,a,b,c,d):
     return np.clip(a*x**1+b*x**2+c*x**3+d,0,2000)
 
+# Derivative of the (clipped) 3rd order polynomials with respect to x, zero where clipped
+def poly3Deriv(x,a,b,c,d=0):
+    val=a*x**1+b*x**2+c*x**3+d
+    return np.where((val>0)&(val<2000),a+2*b*x+3*c*x**2,0)
+
 # Function to calculate the arrival times vs epicentral location
 # ti=function((staX,staY,staZ,isPphase,isSphase,p1,p2,p3,s1,s2,s3),x0,y0,z0,t0)
 # ti=t0+travelTime
@@ -66,6 +75,24 @@ def globalLocEpiFunc(data,x0,y0,z0,t0):
     ttS=poly3_Fixed(degDists,paramS[:,0],paramS[:,1],paramS[:,2])
     return t0+data[:,3]*ttP+data[:,4]*ttS
 
+# Derivatives of globalLocEpiFunc with respect to [x0,y0,z0,t0], for each pick...
+# ...through the angle to each station, d(deg)/d(cos)=-180/(pi*sin), d(cos)/d(xyz)=(sta-cos*eve)/|xyz|
+def globalLocEpiJac(data,x0,y0,z0,t0):
+    eveXyz=np.array([x0,y0,z0])
+    norm=np.sqrt(np.sum(eveXyz**2))
+    eveXyz=eveXyz/norm
+    paramP,paramS=data[:,5:8],data[:,8:11]
+    cosAngs=np.clip(np.dot(data[:,:3],eveXyz),-1,1)
+    degDists=np.arccos(cosAngs)*180.0/np.pi
+    dttDeg=data[:,3]*poly3Deriv(degDists,paramP[:,0],paramP[:,1],paramP[:,2])+\
+           data[:,4]*poly3Deriv(degDists,paramS[:,0],paramS[:,1],paramS[:,2])
+    # ...at the event (or its antipode) the direction is undefined so take the derivative as 0
+    sinAngs=np.sqrt(1-cosAngs**2)
+    dDegCos=np.where(sinAngs>1e-12,-180.0/np.pi/np.maximum(sinAngs,1e-12),0)
+    jac=np.ones((len(data),4))
+    jac[:,:3]=(dttDeg*dDegCos/norm)[:,None]*(data[:,:3]-cosAngs[:,None]*eveXyz)
+    return jac
+
 # Function to calculate the arrival times vs depth
 # ti=function((isPphase,isSphase,p1,p2,p3,p4,s1,s2,s3,s4),z0,t0)
 # ti=t0+travelTime
@@ -75,6 +102,20 @@ def globalLocDepFunc(data,z0,t0):
     ttS=poly3(z0,paramS[:,0],paramS[:,1],paramS[:,2],paramS[:,3])
     return t0+data[:,0]*ttP+data[:,1]*ttS
 
+# Derivatives of globalLocDepFunc with respect to [z0,t0], for each pick
+def globalLocDepJac(data,z0,t0):
+    paramP,paramS=data[:,2:6],data[:,6:10]
+    jac=np.ones((len(data),2))
+    jac[:,0]=data[:,0]*poly3Deriv(z0,paramP[:,0],paramP[:,1],paramP[:,2],paramP[:,3])+\
+             data[:,1]*poly3Deriv(z0,paramS[:,0],paramS[:,1],paramS[:,2],paramS[:,3])
+    return jac
+
+# Fit the epicentral location [x0,y0,z0,t0] to the pick times, from the given starting params
+def fitGlobalEpi(data,pickTimes,params,misfit,width):
+    return robustLeastSquares(lambda params:globalLocEpiFunc(data,*params)-pickTimes,
+                              lambda params:globalLocEpiJac(data,*params),
+                              params,misfit=misfit,width=width,bounds=([-1,-1,-1,-2000],[1,1,1,2000]))
+
 # Recalculate the current event-station distances with current event location
 def recalcDegDists(data,params):
     # Normalize the params, as were not constrained in "curve_fit" to have magnitude of 1
@@ -82,33 +123,33 @@ def recalcDegDists(data,params):
     degDists=vecsAngle(data[:,:3],params[:3])
     return degDists,params
 
-# Use travel times from the IASP91 model model to estimate the event location
+# Use travel times from the IASP91 model model (or another registered model, see registerTTModel)...
+# ...to estimate the event location
 # Gives approximate event location, less appropriate with smaller networks
 # Depth is constrained from 0 to 200 km
 # Method: A coarse search is done first using a third order polynomial fit, varying epicenter...
 # ...a refined epicentral search is done using O(3) polynomials fits about the predicted station-event distances...
 # ...a final search vs depth is done using O(3) polynomials at the refined station-event distances
-# Special note: the scipy curve_fit function does not constrain variables, thus the length 1 vector...
+# Each fit uses the analytic derivatives, minimizing the misfit (one of Locate.MISFITS, width in s for huber)...
+# ...verbose prints the misfit of each iteration
+# Special note: the fit does not constrain variables, thus the length 1 vector...
 # ...representing the surface position will not remain length 1; this effect is "ignored" as the...
 # ...travel times are related to distance in degrees and so the orientation of this vector is all that matters
-def globalLocate(pickSet,staLoc,mainPath,customDict,staProjStyle):
+def globalLocate(pickSet,staLoc,ttModel='iasp91',misfit='l2',width=1.0,verbose=False):
 #    import time
 #    now=time.time()
-    # Nothing to do if no picks, or not in lon,lats
+    # Nothing to do if no picks
     if 0 in pickSet.shape:
-        return np.empty((0,5)),customDict
-    elif staProjStyle!='None':
-        print('Global locate requires stations to use lon,lat')
-        return np.empty((0,5)),customDict
-    # Load in the model (if not already loaded into the custom dictionary)
-    if 'globEpiDict' not in customDict.keys():
-        with open(mainPath+'/Plugins/epiTTparams.pickle','rb') as aFile:
-            customDict['globEpiDict']=pickle.load(aFile)
-        with open(mainPath+'/Plugins/depTTparams.pickle','rb') as aFile:
-            customDict['globDepDict']=pickle.load(aFile)
-    ttEpiDict=customDict['globEpiDict']
-    ttDepDict=customDict['globDepDict']
+        return np.empty((0,5))
+    # Get the model (loaded once per process)
+    try:
+        ttEpiDict=getTTModel(ttModel).get('epi')
+        ttDepDict=getTTModel(ttModel).get('dep')
+    except Exception as error:
+        print(error)
+        return np.empty((0,5))
     # Remove anything but P and S picks
+    pickSet=pickSet.copy()
     for i,entry in enumerate(pickSet[:,1]):
         pickSet[i,1]=pickSet[i,1][0]
     pickSet=pickSet[np.where((pickSet[:,1]=='P')|(pickSet[:,1]=='S'))]
@@ -134,11 +175,12 @@ def globalLocate(pickSet,staLoc,mainPath,customDict,staProjStyle):
 
     # Solve for event origin parameters
     try:
-        params, pcov = curve_fit(globalLocEpiFunc,data,pickTimes,testLoc,
-                                 bounds=([-1,-1,-1,-2000],[1,1,1,2000]))
+        params,report=fitGlobalEpi(data,pickTimes,testLoc,misfit,width)
     except:
         print('Global locator failed')
-        return np.empty((0,5)),customDict
+        return np.empty((0,5))
+    if verbose:
+        printFitReport('globalLocate (coarse)',report)
     degDists,params=recalcDegDists(data,params) # Normalize params
     
     # Update the data for the refined global curve fitting...
@@ -151,11 +193,12 @@ def globalLocate(pickSet,staLoc,mainPath,customDict,staProjStyle):
     data[:,8:11]=ttEpiDict['sParams'][idxs]
     # Fit again with refined parameters, use previous location as starting position
     try:
-        params, pcov = curve_fit(globalLocEpiFunc,data,pickTimes,params,
-                                 bounds=([-1,-1,-1,-2000],[1,1,1,2000]))
+        params,report=fitGlobalEpi(data,pickTimes,params,misfit,width)
     except:
         print('Global locator failed')
-        return np.empty((0,5)),customDict
+        return np.empty((0,5))
+    if verbose:
+        printFitReport('globalLocate (refined)',report)
     # Convert back from the xyz to lon,lat
     degDists,params=recalcDegDists(data,params) # Normalize params
     lon,lat=xyz2sph(params[:3])
@@ -170,13 +213,243 @@ def globalLocate(pickSet,staLoc,mainPath,customDict,staProjStyle):
     dataDep[:,6:10]=ttDepDict['sParams'][idxs]
     # Fit again with depth parameters, use model starting depth and previous origin time as starting position
     try:
-        depParams, pcov = curve_fit(globalLocDepFunc,dataDep,pickTimes,[ttEpiDict['startDep'],params[-1]],
-                                 bounds=([0,-2000],[200,2000]))
+        depParams,report=robustLeastSquares(lambda params:globalLocDepFunc(dataDep,*params)-pickTimes,
+                                            lambda params:globalLocDepJac(dataDep,*params),
+                                            [ttEpiDict['startDep'],params[-1]],misfit=misfit,width=width,
+                                            bounds=([0,-2000],[200,2000]))
     except:
         print('Global locator failed')
-        return np.empty((0,5)),customDict
+        return np.empty((0,5))
+    if verbose:
+        printFitReport('globalLocate (depth)',report)
 #    print time.time()-now,len(pickSet)
 #    print lon,lat,depParams[0]
 #    print(np.sum(np.abs(pickTimes-globalLocEpiFunc(data,*params)))/len(data),'preAvgResid')
 #    print(np.sum(np.abs(pickTimes-globalLocDepFunc(dataDep,*depParams)))/len(data),'postAvgResig')
-    return np.array([[0,lon,lat,depParams[0],depParams[1]+Tref]]),customDict
+    return np.array([[0,lon,lat,depParams[0],depParams[1]+Tref]])
+
+# Travel time used where a grid has no arrival (as with the clipping of the polynomial fits)
+NO_ARRIVAL_TIME=2000.0
+
+# Dense grid of the first P and S arrival times vs epicentral distance (deg) and source depth (km)...
+# ...stored as a .npy array of shape (nDeg+1,nDep+1,2) which holds its own axes: [1:,0,0] are the distances,...
+# ...[0,1:,0] the depths and [1:,1:,phase] the P (phase 0) and S (phase 1) travel times in s (NaN if no arrival)...
+# ...the file is memory mapped, so only the parts of the grid being used are read from disk
+class TTGrid(object):
+    def __init__(self,gridFile):
+        self.grid=np.load(gridFile,mmap_mode='r')
+        if len(self.grid.shape)!=3 or self.grid.shape[2]!=2 or min(self.grid.shape[:2])<3:
+            raise Exception('Travel time grid '+gridFile+' does not have shape (nDeg+1,nDep+1,2)')
+        self.degs=np.array(self.grid[1:,0,0],dtype=float)
+        self.deps=np.array(self.grid[0,1:,0],dtype=float)
+        self.times=self.grid[1:,1:,:]
+        self.depCols={} # Travel times at single depth nodes, as used by the coarse search
+    
+    # Index of the grid cell holding each value along an axis, and how far through the cell the value is
+    @staticmethod
+    def getCells(axis,vals):
+        idxs=np.clip(np.searchsorted(axis,vals,side='right')-1,0,len(axis)-2)
+        fracs=np.clip((vals-axis[idxs])/(axis[idxs+1]-axis[idxs]),0,1)
+        return idxs,fracs
+    
+    # Travel times at the depth node depIdx for each phase index (0:P, 1:S), linearly interpolated...
+    # ...given the distance cells from getCells (so these can be reused over many depths)
+    def getNodeTimes(self,degCells,depIdx,phases):
+        if depIdx not in self.depCols:
+            col=np.array(self.times[:,depIdx,:],dtype=float)
+            col[np.isnan(col)]=NO_ARRIVAL_TIME
+            self.depCols[depIdx]=col
+        col=self.depCols[depIdx]
+        idxs,fracs=degCells
+        return col[idxs,phases]*(1-fracs)+col[idxs+1,phases]*fracs
+    
+    # Travel times at a depth for each distance and phase index, bilinearly interpolated...
+    # ...along with their derivatives with respect to the distance and the depth
+    def getTimes(self,degDists,dep,phases):
+        dIdxs,dFracs=self.getCells(self.degs,degDists)
+        zIdx,zFrac=self.getCells(self.deps,np.array([dep],dtype=float))
+        zIdx,zFrac=zIdx[0],zFrac[0]
+        corners=[]
+        for i in [0,1]:
+            for j in [0,1]:
+                times=np.array(self.times[dIdxs+i,zIdx+j,phases],dtype=float)
+                times[np.isnan(times)]=NO_ARRIVAL_TIME
+                corners.append(times)
+        t00,t01,t10,t11=corners
+        times=(t00*(1-zFrac)+t01*zFrac)*(1-dFracs)+(t10*(1-zFrac)+t11*zFrac)*dFracs
+        dttDeg=((t10-t00)*(1-zFrac)+(t11-t01)*zFrac)/(self.degs[dIdxs+1]-self.degs[dIdxs])
+        dttDep=((t01-t00)*(1-dFracs)+(t11-t10)*dFracs)/(self.deps[zIdx+1]-self.deps[zIdx])
+        return times,dttDeg,dttDep
+
+# Load a pickle, those made with python 2 need their strings decoded to be read with python 3
+def loadPickle(fileName):
+    with open(fileName,'rb') as aFile:
+        if sys.version_info[0]==2:
+            return pickle.load(aFile)
+        return pickle.load(aFile,encoding='latin1')
+
+# A travel time model, made of the parameters of the polynomial fits vs distance ("epi") and depth ("dep")...
+# ...used by globalLocate, and/or a travel time grid ("grid") used by globalGridLocate...
+# ...each part is loaded from its file when first used, and then kept for the life of the process
+class TTModel(object):
+    def __init__(self,name,epiFile=None,depFile=None,gridFile=None):
+        self.name=name
+        self.files={'epi':epiFile,'dep':depFile,'grid':gridFile}
+        self.parts={}
+        self.lock=threading.Lock()
+    
+    # If the part of the model is available
+    def has(self,part):
+        return self.files[part] is not None and os.path.exists(self.files[part])
+    
+    # Get a part of the model, loading it if not done yet (waits on any other thread loading it)
+    def get(self,part):
+        with self.lock:
+            if part not in self.parts:
+                if not self.has(part):
+                    raise Exception('Travel time model '+self.name+' has no '+part+' file '+
+                                    '(grids are made with "python Scripts/GlobalLocateCalcTT.py gridFile")')
+                if part=='grid':
+                    self.parts[part]=TTGrid(self.files[part])
+                else:
+                    self.parts[part]=loadPickle(self.files[part])
+            return self.parts[part]
+    
+    # Load all available parts of the model
+    def preload(self):
+        for part in ['epi','dep','grid']:
+            if self.has(part):
+                self.get(part)
+    
+    # Travel times at a depth (km) for each distance (deg) and phase index (0:P, 1:S), from the grid...
+    # ...with their derivatives with respect to distance and depth (see TTGrid.getTimes)
+    def getTimes(self,degDists,dep,phases):
+        return self.get('grid').getTimes(np.asarray(degDists,dtype=float),dep,np.asarray(phases,dtype=int))
+
+# Registered travel time models, by name
+TT_MODELS={}
+TT_MODELS_LOCK=threading.Lock()
+
+# Add (or replace) a travel time model which the locators can use by name
+def registerTTModel(name,epiFile=None,depFile=None,gridFile=None):
+    with TT_MODELS_LOCK:
+        TT_MODELS[name]=TTModel(name,epiFile=epiFile,depFile=depFile,gridFile=gridFile)
+
+# Get a registered travel time model...
+# ...a path to a grid file (.npy) which has not been registered is registered under its path
+def getTTModel(name):
+    with TT_MODELS_LOCK:
+        if name not in TT_MODELS:
+            if not name.endswith('.npy') or not os.path.exists(name):
+                raise Exception('Travel time model '+name+' is not registered, have '+str(sorted(TT_MODELS.keys())))
+            TT_MODELS[name]=TTModel(name,gridFile=name)
+        return TT_MODELS[name]
+
+# Load all registered travel time models, called on a background thread once the GUI has started
+def preload():
+    with TT_MODELS_LOCK:
+        ttModels=list(TT_MODELS.values())
+    for ttModel in ttModels:
+        try:
+            ttModel.preload()
+        except Exception as error:
+            print('Travel time model '+ttModel.name+' did not preload: '+str(error))
+
+# The model files kept beside this module
+PLUGIN_DIR=os.path.dirname(os.path.abspath(__file__))
+registerTTModel('iasp91',epiFile=PLUGIN_DIR+'/epiTTparams.pickle',depFile=PLUGIN_DIR+'/depTTparams.pickle',
+                gridFile=PLUGIN_DIR+'/iasp91TTgrid.npy')
+
+# Points spread evenly over the unit sphere (a Fibonacci lattice), about spacing (deg) apart
+SPHERE_POINTS={}
+
+def getSpherePoints(spacing):
+    if spacing not in SPHERE_POINTS:
+        num=int(np.ceil(4*np.pi/(spacing*np.pi/180.0)**2))
+        idxs=np.arange(num)+0.5
+        zs=1-2*idxs/num
+        rads=np.sqrt(1-zs**2)
+        angs=np.pi*(1+5**0.5)*idxs
+        SPHERE_POINTS[spacing]=np.array([rads*np.cos(angs),rads*np.sin(angs),zs]).T
+    return SPHERE_POINTS[spacing]
+
+# Coarse search of the event location over points about spacing (deg) apart, at nDeps depth nodes of the grid...
+# ...the origin time of each trial is the mean (median for l1 and huber) of its residuals...
+# ...trials are done in chunks to bound the memory used, returns [x,y,z,dep,t0] of the trial with the lowest misfit
+def gridSearchEpi(ttGrid,staXyz,phases,pickTimes,spacing,nDeps,misfit,width,chunkSize=2048):
+    trials=getSpherePoints(spacing)
+    depIdxs=np.unique(np.round(np.linspace(0,len(ttGrid.deps)-1,max(1,nDeps))).astype(int))
+    bestCost,bestParams=np.inf,None
+    for i in range(0,len(trials),chunkSize):
+        degDists=np.arccos(np.clip(trials[i:i+chunkSize].dot(staXyz.T),-1,1))*180.0/np.pi
+        degCells=ttGrid.getCells(ttGrid.degs,degDists)
+        for depIdx in depIdxs:
+            resids=pickTimes-ttGrid.getNodeTimes(degCells,depIdx,phases)
+            t0s=np.mean(resids,axis=1) if misfit=='l2' else np.median(resids,axis=1)
+            costs=getMisfitCost(resids-t0s[:,None],misfit,width,axis=1)
+            j=np.argmin(costs)
+            if costs[j]<bestCost:
+                bestCost,bestParams=costs[j],np.concatenate((trials[i+j],[ttGrid.deps[depIdx],t0s[j]]))
+    return bestParams
+
+# Arrival times from the travel time grid, given params [x0,y0,z0,dep0,t0]
+def globalGridFunc(ttGrid,staXyz,phases,params):
+    eveXyz=params[:3]/np.sqrt(np.sum(params[:3]**2))
+    return params[4]+ttGrid.getTimes(vecsAngle(staXyz,eveXyz),params[3],phases)[0]
+
+# Derivatives of globalGridFunc with respect to [x0,y0,z0,dep0,t0], for each pick (see globalLocEpiJac)
+def globalGridJac(ttGrid,staXyz,phases,params):
+    norm=np.sqrt(np.sum(params[:3]**2))
+    eveXyz=params[:3]/norm
+    cosAngs=np.clip(np.dot(staXyz,eveXyz),-1,1)
+    times,dttDeg,dttDep=ttGrid.getTimes(np.arccos(cosAngs)*180.0/np.pi,params[3],phases)
+    sinAngs=np.sqrt(1-cosAngs**2)
+    dDegCos=np.where(sinAngs>1e-12,-180.0/np.pi/np.maximum(sinAngs,1e-12),0)
+    jac=np.ones((len(staXyz),5))
+    jac[:,:3]=(dttDeg*dDegCos/norm)[:,None]*(staXyz-cosAngs[:,None]*eveXyz)
+    jac[:,3]=dttDep
+    return jac
+
+# Use a precomputed travel time grid (made with "python Scripts/GlobalLocateCalcTT.py gridFile") to estimate the event location...
+# ...ttModel is a registered model with a grid (see registerTTModel), or the path to a grid file
+# Method: a coarse search over points about coarseSpacing (deg) apart across the globe, at coarseDeps depths...
+# ...refined using the analytic derivatives of the bilinear interpolation of the grid, minimizing the misfit...
+# ...(one of Locate.MISFITS, width in s for huber), verbose prints the misfit of each iteration
+# Depth is constrained to the depths of the grid
+def globalGridLocate(pickSet,staLoc,ttModel='iasp91',coarseSpacing=2.0,coarseDeps=5,
+                     misfit='l2',width=1.0,verbose=False):
+    # Nothing to do if no picks
+    if 0 in pickSet.shape:
+        return np.empty((0,5))
+    try:
+        ttGrid=getTTModel(ttModel).get('grid')
+    except Exception as error:
+        print(error)
+        return np.empty((0,5))
+    # Remove anything but P and S picks
+    pickSet=pickSet.copy()
+    for i,entry in enumerate(pickSet[:,1]):
+        pickSet[i,1]=pickSet[i,1][0]
+    pickSet=pickSet[np.where((pickSet[:,1]=='P')|(pickSet[:,1]=='S'))]
+    # Get only picks which have station metadata
+    pickSet,pickStaIdxs=getPickStaIdxs(pickSet,staLoc[:,0])
+    if len(pickSet)==0:
+        return np.empty((0,5))
+    staXyz=sph2xyz(staLoc[pickStaIdxs,1:3].astype(float))
+    phases=(pickSet[:,1]=='S').astype(int)
+    Tref=np.min(pickSet[:,2].astype(float))
+    pickTimes=pickSet[:,2].astype(float)-Tref
+    # Coarse search, then refine
+    params=gridSearchEpi(ttGrid,staXyz,phases,pickTimes,coarseSpacing,coarseDeps,misfit,width)
+    try:
+        params,report=robustLeastSquares(lambda params:globalGridFunc(ttGrid,staXyz,phases,params)-pickTimes,
+                                         lambda params:globalGridJac(ttGrid,staXyz,phases,params),
+                                         params,misfit=misfit,width=width,
+                                         bounds=([-1,-1,-1,ttGrid.deps[0],-2000],[1,1,1,ttGrid.deps[-1],2000]))
+    except:
+        print('Global locator failed')
+        return np.empty((0,5))
+    if verbose:
+        printFitReport('globalGridLocate',report)
+    lon,lat=xyz2sph(params[:3]/np.sqrt(np.sum(params[:3]**2)))
+    return np.array([[0,lon,lat,params[3],params[4]+Tref]])
@@ -1,11 +1,8 @@
 from __future__ import print_function
-import warnings
 
 import numpy as np
-import scipy.optimize as optimize
-warnings.simplefilter("ignore", optimize.OptimizeWarning)
 
-from StationMeta import unitConversionDict
+from StationMeta import unitConversionDict,projStaLoc,getStaRows
 
 # Get the velocity and delay values based on the current source...
 # ...used for the simple locator (see simpleLocatorFunc for the equation, units in km and s)
@@ -28,42 +25,124 @@ def getVelDelay(sourceDict):
 def simpleLocatorFunc(data,x0,y0,z0,t0):
     return t0+((((data[:,0]-x0)**2+(data[:,1]-y0)**2+(data[:,2]-z0)**2)**0.5)+data[:,3]*data[:,4])/data[:,3]
 
-# Gather the information to be sent to the location minimization function
+# Derivatives of simpleLocatorFunc with respect to [x0,y0,z0,t0], for each pick
+# dti/dx0=-(xi-x0)/(Dist*Vel), and dti/dt0=1
+def simpleLocatorJac(data,x0,y0,z0,t0):
+    diff=data[:,:3]-np.array([x0,y0,z0])
+    dist=np.sqrt(np.sum(diff**2,axis=1))
+    jac=np.ones((len(data),4))
+    # ...where at a station, the direction is undefined so take the derivative as 0
+    jac[:,:3]=-diff/(np.maximum(dist,1e-12)*data[:,3])[:,None]
+    return jac
+
+# Misfit which the locators minimize, given the travel time residuals...
+# ...l2: least squares, l1: absolute, huber: least squares within width (s) of zero, absolute beyond
+MISFITS=['l2','l1','huber']
+
+# ...axis sums the residuals of many trial locations at once (eg. a grid search)
+def getMisfitCost(resids,misfit='l2',width=1.0,axis=None):
+    absRes=np.abs(resids)
+    if misfit=='l1':
+        return np.sum(absRes,axis=axis)
+    elif misfit=='huber':
+        return np.sum(np.where(absRes<=width,0.5*absRes**2,width*(absRes-0.5*width)),axis=axis)
+    return 0.5*np.sum(absRes**2,axis=axis)
+
+# Weights of the residuals, which minimize the misfit using iteratively reweighted least squares
+def getMisfitWeights(resids,misfit='l2',width=1.0):
+    absRes=np.abs(resids)
+    if misfit=='l1':
+        return 1.0/np.maximum(absRes,1e-6)
+    elif misfit=='huber':
+        return np.where(absRes<=width,1.0,width/np.maximum(absRes,1e-12))
+    return np.ones(len(resids))
+
+# Levenberg-Marquardt fit of params, minimizing the misfit of the residuals resFunc(params)...
+# ...jacFunc(params) gives the derivatives of the residuals with respect to the params...
+# ...bounds ([lower],[upper]) are kept by clipping each step...
+# ...returns the params and a report of the fit {'costs':cost after each iteration,'nIter','converged'}
+def robustLeastSquares(resFunc,jacFunc,params,misfit='l2',width=1.0,bounds=None,maxIter=50,tol=1e-6):
+    if misfit not in MISFITS:
+        print('Misfit '+str(misfit)+' not in '+str(MISFITS)+', using l2')
+        misfit='l2'
+    params=np.array(params,dtype=float)
+    if bounds is not None:
+        lower,upper=np.array(bounds[0],dtype=float),np.array(bounds[1],dtype=float)
+        params=np.clip(params,lower,upper)
+    resids=resFunc(params)
+    cost=getMisfitCost(resids,misfit,width)
+    costs,damp,converged=[cost],1e-3,False
+    for i in range(maxIter):
+        jac=jacFunc(params)
+        weightJac=jac*getMisfitWeights(resids,misfit,width)[:,None]
+        normMat,grad=jac.T.dot(weightJac),weightJac.T.dot(resids)
+        scale=np.maximum(np.diag(normMat),1e-12*max(np.max(np.diag(normMat)),1e-12))
+        # Increase the damping until the step lowers the misfit
+        improved=False
+        while damp<1e12:
+            try:
+                step=np.linalg.solve(normMat+damp*np.diag(scale),-grad)
+            except np.linalg.LinAlgError:
+                step=np.linalg.lstsq(normMat+damp*np.diag(scale),-grad,rcond=None)[0]
+            newParams=params+step
+            if bounds is not None:
+                newParams=np.clip(newParams,lower,upper)
+            newResids=resFunc(newParams)
+            newCost=getMisfitCost(newResids,misfit,width)
+            if newCost<cost:
+                improved=True
+                damp=max(damp/10.0,1e-12)
+                break
+            damp*=10.0
+        # No step lowers the misfit, so at the minimum
+        if not improved:
+            converged=True
+            break
+        change=(cost-newCost)/max(cost,1e-30)
+        stepSize=np.sqrt(np.sum((newParams-params)**2))
+        params,resids,cost=newParams,newResids,newCost
+        costs.append(cost)
+        if change<tol or cost<1e-20 or stepSize<tol*(np.sqrt(np.sum(params**2))+tol):
+            converged=True
+            break
+    return params,{'costs':costs,'nIter':len(costs)-1,'converged':converged}
+
+# Print the report of a locators fit
+def printFitReport(name,report):
+    print(name+(' converged' if report['converged'] else ' did not converge')+' after '+str(report['nIter'])+
+          ' iterations, misfit per iteration: '+', '.join(['%.4g' % cost for cost in report['costs']]))
+
+# Gather the information to be sent to the location minimization function...
+# ...as [[xi,yi,zi,vi,di,ti],...] for each P and S pick with station metadata, and the picks stations
 def getPickData(pickSet,staLoc,vdInfo,mapProj):
+    if len(pickSet)==0:
+        return np.empty((0,6)),np.empty(0,dtype=str)
+    # Ensure that each pick has station metadata present, and is a P or S pick
+    rows=getStaRows(staLoc,pickSet[:,0])
+    isP,isS=pickSet[:,1]=='P',pickSet[:,1]=='S'
+    keep=np.where((rows>=0)&(isP|isS))[0]
     # Form array to be able to send to the 0 dimensional travel time function
-    data,stas=[],[] #[xi,yi,zi,vi,ti],[]
-    for aPick in pickSet:
-        # Ensure that this pick has station metadata present
-        idx=np.where(staLoc[:,0]==aPick[0])[0]
-        if len(idx)<1:
-            continue
-        aStaX,aStaY,aStaZ=staLoc[idx[0],1:4].astype(float)
-        # Assign appropriate velocity values        
-        if aPick[1]=='P':
-            aVel=vdInfo['Vp']
-            aDelay=vdInfo['Dp']
-        elif aPick[1]=='S':
-            aVel=vdInfo['Vs']
-            aDelay=vdInfo['Ds']
-        else:
-            continue
-        aTime=float(aPick[2]) ## Give more sig digs?... rough approximation anyways
-        data.append([aStaX,aStaY,aStaZ,aVel,aDelay,aTime])
-        stas.append(aPick[0])
-    data=np.array(data)
+    data=np.empty((len(keep),6))
+    data[:,:3]=staLoc[rows[keep],1:4].astype(float)
+    # Assign appropriate velocity values
+    data[:,3]=np.where(isP[keep],vdInfo['Vp'],vdInfo['Vs'])
+    data[:,4]=np.where(isP[keep],vdInfo['Dp'],vdInfo['Ds'])
+    data[:,5]=pickSet[keep,2].astype(float) ## Give more sig digs?... rough approximation anyways
     if len(data)>0:
         # Get the unit conversion factor between the default km and current
         convFactor=unitConversionDict()[mapProj['units']]/1000.0
         # Divide by factor to get the wanted velocity
         data[:,3]/=convFactor
-    return np.array(data),np.array(stas,dtype=str)
+    return data,np.array(pickSet[keep,0],dtype=str)
 
-# Locate event using a straight ray path, and non-linear least squares curve fitting
+# Locate event using a straight ray path, and a (robust) non-linear least squares fit...
+# ...starting at the station with the earliest pick
 # Also assign residual coloring to the stations
 # Will not return a location if no velocities supplied, or stations are not projected
-def simpleLocator(pickSet,staLoc,mapProj,staSort,sourceDict):
+# misfit is one of MISFITS, huber uses tResThresh as its width, verbose prints the misfit of each iteration
+def simpleLocator(pickSet,staLoc,mapProj,staSort,sourceDict,misfit='l2',verbose=False):
     # Convert from Lon,Lat,Ele to X,Y,Z
-    staLoc[:,1:4]=mapProj['func'](staLoc[:,1:4])
+    staLoc=projStaLoc(staLoc,mapProj)
     # Use only P and S picks
     if len(pickSet)>=4:
         pickSet=pickSet[np.where((pickSet[:,1]=='P')|(pickSet[:,1]=='S'))]
@@ -71,11 +150,12 @@ def simpleLocator(pickSet,staLoc,mapProj,staSort,sourceDict):
     if len(staLoc)==0:
         traceBgPenAssign={'noStaData':list(staSort)}
     else:
-        traceBgPenAssign={'noStaData':[sta for sta in staSort if sta not in staLoc[:,0]]}
+        traceBgPenAssign={'noStaData':list(np.asarray(staSort)[getStaRows(staLoc,staSort)<0])}
     if len(staSort)==0:
         mapStaPenAssign={'noTraceData':[row[0] for row in staLoc]}
     else:
-        mapStaPenAssign={'noTraceData':[row[0] for row in staLoc if row[0] not in staSort]}
+        staSortSet=set(staSort)
+        mapStaPenAssign={'noTraceData':[row[0] for row in staLoc if row[0] not in staSortSet]}
     mapStaPenAssign['goodMap']=list(np.unique(pickSet[:,0]))
     # If there is no vpInfo defined or the stations are not projected, do not update the location
     vdInfo=getVelDelay(sourceDict)
@@ -90,11 +170,16 @@ def simpleLocator(pickSet,staLoc,mapProj,staSort,sourceDict):
     data[:,5]-=Tref
     # Solve for event origin parameters
     try:
-        params, pcov = optimize.curve_fit(simpleLocatorFunc, data[:,:5], data[:,5],(0,0,0,0))
+        params,report=robustLeastSquares(lambda params:simpleLocatorFunc(data[:,:5],*params)-data[:,5],
+                                         lambda params:simpleLocatorJac(data[:,:5],*params),
+                                         np.concatenate((data[np.argmin(data[:,5]),:3],[0])),
+                                         misfit=misfit,width=vdInfo['tResThresh'])
         x0,y0,z0,t0=params
     except:
         print('simpleLocator failed')
         return np.empty((0,5)),traceBgPenAssign,mapStaPenAssign
+    if verbose:
+        printFitReport('simpleLocator',report)
     # Get the residual values...
     # ...predicted arrival times
     ti=simpleLocatorFunc(data[:,:5],x0,y0,z0,t0)
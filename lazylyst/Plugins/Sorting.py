@@ -4,6 +4,7 @@ import numpy as np
 
 from Plugins.Locate import getVelDelay,getPickData,simpleLocatorFunc
 from Plugins.GlobalLocate import sph2xyz,vecsAngle
+from StationMeta import projStaLoc
 
 # Return the stations in alphabetical order
 def staSortAlph(staSort):
@@ -20,6 +21,7 @@ def staSortPickTime(staSort,pickSet,pickMode):
     maxT=np.max(pickSet[:,2].astype(float))
     offset=maxT-np.min(pickSet[:,2].astype(float))+1
     args=np.where(pickSet[:,1]!=pickMode)
+    pickSet=pickSet.copy()
     pickSet[args,2]=(pickSet[args,2].astype(float)+offset).astype(str)
     pos=[]
     for i,sta in enumerate(staSort):
@@ -35,7 +37,7 @@ def staSortDist(staSort,staLoc,mapCurEve,mapProj):
     if len(mapCurEve)==0 or len(staLoc)==0:
         return '$pass'
     # Project the station and event locations
-    staLoc[:,1:4]=mapProj['func'](staLoc[:,1:4])
+    staLoc,mapCurEve=projStaLoc(staLoc,mapProj),mapCurEve.copy()
     mapCurEve[:,1:4]=mapProj['func'](mapCurEve[:,1:4])
     # Secondary sorting is alphabetical
     staSort=np.sort(staSort)
@@ -80,7 +82,7 @@ def staSortResidual(staSort,staLoc,sourceDict,pickSet,mapCurEve,mapProj):
     if vdInfo=='$pass' or len(mapCurEve)==0 or mapProj['units']=='deg' or len(staSort)==0:
         return staSort
     # Reproject event and station locations
-    staLoc[:,1:4]=mapProj['func'](staLoc[:,1:4])
+    staLoc,mapCurEve=projStaLoc(staLoc,mapProj),mapCurEve.copy()
     mapCurEve[:,1:4]=mapProj['func'](mapCurEve[:,1:4])
     data,stas=getPickData(pickSet,staLoc,vdInfo,mapProj)
     # If there was none of the wanted pick types, return alphabetical
@@ -36,6 +36,27 @@ def defaultPreferences(main):
     'remExcessPicksStyle':Pref(tag='remExcessPicksStyle',val='oldest',dataType=str,
                         dialog='ComboBoxDialog',condition={'isOneOf':['oldest','closest','furthest']},
                         tip='Which excess pick(s) will be deleted when manually adding picks'),
+    'streamCacheSize':Pref(tag='streamCacheSize',val=256,dataType=float,
+                           func=main.updateStreamCache,condition={'bound':[0,1e6]},
+                           tip='Memory (MB) used to keep recently extracted event data, 0 disables the cache'),
+    'prefetchEveCount':Pref(tag='prefetchEveCount',val=1,dataType=int,condition={'bound':[0,10]},
+                            tip='Number of pick files either side of the current one to extract data for in the background, '+
+                                '0 disables prefetching (requires streamCacheSize above 0)'),
+    'passiveWorkers':Pref(tag='passiveWorkers',val=0,dataType=int,
+                          func=main.updateActPool,condition={'bound':[0,64]},
+                          tip='Number of threads used to run passive actions which do not depend on each other at the same time, '+
+                              '0 or 1 runs all actions one after the other (returns are always updated in the passive order)'),
+    'processWorkers':Pref(tag='processWorkers',val=2,dataType=int,
+                          func=main.updateProcPool,condition={'bound':[1,64]},
+                          tip='Number of worker processes used by actions set to run in a process (started when first needed)'),
+    'actionCacheSize':Pref(tag='actionCacheSize',val=128,dataType=float,
+                           func=main.updateActCache,condition={'bound':[0,1e6]},
+                           tip='Memory (MB) used to keep the returns of actions marked as cacheable, 0 disables the cache'),
+    'inputCopyStyle':Pref(tag='inputCopyStyle',val='view',dataType=str,
+                          dialog='ComboBoxDialog',condition={'isOneOf':['view','copy']},
+                          tip='How hot variables are given to actions, view: arrays and trace data are read only views '+
+                              '(an action which edits them in place is given copies after its first attempt), '+
+                              'copy: everything is deep copied (slower)'),
     'mapProj':Pref(tag='mapProj',
                    val={'type':'Simple',
                         'epsg':'4326',
@@ -0,0 +1,255 @@
+# Author: Andrew.M.G.Reynen
+from __future__ import print_function, division
+import os
+import sys
+import pickle
+import time
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from HotVariables import initHotVar,getHotVarEffects
+from ActionCache import getContentHash
+from ActionProcess import getWorkerFunc
+
+# Highest resolution clock available
+perfTime=getattr(time,'perf_counter',time.time)
+
+# Pick files are located within this process for at least this long (s), before the rest may be sent to the process pool...
+# ...and are only sent if they would take longer than POOL_MIN_TIME (s) to locate here, going by the time taken so far...
+# ...so quick locators, or few pick files, do not wait on the worker processes
+POOL_AFTER_TIME=0.5
+POOL_MIN_TIME=2.0
+
+# Most locations kept, by pick file content, before the oldest are forgotten
+MAX_LOCATED=200000
+
+# Read the picks of a pick file, as [[sta,type,timestamp],...]
+def readPickFile(path):
+    if os.path.getsize(path)==0:
+        return np.empty((0,3))
+    pickSet=np.genfromtxt(path,delimiter=',',dtype=str)
+    # In the odd case there are empty spaces in the file
+    if len(pickSet)==0:
+        return np.empty((0,3))
+    # Put into proper dimensions if only one pick was present
+    if len(pickSet.shape)==1:
+        pickSet=pickSet.reshape((1,3))
+    return pickSet
+
+# Return the content hash of a file
+def getFileHash(path):
+    with open(path,'rb') as aFile:
+        return hashlib.md5(aFile.read()).hexdigest()
+
+# Locate the picks of one pick file using the locating actions function, with the pick set put in place...
+# ...returns [lon,lat,dep,time] of the first located event (None if not located), and any error message
+def locatePickSet(func,kwargs,inputs,pickIdx,retIdx,pickSet):
+    inputs=list(inputs)
+    inputs[pickIdx]=pickSet
+    try:
+        returnVals=func(*inputs,**kwargs)
+        if retIdx is not None:
+            returnVals=returnVals[retIdx]
+        if isinstance(returnVals,str):
+            return None,None
+        eveLoc=np.array(returnVals,dtype=float)
+    except Exception as error:
+        return None,str(error)
+    if len(eveLoc.shape)!=2 or eveLoc.shape[1]!=5 or len(eveLoc)==0:
+        return None,None
+    return eveLoc[0,1:].tolist(),None
+
+# Locate a chunk of pick files within a worker process of the action process pool...
+# ...hashPaths are [[fileHash,path],...], returns [[fileHash,location,error],...]
+def runRelocateChunk(sysPath,reloadGen,path,name,kwargs,inputs,pickIdx,retIdx,hashPaths):
+    func=getWorkerFunc(path,name,sysPath,reloadGen)
+    results=[]
+    for fileHash,aPath in hashPaths:
+        try:
+            pickSet=readPickFile(aPath)
+        except Exception as error:
+            results.append((fileHash,None,str(error)))
+            continue
+        results.append((fileHash,)+locatePickSet(func,kwargs,inputs,pickIdx,retIdx,pickSet))
+    return results
+
+# Locations of all events within a pick directory, kept by the content hash of each pick file...
+# ...so relocating again (or after one pick file is saved) only locates new or edited pick files
+class CatalogueRelocator(object):
+    def __init__(self,maxLocated=MAX_LOCATED):
+        self.maxLocated=maxLocated
+        self.lock=threading.RLock()
+        self.context=None # The locating action and its inputs, used for the current catalogue
+        self.fileStats={} # Path:[mtime,size,fileHash], so unchanged files are not read again
+        self.located=OrderedDict() # (contextKey,fileHash):[lon,lat,dep,time] (None if not located)
+        self.catalogue=OrderedDict() # Pick file:fileHash, of the pick files in the catalogue
+
+    # Set the action used to locate each pick file, and the pick directory of the catalogue...
+    # ...the action has to take pickSet and return mapCurEve, inputs are those collected for the action...
+    # ...inputs which belong to the current event (other than pickSet) are given their empty values...
+    # ...returns if the action can be used
+    def setContext(self,action,inputs,pickDir):
+        if 'pickSet' not in action.inputs or 'mapCurEve' not in action.returns:
+            print('Action '+action.tag+' must have pickSet as an input and mapCurEve as a return to relocate events')
+            return False
+        if action.func is None:
+            print('Action '+action.tag+' is not linked to a function')
+            return False
+        pickIdx=action.inputs.index('pickSet')
+        retIdx=action.returns.index('mapCurEve') if len(action.returns)>1 else None
+        inputs=list(inputs)
+        defaultHot=initHotVar()
+        for i,key in enumerate(action.inputs):
+            if key in getHotVarEffects(['curPickFile']):
+                inputs[i]=defaultHot[key].val
+        # Workers are only used if the function, and its inputs, can be sent to another process
+        canPool=action.path!='$main'
+        if canPool:
+            try:
+                pickle.dumps((action.optionals,inputs),2)
+            except Exception:
+                canPool=False
+        key=getContentHash([action.path,action.name,action.optionals,inputs])
+        context={'key':key,'pickDir':pickDir,'func':action.func,'path':action.path,'name':action.name,
+                 'kwargs':dict(action.optionals),'inputs':inputs,'pickIdx':pickIdx,'retIdx':retIdx,'canPool':canPool}
+        with self.lock:
+            if self.context is None or self.context['pickDir']!=pickDir:
+                self.catalogue=OrderedDict()
+            self.context=context
+        return True
+
+    # Get the content hash of a pick file, reading it only if changed since last seen (or if forced)
+    def getFileHash(self,path,force=False):
+        stat=os.stat(path)
+        with self.lock:
+            entry=self.fileStats.get(path)
+        if not force and entry is not None and entry[:2]==[stat.st_mtime,stat.st_size]:
+            return entry[2]
+        fileHash=getFileHash(path)
+        with self.lock:
+            self.fileStats[path]=[stat.st_mtime,stat.st_size,fileHash]
+        return fileHash
+
+    # Add a location, forgetting the oldest if over the limit
+    def addLocated(self,key,loc):
+        with self.lock:
+            self.located[key]=loc
+            while len(self.located)>self.maxLocated:
+                self.located.popitem(last=False)
+
+    # Locate all of the given pick files, returning the catalogue as mapPrevEve (None if cancelled)...
+    # ...if locating here would take a while, the rest are sent to the (persistent) action process pool...
+    # ...getProcPool returns the pool, so it is only started when needed (None to locate only within this process)
+    def relocateAll(self,pickFiles,getProcPool=None,cancelToken=None):
+        with self.lock:
+            context=self.context
+        if context is None:
+            return None
+        # See which pick files contents have not yet been located
+        hashes,toLocate=[],OrderedDict()
+        for aFile in pickFiles:
+            path=context['pickDir']+'/'+aFile
+            if not os.path.exists(path):
+                hashes.append(None)
+                continue
+            fileHash=self.getFileHash(path)
+            hashes.append(fileHash)
+            if (context['key'],fileHash) not in self.located and fileHash not in toLocate:
+                toLocate[fileHash]=path
+        if len(toLocate)>0:
+            print('Locating '+str(len(toLocate))+' of '+str(len(pickFiles))+' pick files')
+        errors=[]
+        items=list(toLocate.items())
+        canPool=getProcPool is not None and context['canPool']
+        t0=perfTime()
+        for i,[fileHash,path] in enumerate(items):
+            # Locations made so far are kept for next time
+            if cancelToken is not None and cancelToken.isCancelled():
+                return None
+            elapsed=perfTime()-t0
+            if canPool and i>0 and elapsed>=POOL_AFTER_TIME and elapsed/i*(len(items)-i)>=POOL_MIN_TIME:
+                procPool=getProcPool()
+                canPool=procPool is not None
+                if canPool:
+                    if not self.relocateInPool(items[i:],context,procPool,errors,cancelToken):
+                        return None
+                    break
+            loc,error=locatePickSet(context['func'],context['kwargs'],context['inputs'],
+                                    context['pickIdx'],context['retIdx'],readPickFile(path))
+            self.addLocated((context['key'],fileHash),loc)
+            if error is not None:
+                errors.append(error)
+        if len(errors)>0:
+            print(str(len(errors))+' pick file(s) failed to locate, first error: '+errors[0])
+        with self.lock:
+            if self.context is not context:
+                return None
+            self.catalogue=OrderedDict([[aFile,fileHash] for aFile,fileHash in zip(pickFiles,hashes) if fileHash is not None])
+            return self.getCatalogue()
+
+    # Locate pick files [[fileHash,path],...] in chunks over the action process pool, returns False if cancelled...
+    # ...only a few chunks are given to the pool at a time, so a cancelled run does not hold up the pool for long
+    def relocateInPool(self,items,context,procPool,errors,cancelToken):
+        chunkSize=max(1,min(50,len(items)//(procPool.nProcs*8)))
+        chunks=deque([items[i:i+chunkSize] for i in range(0,len(items),chunkSize)])
+        running=deque()
+        while len(chunks)>0 or len(running)>0:
+            while len(chunks)>0 and len(running)<2*procPool.nProcs:
+                running.append(procPool.applyAsync(runRelocateChunk,(list(sys.path),procPool.reloadGen,context['path'],
+                                                                     context['name'],context['kwargs'],context['inputs'],
+                                                                     context['pickIdx'],context['retIdx'],chunks.popleft())))
+            for fileHash,loc,error in running.popleft().get():
+                self.addLocated((context['key'],fileHash),loc)
+                if error is not None:
+                    errors.append(error)
+            if cancelToken is not None and cancelToken.isCancelled():
+                return False
+        return True
+
+    # Locate a single (just saved) pick file, and update it within the catalogue...
+    # ...returns the catalogue as mapPrevEve, or None if it was unchanged (or no catalogue for this pick directory)
+    def relocateFile(self,pickDir,pickFile):
+        with self.lock:
+            context=self.context
+        if context is None or context['pickDir']!=pickDir or pickFile=='':
+            return None
+        path=pickDir+'/'+pickFile
+        if not os.path.exists(path):
+            return None
+        fileHash=self.getFileHash(path,force=True)
+        with self.lock:
+            if self.catalogue.get(pickFile)==fileHash:
+                return None
+        if (context['key'],fileHash) not in self.located:
+            loc,error=locatePickSet(context['func'],context['kwargs'],context['inputs'],
+                                    context['pickIdx'],context['retIdx'],readPickFile(path))
+            if error is not None:
+                print('Pick file '+pickFile+' failed to locate: '+error)
+            self.addLocated((context['key'],fileHash),loc)
+        with self.lock:
+            if self.context is not context:
+                return None
+            self.catalogue[pickFile]=fileHash
+            return self.getCatalogue()
+
+    # Return the located events of the catalogue, as [[ID,lon,lat,dep,time],...]
+    def getCatalogue(self):
+        with self.lock:
+            key=self.context['key']
+            rows=[]
+            for aFile,fileHash in self.catalogue.items():
+                loc=self.located.get((key,fileHash))
+                if loc is not None:
+                    rows.append([int(aFile.split('_')[0])]+loc)
+        if len(rows)==0:
+            return np.empty((0,5))
+        return np.array(rows,dtype=float)
+
+    # Forget the catalogue, and the locating action it was made with (used when the station metadata changes)
+    def clear(self):
+        with self.lock:
+            self.context=None
+            self.catalogue=OrderedDict()
@@ -1,5 +1,10 @@
 # Author: Andrew.M.G.Reynen
 
+import os
+import sys
+import pickle
+import threading
+
 from obspy import read_inventory
 import numpy as np
 import pyproj
@@ -8,7 +13,8 @@ import pyproj
 def staXml2Loc(staXml):
     # Loop through just to extract the station codes and locations...
     # ...with format [Net.Sta.Loc,Lon(deg),Lat(deg),Ele(m)], lon/lat assumed to be in WGS84 datum
-    outArr=np.empty((0,4),dtype='a32')
+    rows=[]
+    seen=set()
     for net in staXml:
         for sta in net:
             if len(sta.channels)==0:
@@ -16,22 +22,58 @@ def staXml2Loc(staXml):
             for cha in sta:
                 nsl='.'.join([net.code,sta.code,cha.location_code])
                 # Do not add this station id already present
-                if len(outArr)>0:
-                    if nsl in outArr[:,0]:
-                        continue
-                entry=np.array([nsl,cha.longitude,cha.latitude,cha.elevation],dtype='a32')
-                outArr=np.vstack((outArr,entry))
+                if nsl in seen:
+                    continue
+                seen.add(nsl)
+                rows.append([nsl,cha.longitude,cha.latitude,cha.elevation])
     # If the file was empty, convert to appropriate shape
-    if len(outArr)==0:
-        outArr=np.empty((0,4),dtype='a32')
-    else:
-        outArr=np.array(outArr,dtype=str)
-    return outArr
+    if len(rows)==0:
+        return np.empty((0,4),dtype='S32')
+    # ...otherwise fill the array all at once
+    return np.array(rows,dtype='S32').astype(str)
 
 # Read in a station xml file given the path name
 def readInventory(staFile):
     return read_inventory(staFile,format='stationxml')
 
+# Bump when the contents of the station cache change, older caches are then ignored
+STA_CACHE_VERSION=1
+
+# Location of the parsed station cache, kept beside the station file itself
+def getStaCachePath(staFile):
+    staDir,staName=os.path.split(os.path.abspath(staFile))
+    return os.path.join(staDir,'.'+staName+'.lazylystCache')
+
+# Read in a station xml file and its station table [[Net.Sta.Loc,Lon,Lat,Ele],...]...
+# ...reusing the previously parsed values if the file is unchanged (same mtime and size)
+def readStaMeta(staFile):
+    fileStat=os.stat(staFile)
+    fileKey=[STA_CACHE_VERSION,fileStat.st_mtime,fileStat.st_size]
+    cachePath=getStaCachePath(staFile)
+    try:
+        with open(cachePath,'rb') as aFile:
+            cache=pickle.load(aFile)
+        if cache['key']==fileKey:
+            return cache['staXml'],cache['staLoc']
+    except Exception:
+        pass
+    staXml=readInventory(staFile)
+    staLoc=staXml2Loc(staXml)
+    # Write to a temporary file first, so a partially written cache is never read
+    tempPath=cachePath+'.tmp'
+    try:
+        with open(tempPath,'wb') as aFile:
+            pickle.dump({'key':fileKey,'staXml':staXml,'staLoc':staLoc},aFile,protocol=pickle.HIGHEST_PROTOCOL)
+        if sys.version_info[0]==2:
+            if os.path.exists(cachePath):
+                os.remove(cachePath)
+            os.rename(tempPath,cachePath)
+        else:
+            os.replace(tempPath,cachePath)
+    except Exception as error:
+        print('Could not write the station cache '+cachePath+' ('+str(error)+')')
+    return staXml,staLoc
+
 # Conversion factor between meters and given unit
 def unitConversionDict():
     return {'m':1.0,
@@ -40,9 +82,126 @@ def unitConversionDict():
             'yd':0.9144,
             'mi':1609.344}
 
+# Forward and inverse projection between [Lon,Lat,Ele] (WGS84) and the map projection...
+# ...called directly it is the forward projection (mapProj['func']), inverse is mapProj['funcInv']...
+# ...the transformers are made once per thread, as they should not be shared between threads...
+# ...and projected station tables are remembered, so the stations are projected once per projection
+class MapProjection(object):
+    def __init__(self,outKwargs,memoSize=4):
+        self.outKwargs=outKwargs # Keyword arguments of the output pyproj.Proj
+        self.memoSize=memoSize # Number of projected station tables to remember
+        self.initState()
+        # Make this threads transformers now, so an invalid projection is caught when set
+        self.getTransformers()
+    
+    def initState(self):
+        self.local=threading.local()
+        self.lock=threading.Lock()
+        self.staMemo=[] # [[staLoc,projected staLoc],...], most recently used last
+    
+    # The projection does not change once made, so copies (eg. of the mapProj preference for each action)...
+    # ...share this instance, keeping its transformers and projected station tables
+    def __copy__(self):
+        return self
+    
+    def __deepcopy__(self,memo):
+        return self
+    
+    # Only the projection definition is sent when pickled (eg. to a worker process)
+    def __getstate__(self):
+        return {'outKwargs':self.outKwargs,'memoSize':self.memoSize}
+    
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.initState()
+    
+    # Get this threads forward and inverse transformers, making them if not yet present
+    def getTransformers(self):
+        if not hasattr(self.local,'fwd'):
+            inProj=pyproj.Proj(init='EPSG:4326')
+            outProj=pyproj.Proj(**self.outKwargs)
+            self.local.fwd=pyproj.Transformer.from_proj(inProj,outProj,always_xy=True)
+            self.local.inv=pyproj.Transformer.from_proj(outProj,inProj,always_xy=True)
+        return self.local.fwd,self.local.inv
+    
+    # Project an array of [[x,y,z],...] all at once
+    def transform(self,xyzArr,inverse=False):
+        fwd,inv=self.getTransformers()
+        xyzArr=np.asarray(xyzArr,dtype=float)
+        return np.array((inv if inverse else fwd).transform(*xyzArr.T)).T
+    
+    def __call__(self,xyzArr):
+        return self.transform(xyzArr)
+    
+    def inverse(self,xyzArr):
+        return self.transform(xyzArr,inverse=True)
+    
+    # Return the station table with [Lon,Lat,Ele] replaced by the projected [X,Y,Z]...
+    # ...the returned array is shared between calls, so is read only
+    def projStaLoc(self,staLoc):
+        with self.lock:
+            for i,[memoLoc,projLoc] in enumerate(self.staMemo):
+                if memoLoc.shape==staLoc.shape and np.array_equal(memoLoc,staLoc):
+                    self.staMemo.append(self.staMemo.pop(i))
+                    return projLoc
+        projLoc=np.array(staLoc,copy=True)
+        if len(projLoc)>0:
+            projLoc[:,1:4]=self.transform(projLoc[:,1:4])
+        projLoc.flags.writeable=False
+        with self.lock:
+            self.staMemo.append([np.array(staLoc,copy=True),projLoc])
+            if len(self.staMemo)>self.memoSize:
+                self.staMemo.pop(0)
+        return projLoc
+
+# Lookups of station tables made by getStaIndex, as [[station names,lookup],...] most recently used last
+STA_INDEX_MEMO=[]
+STA_INDEX_LOCK=threading.Lock()
+# Number of lookups taken from (hits) and added to (misses) the memo
+STA_INDEX_STATS={'hits':0,'misses':0}
+
+# Return a lookup of the station names in a station table, as [sorted unique names,row index of each name]...
+# ...lookups are remembered by the station names, as each action gets its own copy (or view) of the same table...
+# ...comparing the names is much quicker than sorting them again
+def getStaIndex(staLoc,memoSize=4):
+    staNames=staLoc[:,0]
+    with STA_INDEX_LOCK:
+        for i,[memoNames,lookup] in enumerate(STA_INDEX_MEMO):
+            if len(memoNames)==len(staNames) and np.array_equal(memoNames,staNames):
+                STA_INDEX_MEMO.append(STA_INDEX_MEMO.pop(i))
+                STA_INDEX_STATS['hits']+=1
+                return lookup
+    # Where a name repeats, the first row is used
+    lookup=np.unique(staNames,return_index=True)
+    for arr in lookup:
+        arr.flags.writeable=False
+    with STA_INDEX_LOCK:
+        STA_INDEX_STATS['misses']+=1
+        STA_INDEX_MEMO.append([np.array(staNames,copy=True),lookup])
+        if len(STA_INDEX_MEMO)>memoSize:
+            STA_INDEX_MEMO.pop(0)
+    return lookup
+
+# Return the row index within the station table of each station name, -1 where the station is not present
+def getStaRows(staLoc,staNames):
+    staNames=np.asarray(staNames,dtype=str)
+    if len(staLoc)==0 or len(staNames)==0:
+        return np.full(len(staNames),-1,dtype=int)
+    names,rows=getStaIndex(staLoc)
+    pos=np.clip(np.searchsorted(names,staNames),0,len(names)-1)
+    return np.where(names[pos]==staNames,rows[pos],-1)
+
+# Return the station table with [Lon,Lat,Ele] projected to [X,Y,Z] (read only)...
+# ...using the remembered projection if the projection function supports it
+def projStaLoc(staLoc,mapProj):
+    if isinstance(mapProj['func'],MapProjection):
+        return mapProj['func'].projStaLoc(staLoc)
+    staLoc=staLoc.copy()
+    staLoc[:,1:4]=mapProj['func'](staLoc[:,1:4])
+    return staLoc
+
 # Set the projection function
 def setProjFunc(mapProj,staLoc,init=False):
-    inProj=pyproj.Proj(init='EPSG:4326')
     # Extra key word arguments to be passed to the new projection
     extraKwargs={'axis':mapProj['zDir'],'preserve_units':True}
     if mapProj['units']!='deg':
@@ -52,14 +211,14 @@ def setProjFunc(mapProj,staLoc,init=False):
     if mapProj['type']=='Simple':
         # ...no projection
         if mapProj['simpleType']=='None' or 0 in staLoc.shape:
-            outProj=pyproj.Proj(init='EPSG:4326',**extraKwargs)
+            outKwargs=dict(init='EPSG:4326',**extraKwargs)
             if 0 in staLoc.shape and mapProj['simpleType']!='None' and not init:
                 print('Cannot determine projection as no stations given, using no projection')
         # ...Universal Transverse Mercator
         elif mapProj['simpleType']=='UTM':
             UTM_Zone=int(np.floor((np.median(staLoc[:,1].astype(float)) + 180.0)/6) % 60) + 1
-            outProj = pyproj.Proj(proj='utm',zone=UTM_Zone,
-                                  datum='WGS84',**extraKwargs)
+            outKwargs=dict(proj='utm',zone=UTM_Zone,
+                           datum='WGS84',**extraKwargs)
         # ...Albers Equal Area (Conic)
         elif mapProj['simpleType']=='AEA Conic':
             # Use the bounds of the stations for guidelines
@@ -70,13 +229,14 @@ def setProjFunc(mapProj,staLoc,init=False):
             lat1,lat2=(maxLat-minLat)*1.0/6+minLat,(maxLat-minLat)*5.0/6+minLat
             # The origin of the projection
             lat0,lon0=(maxLat-minLat)*1.0/2+minLat,(maxLon-minLon)*1.0/2+minLon
-            outProj=pyproj.Proj(proj='aea',lat_1=lat1,lat_2=lat2,lat_0=lat0,lon_0=lon0,
-                                datum='WGS84',ellps='WGS84',**extraKwargs)
+            outKwargs=dict(proj='aea',lat_1=lat1,lat_2=lat2,lat_0=lat0,lon_0=lon0,
+                           datum='WGS84',ellps='WGS84',**extraKwargs)
         # ...catch
         else:
             print('Simple projection not defined, how did we get here?')
     # If using a EPSG code
     else:
-        outProj=pyproj.Proj(init='EPSG:'+mapProj['epsg'],**extraKwargs)
-    mapProj['func']=lambda xyzArr:np.array(pyproj.transform(inProj,outProj,*xyzArr.T)).T
-    mapProj['funcInv']=lambda xyzArr:np.array(pyproj.transform(outProj,inProj,*xyzArr.T)).T
\ No newline at end of file
+        outKwargs=dict(init='EPSG:'+mapProj['epsg'],**extraKwargs)
+    projection=MapProjection(outKwargs)
+    mapProj['func']=projection
+    mapProj['funcInv']=projection.inverse
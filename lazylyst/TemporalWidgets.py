@@ -345,16 +345,78 @@ class PickLine(pg.InfiniteLine):
         self.setPen(col,width=width)
         self.setVisible(width!=0)
 
-# Plot curve item, but now with reference to the channel
+# Number of samples combined at each successive overview level
+OVERVIEW_FACTOR=4
+# Overview levels stop being made once they have fewer bins than this
+OVERVIEW_MIN_BINS=256
+
+# Get the overview levels of a trace, each being the interleaved [min,max] of bins of samples...
+# ...level i bins contain OVERVIEW_FACTOR**(i+1) samples
+def getOverviewLevels(y):
+    levels=[]
+    mins,maxs=y,y
+    while len(mins)>OVERVIEW_MIN_BINS*OVERVIEW_FACTOR:
+        # Pad the end of the last bin with its final value
+        nPad=(-len(mins))%OVERVIEW_FACTOR
+        if nPad!=0:
+            mins=np.concatenate((mins,np.repeat(mins[-1],nPad)))
+            maxs=np.concatenate((maxs,np.repeat(maxs[-1],nPad)))
+        mins=mins.reshape(-1,OVERVIEW_FACTOR).min(axis=1)
+        maxs=maxs.reshape(-1,OVERVIEW_FACTOR).max(axis=1)
+        levels.append(np.vstack((mins,maxs)).T.reshape(-1))
+    return levels
+
+# Plot curve item, but now with reference to the channel...
+# ...samples are uniformly spaced from t0, and only a bounded number of points are drawn for the current view
 class TraceCurve(pg.PlotCurveItem):
-    def __init__(self,x,y,cha,pen,dep,parent=None):
+    def __init__(self,t0,delta,y,cha,pen,dep,parent=None):
         super(TraceCurve,self).__init__(parent)
-        self.setData(x=x,y=y,pen=pen)
+        self.y=None
+        self.setTrace(t0,delta,y,cha,pen,dep)
+    
+    # Swap in a new trace, in place (overview levels are only rebuilt if the data changed)
+    def setTrace(self,t0,delta,y,cha,pen,dep):
+        if y is not self.y:
+            self.levels=getOverviewLevels(y)
+        self.t0=t0
+        self.delta=delta
+        self.y=y
+        self.viewKey=None
+        self.setPen(pen)
         self.cha=cha
         self.setZValue(dep)
         # If width of zero, do not show the curve
-        if pen.widthF()==0:
-            self.setVisible(False)
+        self.setVisible(pen.widthF()!=0)
+    
+    # Show the data between the given times, using the coarsest level still having a point per pixel
+    def updateView(self,xMin,xMax,numPixels):
+        numPixels=max(1,int(numPixels))
+        # Number of samples within the view, and the level which would fit them into the pixels
+        numVis=(xMax-xMin)/self.delta
+        level=0
+        while level<len(self.levels) and numVis/OVERVIEW_FACTOR**level>2*numPixels:
+            level+=1
+        # Bins (or samples) which are within view, with one extra on either side
+        if level==0:
+            binDelta,vals,binPnts=self.delta,self.y,1
+        else:
+            binDelta,vals,binPnts=self.delta*OVERVIEW_FACTOR**level,self.levels[level-1],2
+        numBins=len(vals)//binPnts
+        i1=int(max(0,np.floor((xMin-self.t0)/binDelta)-1))
+        i2=int(min(numBins,np.ceil((xMax-self.t0)/binDelta)+2))
+        # Skip if showing the same as previously
+        if self.viewKey==(level,i1,i2):
+            return
+        self.viewKey=(level,i1,i2)
+        if i2<=i1:
+            self.setData(x=np.zeros(0),y=np.zeros(0))
+            return
+        # The min and max of a bin are placed at its start and middle
+        if binPnts==1:
+            x=self.t0+np.arange(i1,i2)*binDelta
+        else:
+            x=self.t0+(np.arange(i1,i2)[:,None]*binDelta+np.array([0,0.5*binDelta])).reshape(-1)
+        self.setData(x=x,y=vals[i1*binPnts:i2*binPnts])
 
 # Widget which will hold the trace data, and respond to picking keybinds     
 class TraceWidget(pg.PlotWidget):
@@ -364,9 +426,9 @@ class TraceWidget(pg.PlotWidget):
         super(TraceWidget, self).__init__(parent)
         self.pltItem=self.getPlotItem()
         self.pltItem.setMenuEnabled(enableMenu=False)
-        # Speed up the panning and zooming
-        self.pltItem.setClipToView(True)
-        self.pltItem.setDownsampling(True, True, 'peak')
+        # Speed up the panning and zooming, the trace curves only draw what is within view
+        self.pltItem.vb.sigXRangeChanged.connect(self.updateTraceViews)
+        self.pltItem.vb.sigResized.connect(self.updateTraceViews)
         # Turn off the auto ranging
         self.pltItem.vb.disableAutoRange()
         # Only show the left axis
@@ -393,11 +455,33 @@ class TraceWidget(pg.PlotWidget):
         mousePoint=self.pltItem.vb.mapSceneToView(pixPoint)
         self.hoverPos=Decimal(mousePoint.x()),Decimal(mousePoint.y())
     
-    # Add a trace to the widget
-    def addTrace(self,x,y,cha,pen,dep):
-        curve=TraceCurve(x,y,cha,pen,dep)
+    # Add a trace to the widget, given its start time and sample spacing
+    def addTrace(self,t0,delta,y,cha,pen,dep):
+        curve=TraceCurve(t0,delta,y,cha,pen,dep)
         self.addItem(curve)
         self.traceCurves.append(curve)
+        self.updateTraceViews(curves=[curve])
+    
+    # Show a new set of traces [[t0,delta,y,cha,pen,dep],...], reusing the present trace curves...
+    # ...curves are only added or removed if the number of traces changed
+    def setTraces(self,traces):
+        for curve,trace in zip(self.traceCurves,traces):
+            curve.setTrace(*trace)
+        for trace in traces[len(self.traceCurves):]:
+            curve=TraceCurve(*trace)
+            self.addItem(curve)
+            self.traceCurves.append(curve)
+        while len(self.traceCurves)>len(traces):
+            self.removeItem(self.traceCurves.pop())
+        self.updateTraceViews()
+    
+    # Update which points of the trace curves are shown, given the current time range
+    def updateTraceViews(self,*args,**kwargs):
+        curves=kwargs.get('curves',self.traceCurves)
+        xMin,xMax=self.pltItem.vb.viewRange()[0]
+        numPixels=self.pltItem.vb.width()
+        for curve in curves:
+            curve.updateView(xMin,xMax,numPixels)
     
     # Add a single pick line to this station
     def addPick(self,aTime,aType,pen):
@@ -77,9 +77,18 @@ class Ui_actionDialog(object):
         self.actNameLineEdit = QtWidgets.QLineEdit(actionDialog)
         self.actNameLineEdit.setObjectName("actNameLineEdit")
         self.actShortInputLayout.addWidget(self.actNameLineEdit, 2, 2, 1, 1)
+        self.actPassiveCheckLayout = QtWidgets.QHBoxLayout()
+        self.actPassiveCheckLayout.setObjectName("actPassiveCheckLayout")
         self.passiveBeforeCheck = QtWidgets.QCheckBox(actionDialog)
         self.passiveBeforeCheck.setObjectName("passiveBeforeCheck")
-        self.actShortInputLayout.addWidget(self.passiveBeforeCheck, 6, 4, 1, 1)
+        self.actPassiveCheckLayout.addWidget(self.passiveBeforeCheck)
+        self.actCachedCheck = QtWidgets.QCheckBox(actionDialog)
+        self.actCachedCheck.setObjectName("actCachedCheck")
+        self.actPassiveCheckLayout.addWidget(self.actCachedCheck)
+        self.actProcessCheck = QtWidgets.QCheckBox(actionDialog)
+        self.actProcessCheck.setObjectName("actProcessCheck")
+        self.actPassiveCheckLayout.addWidget(self.actProcessCheck)
+        self.actShortInputLayout.addLayout(self.actPassiveCheckLayout, 6, 4, 1, 1)
         self.actPathLabel = QtWidgets.QLabel(actionDialog)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Preferred)
         sizePolicy.setHorizontalStretch(0)
@@ -119,6 +128,12 @@ class Ui_actionDialog(object):
         self.activeThreadedCheck = QtWidgets.QCheckBox(actionDialog)
         self.activeThreadedCheck.setObjectName("activeThreadedCheck")
         self.actActiveCheckLayout.addWidget(self.activeThreadedCheck)
+        self.activeThreadPolicyCombo = QtWidgets.QComboBox(actionDialog)
+        self.activeThreadPolicyCombo.setObjectName("activeThreadPolicyCombo")
+        self.activeThreadPolicyCombo.addItem("")
+        self.activeThreadPolicyCombo.addItem("")
+        self.activeThreadPolicyCombo.addItem("")
+        self.actActiveCheckLayout.addWidget(self.activeThreadPolicyCombo)
         self.actShortInputLayout.addLayout(self.actActiveCheckLayout, 0, 4, 1, 1)
         self.actShortInputLayout.setColumnStretch(1, 1)
         self.actShortInputLayout.setColumnStretch(2, 7)
@@ -217,9 +232,12 @@ class Ui_actionDialog(object):
         actionDialog.setTabOrder(self.actOptionalsLineEdit, self.actActiveRadio)
         actionDialog.setTabOrder(self.actActiveRadio, self.actTriggerLineEdit)
         actionDialog.setTabOrder(self.actTriggerLineEdit, self.actIntervalLineEdit)
-        actionDialog.setTabOrder(self.actIntervalLineEdit, self.actPassiveRadio)
+        actionDialog.setTabOrder(self.actIntervalLineEdit, self.activeThreadPolicyCombo)
+        actionDialog.setTabOrder(self.activeThreadPolicyCombo, self.actPassiveRadio)
         actionDialog.setTabOrder(self.actPassiveRadio, self.passiveBeforeCheck)
-        actionDialog.setTabOrder(self.passiveBeforeCheck, self.actSelectTriggerList)
+        actionDialog.setTabOrder(self.passiveBeforeCheck, self.actCachedCheck)
+        actionDialog.setTabOrder(self.actCachedCheck, self.actProcessCheck)
+        actionDialog.setTabOrder(self.actProcessCheck, self.actSelectTriggerList)
         actionDialog.setTabOrder(self.actSelectTriggerList, self.actAvailTriggerList)
         actionDialog.setTabOrder(self.actAvailTriggerList, self.actSelectInputList)
         actionDialog.setTabOrder(self.actSelectInputList, self.actAvailInputList)
@@ -244,6 +262,10 @@ class Ui_actionDialog(object):
         self.actActiveRadio.setText(_translate("actionDialog", "Active"))
         self.passiveBeforeCheck.setToolTip(_translate("actionDialog", "Action is to applied prior its triggering active action"))
         self.passiveBeforeCheck.setText(_translate("actionDialog", "Before Trigger"))
+        self.actCachedCheck.setToolTip(_translate("actionDialog", "Reuse the returns of a previous call with the same inputs and optionals (function must not have side effects)"))
+        self.actCachedCheck.setText(_translate("actionDialog", "Cache"))
+        self.actProcessCheck.setToolTip(_translate("actionDialog", "Run the function in a worker process, triggering it runs its queue on a seperate thread so it does not hold up the GUI (inputs and returns must be picklable)"))
+        self.actProcessCheck.setText(_translate("actionDialog", "Process"))
         self.actPathLabel.setToolTip(_translate("actionDialog", "Path relative a directory on the computers PATH variable"))
         self.actPathLabel.setText(_translate("actionDialog", "Path"))
         self.actTriggerLabel.setToolTip(_translate("actionDialog", "Keybind to activate action"))
@@ -252,6 +274,10 @@ class Ui_actionDialog(object):
         self.activeTimerCheck.setText(_translate("actionDialog", "Timer"))
         self.activeThreadedCheck.setToolTip(_translate("actionDialog", "Run action in background"))
         self.activeThreadedCheck.setText(_translate("actionDialog", "Thread"))
+        self.activeThreadPolicyCombo.setToolTip(_translate("actionDialog", "If triggered while still running: drop the new trigger, queue it, or cancel the running one and start again"))
+        self.activeThreadPolicyCombo.setItemText(0, _translate("actionDialog", "Drop"))
+        self.activeThreadPolicyCombo.setItemText(1, _translate("actionDialog", "Queue"))
+        self.activeThreadPolicyCombo.setItemText(2, _translate("actionDialog", "Supersede"))
         self.actAvailReturnList.setSortingEnabled(True)
         self.actAvailTriggerList.setSortingEnabled(True)
         self.actInputLabel.setToolTip(_translate("actionDialog", "Variable(s) to send to function"))
@@ -0,0 +1,53 @@
+# Author: Andrew.M.G.Reynen
+from __future__ import print_function
+import os
+import sys
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'lazylyst'))
+
+import numpy as np
+from obspy import Stream, Trace, UTCDateTime
+
+from LazylystCore import LazylystCore
+from HotVariables import initHotVar
+from Preferences import Pref
+from Actions import Action
+from ActionStats import ActionStats
+from ActionCache import ActionCache
+
+# Plugin which edits the trace headers, before editing the (read only) trace data in place
+def shiftAndScale(stream):
+    for tr in stream:
+        tr.stats.starttime+=10
+        tr.data*=2
+    return stream
+
+# Enough of the main window to run actions, without any widgets
+class CoreMain(LazylystCore):
+    def __init__(self):
+        self.hotVar=initHotVar()
+        self.pref={'inputCopyStyle':Pref(tag='inputCopyStyle',val='view')}
+        self.act={}
+        self.actStats=ActionStats()
+        self.actCache=ActionCache()
+        self.actPool=None
+        self.copyInputTags=set()
+
+    def getProcPool(self):
+        return None
+
+# An action failing to edit its read only inputs is run again with fresh copies, not the inputs it partly edited
+def test_callActionRetriesWithFreshInputs():
+    main=CoreMain()
+    startTime=UTCDateTime(2015,9,7)
+    main.hotVar['stream'].val=Stream([Trace(data=np.ones(100),header={'station':'STN01','starttime':startTime})])
+    action=Action(tag='ShiftAndScale',name='shiftAndScale',path='test_action_inputs',
+                  inputs=['stream'],returns=['pltSt'],func=shiftAndScale)
+    main.act[action.tag]=action
+    for i in range(2):
+        stream=main.callAction(action,main.collectActInputs(action.tag))
+        assert stream[0].stats.starttime==startTime+10
+        assert np.all(stream[0].data==2)
+    assert action.tag in main.copyInputTags
+    # The hot variable itself was not edited
+    assert main.hotVar['stream'].val[0].stats.starttime==startTime
+    assert np.all(main.hotVar['stream'].val[0].data==1)
@@ -0,0 +1,44 @@
+# Author: Andrew.M.G.Reynen
+from __future__ import print_function
+import os
+import sys
+from copy import deepcopy
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'lazylyst'))
+
+import numpy as np
+
+import StationMeta
+from HotVariables import readOnlySnapshot
+from Plugins.Locate import simpleLocator
+
+# Stations in a grid, with a P and S pick on each from an event in the middle
+def getStationsAndPicks(nSta=100):
+    lons,lats=np.meshgrid(np.linspace(-120,-119,10),np.linspace(50,51,nSta//10))
+    staLoc=np.array([['NX.S%03d.'%i,str(lon),str(lat),'0'] for i,(lon,lat) in enumerate(zip(lons.ravel(),lats.ravel()))])
+    pickSet=[]
+    for i,name in enumerate(staLoc[:,0]):
+        pickSet+=[[name,'P',str(1441584000.0+0.01*i)],[name,'S',str(1441584001.0+0.02*i)]]
+    return staLoc,np.array(pickSet)
+
+# Locating again, with new copies of the same inputs (as given to each action), reuses the station lookup
+def test_simpleLocatorReusesStaIndex():
+    staLoc,pickSet=getStationsAndPicks()
+    mapProj={'type':'Simple','epsg':'4326','simpleType':'AEA Conic','zDir':'end','units':'km','func':None,'funcInv':None}
+    StationMeta.setProjFunc(mapProj,staLoc,init=True)
+    sourceDict={'Velocity':{'Vp':6.19,'Vs':3.57,'Dp':0.74,'Ds':1.13,'tResThresh':1.0}}
+    staSort=staLoc[:,0]
+    del StationMeta.STA_INDEX_MEMO[:]
+    simpleLocator(pickSet,readOnlySnapshot(staLoc),deepcopy(mapProj),staSort,sourceDict)
+    stats=dict(StationMeta.STA_INDEX_STATS)
+    simpleLocator(pickSet,readOnlySnapshot(staLoc),deepcopy(mapProj),staSort,sourceDict)
+    assert StationMeta.STA_INDEX_STATS['misses']==stats['misses']
+    assert StationMeta.STA_INDEX_STATS['hits']>stats['hits']
+
+# Lookups give the first row of each name, and -1 for names not in the table
+def test_getStaRows():
+    staLoc,pickSet=getStationsAndPicks()
+    rows=StationMeta.getStaRows(staLoc,['NX.S005.','XX.NONE.','NX.S000.'])
+    assert list(rows)==[5,-1,0]
+    # An edited (writable) table must not be given the lookup of its old names
+    staLoc[5,0]='NX.S999.'
+    assert list(StationMeta.getStaRows(staLoc,['NX.S005.','NX.S999.']))==[-1,5]